@@ -0,0 +1,174 @@
+#
+# test_wtfdmdg.py
+#
+# Tests for the GUI application, under an offscreen Qt. Run with python -m
+# pytest, or python -m unittest.
+#
+
+import os
+import sys
+import time
+import datetime
+import threading
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault( "QT_QPA_PLATFORM", "offscreen" )
+
+import wtfdmdg_core
+from wtfdmdg_core import DAY_PATH, WtfdmdgJournal, WtfdmdgHistoryStore, WtfdmdgBaseCommandParser, runBatch
+
+import wtfdmdg
+from test_wtfdmdg_daemon import ServerThread
+
+_app = None
+
+def getApplication():
+    """
+    Get the one application a process may have, created on first use
+    """
+    global _app
+    if _app is None:
+        _app = wtfdmdg.WtfdmdgApplication( sys.argv[:1] )
+    return _app
+
+def tearDownModule():
+    if _app is not None:
+        _app.closeFile()
+
+class ApplicationTest( unittest.TestCase ):
+    """
+    Runs the application against day files in a temporary directory
+    """
+
+    def setUp( self ):
+        self._directory = tempfile.TemporaryDirectory()
+        appdata = os.path.join( self._directory.name, "wtfdmdg" )
+        os.makedirs( appdata )
+        for module, name, value in ( ( wtfdmdg_core, "APPDATA_DIR", appdata ),
+                                     ( wtfdmdg, "APPDATA_DIR", appdata ),
+                                     ( wtfdmdg_core, "HISTORY_PATH", os.path.join( appdata, "history.sqlite3" ) ) ):
+            patcher = mock.patch.object( module, name, value )
+            patcher.start()
+            self.addCleanup( patcher.stop )
+        self.app = getApplication()
+        # Forget the history store of the last test's directory
+        self.app._writer.submit( None, self.app._closeHistory )
+        self.app._writer.flush()
+        self.app._historyChanges.clear()
+        self.app.loadFile()
+        self.addCleanup( self._directory.cleanup )
+        self.addCleanup( self.app._writer.flush )
+
+    def pump( self, seconds ):
+        """
+        Run the event loop for seconds
+        """
+        end = time.time() + seconds
+        while time.time() < end:
+            self.app.processEvents()
+            time.sleep( 0.01 )
+
+    def bodies( self, session ):
+        return sorted( t.body.strip() for t in session.values() )
+
+    def test_commandAfterExternalCompactionKeepsBoth( self ):
+        # Another process folds the day into a new snapshot and removes the
+        # journal, and a command follows before the file watcher reports it
+        self.app.processLine( "0900-1000 mine" )
+        self.app._writer.flush()
+        self.pump( 0.5 )
+        runBatch( [ "1000-1100 theirs" ] )
+        self.app.processLine( "1100-1200 mine2" )
+        self.app._writer.flush()
+        self.pump( 0.5 )
+        self.app._writer.flush()
+
+        self.assertEqual( self.bodies( self.app.session ), [ "mine", "mine2", "theirs" ] )
+        self.assertEqual( WtfdmdgJournal( DAY_PATH( self.app.getDay() ) ).read(), self.app.session )
+
+    def test_ownCommandsAreNotReadBack( self ):
+        self.app.processLine( "0900-1000 mine" )
+        self.app._writer.flush()
+        self.pump( 0.5 )
+        with mock.patch.object( WtfdmdgJournal, "read", autospec=True, side_effect=WtfdmdgJournal.read ) as read:
+            for i in range( 3 ):
+                self.app.processLine( "{}-{} command {}".format( 10 + i, 11 + i, i ) )
+                self.pump( 0.4 )
+            self.app._writer.flush()
+            self.assertEqual( read.call_count, 0 )
+
+    def test_commandOnAnotherDayIsDatedThatDay( self ):
+        yesterday = self.app.getDay() - datetime.timedelta( days=1 )
+        self.app.showDay( yesterday )
+        try:
+            self.app.processLine( "0900-1000 then" )
+            self.app._writer.flush()
+            task, = WtfdmdgJournal( DAY_PATH( yesterday ) ).read().values()
+            self.assertEqual( task.begin, datetime.datetime.combine( yesterday, datetime.time( 9 ) ) )
+        finally:
+            self.app.showToday()
+
+    def test_historyIsNotImportedAgain( self ):
+        for i in range( 3 ):
+            self.app.processLine( "{}-{} command {}".format( 10 + i, 11 + i, i ) )
+            self.app._writer.flush()
+        self.app.processLine( "1:" )
+        self.app._writer.flush()
+        store = WtfdmdgHistoryStore( WtfdmdgBaseCommandParser() )
+        try:
+            self.assertEqual( store.importDayFiles(), 0 )
+            begin = datetime.datetime.combine( self.app.getDay(), datetime.time() )
+            self.assertEqual( sorted( t.body.strip() for _, t in store.getTasks( begin, begin + datetime.timedelta( days=1 ) ) ),
+                              [ "command 0", "command 2" ] )
+        finally:
+            store.close()
+
+    def test_timelineReadsPastDaysInTheBackground( self ):
+        today = self.app.getDay()
+        # Yesterday may have been read ahead already
+        for k in range( 2, 5 ):
+            runBatch( [ "0900-1000 past" ], day=today - datetime.timedelta( days=k ) )
+        self.pump( 0.2 )
+        timeline = self.app._mainWindow._timelineWidget
+        self.addCleanup( timeline.setSpan, 1 )
+        read = WtfdmdgJournal.read
+        readers = []
+        def readOffThread( journal ):
+            readers.append( threading.current_thread() )
+            return read( journal )
+        with mock.patch.object( WtfdmdgJournal, "read", autospec=True, side_effect=readOffThread ):
+            timeline.setSpan( 7 )
+            timeline.redraw()
+            self.assertEqual( len( timeline._barGraphItem.opts[ "x0" ] ), 0 )
+            self.pump( 0.5 )
+            self.assertEqual( len( timeline._barGraphItem.opts[ "x0" ] ), 3 )
+            n = len( readers )
+            timeline.redraw()
+            self.pump( 0.1 )
+        self.assertEqual( len( readers ), n )
+        self.assertNotIn( threading.main_thread(), readers )
+
+    def test_carriesOnWhenTheServerGoes( self ):
+        server = ServerThread( wtfdmdg_core.APPDATA_DIR )
+        self.addCleanup( server.stop )
+        client = server.connect()
+        # Attach the client as the application does when started with one
+        self.app._client = client
+        self.app.serverLost.connect( self.app._onServerLost )
+        self.addCleanup( self.app.serverLost.disconnect )
+        client.onClose = self.app.serverLost.emit
+        self.assertTrue( self.app.processLine( "0900-1000 served" ) )
+
+        server.stop()
+        self.assertFalse( self.app.processLines( [ "1000-1100 unsent" ] ) )
+        self.pump( 0.2 )
+        self.assertIsNone( self.app._client )
+        self.assertEqual( self.bodies( self.app.session ), [ "served" ] )
+        self.assertTrue( self.app.processLine( "1000-1100 standalone" ) )
+        self.app._writer.flush()
+        self.assertEqual( self.bodies( WtfdmdgJournal( DAY_PATH( self.app.getDay() ) ).read() ), [ "served", "standalone" ] )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,454 @@
+#
+# test_wtfdmdg_core.py
+#
+# Tests for wtfdmdg_core. Run with python -m pytest, or python -m unittest.
+#
+
+import os
+import time
+import pickle
+import threading
+import unittest
+import random
+import datetime
+import tempfile
+from unittest import mock
+
+import wtfdmdg_core
+from wtfdmdg_core import ( Task, layoutTimeline, WtfdmdgJournal, WtfdmdgBaseCommandParser, executeTransaction,
+                           runBatch, DAY_PATH, WtfdmdgHistoryStore, WtfdmdgChangeSet, WtfdmdgDayCache,
+                           writeSnapshot, readSnapshot, JOURNAL_PATH, WtfdmdgTaskIndex, WtfdmdgTagIndex, WtfdmdgUndoLog,
+                           applyChanges )
+
+MINUTE = datetime.timedelta( minutes=1 )
+
+def randomSession( rng, size ):
+    """
+    Make a list of size closed tasks with minute resolution times, including
+    tasks which touch, nest and last no time at all
+    """
+    day = datetime.datetime( 2026, 1, 1, 8 )
+    tasks = []
+    for ref in range( size ):
+        begin = day + rng.randrange( 0, 600 ) * MINUTE
+        end = begin + rng.choice( [ 0, 1, rng.randrange( 0, 120 ) ] ) * MINUTE
+        tasks.append( Task( ref, begin, end, "task %d" % ref ) )
+    return tasks
+
+def conflicts( a, b ):
+    """
+    True if a and b are ever running during the same minute. A task shorter
+    than a minute runs during no minute at all.
+    """
+    return max( a.begin, b.begin ) <= min( a.end, b.end ) - MINUTE
+
+def activeAtLayout( tasks ):
+    """
+    The layout the timeline used before layoutTimeline, kept to compare against
+    """
+    def activeAt( t0, t1 ):
+        t0 = t0 + MINUTE
+        return [ x for x in tasks if not ( t1 < ( x.begin ) or t0 > ( x.end ) ) ]
+    importantTimes = sorted( set( x.begin for x in tasks ) | set( x.end for x in tasks ) )
+    maxConcurrent = max( len( activeAt( x, x ) ) for x in importantTimes )
+
+    columnAssignments = {}
+    for task in tasks:
+        columnAssignments[ task ] = None
+    for task in tasks:
+        conflicting = activeAt( task.begin, task.end )
+        for i in range( maxConcurrent ):
+            if i not in [ columnAssignments[ x ] for x in conflicting ]:
+                columnAssignments[ task ] = i
+                break
+    return maxConcurrent, columnAssignments
+
+class LayoutTimelineTest( unittest.TestCase ):
+
+    SESSIONS = 3000
+
+    def sessions( self ):
+        rng = random.Random( 1 )
+        for _ in range( self.SESSIONS ):
+            yield randomSession( rng, rng.randrange( 1, 30 ) )
+
+    def test_maxConcurrentMatchesActiveAt( self ):
+        for tasks in self.sessions():
+            self.assertEqual( layoutTimeline( tasks )[0], activeAtLayout( tasks )[0] )
+
+    def test_columnsMatchActiveAt( self ):
+        # Where the old layout gave every task a column, the columns should
+        # not move. Sessions are taken in order of begin time, as they are
+        # usually entered, since the old layout depended on session order,
+        # and without instant tasks, which the old layout let conflict.
+        compared = 0
+        for tasks in self.sessions():
+            tasks = sorted( ( x for x in tasks if x.end > x.begin ), key=lambda x: x.begin )
+            if len( tasks ) == 0:
+                continue
+            _, columns = activeAtLayout( tasks )
+            if None in columns.values():
+                continue
+            self.assertEqual( layoutTimeline( tasks )[1], columns )
+            compared += 1
+        self.assertGreater( compared, self.SESSIONS // 2 )
+
+    def test_everyTaskGetsAColumn( self ):
+        for tasks in self.sessions():
+            maxConcurrent, columns = layoutTimeline( tasks )
+            self.assertEqual( set( columns ), set( tasks ) )
+            for task in tasks:
+                self.assertIn( columns[ task ], range( max( maxConcurrent, 1 ) ) )
+
+    def test_conflictingTasksNeverShareAColumn( self ):
+        for tasks in self.sessions():
+            _, columns = layoutTimeline( tasks )
+            for i, a in enumerate( tasks ):
+                for b in tasks[ i + 1: ]:
+                    if conflicts( a, b ):
+                        self.assertNotEqual( columns[ a ], columns[ b ], ( a, b ) )
+
+    def test_emptyAndInstantSessions( self ):
+        self.assertEqual( layoutTimeline( [] ), ( 0, {} ) )
+        begin = datetime.datetime( 2026, 1, 1, 9 )
+        tasks = [ Task( 0, begin, begin, "" ), Task( 1, begin, begin + MINUTE, "" ) ]
+        maxConcurrent, columns = layoutTimeline( tasks )
+        self.assertEqual( maxConcurrent, 1 )
+        self.assertEqual( columns, { tasks[0] : 0, tasks[1] : 0 } )
+
+    def test_touchingTasksShareAColumn( self ):
+        begin = datetime.datetime( 2026, 1, 1, 9 )
+        tasks = [ Task( 0, begin, begin + 30 * MINUTE, "" ),
+                  Task( 1, begin + 30 * MINUTE, begin + 60 * MINUTE, "" ) ]
+        self.assertEqual( layoutTimeline( tasks ), ( 1, { tasks[0] : 0, tasks[1] : 0 } ) )
+
+def useDirectory( test ):
+    """
+    Point APPDATA_DIR and HISTORY_PATH of wtfdmdg_core at a temporary
+    directory for the duration of test
+    """
+    directory = tempfile.TemporaryDirectory()
+    test.addCleanup( directory.cleanup )
+    for name, value in ( ( "APPDATA_DIR", directory.name ),
+                         ( "HISTORY_PATH", os.path.join( directory.name, "history.sqlite3" ) ) ):
+        patcher = mock.patch.object( wtfdmdg_core, name, value )
+        patcher.start()
+        test.addCleanup( patcher.stop )
+    return directory.name
+
+class CommandParserTest( unittest.TestCase ):
+
+    DAY = datetime.date( 2026, 3, 7 )
+
+    def test_timesAreOnTheGivenDay( self ):
+        session = {}
+        WtfdmdgBaseCommandParser().execute( session, "0900-1030 x", day=CommandParserTest.DAY )
+        self.assertEqual( session[ 0 ], Task( 0, datetime.datetime( 2026, 3, 7, 9 ), datetime.datetime( 2026, 3, 7, 10, 30 ), " x" ) )
+
+    def test_nowIsOnTheGivenDay( self ):
+        session = {}
+        WtfdmdgBaseCommandParser().execute( session, "n-.x", day=CommandParserTest.DAY )
+        self.assertEqual( session[ 0 ].begin.date(), CommandParserTest.DAY )
+        self.assertEqual( session[ 0 ].begin.second, 0 )
+
+    def test_timesDefaultToToday( self ):
+        session = {}
+        WtfdmdgBaseCommandParser().execute( session, "0900-1030 x" )
+        self.assertEqual( session[ 0 ].begin.date(), datetime.date.today() )
+
+    def test_transactionOnAnotherDay( self ):
+        session = {}
+        executeTransaction( WtfdmdgBaseCommandParser(), session, [ "0900-1000 a", "1000-1100 b" ], day=CommandParserTest.DAY )
+        self.assertEqual( set( t.begin.date() for t in session.values() ), { CommandParserTest.DAY } )
+
+    def test_batchOnAnotherDay( self ):
+        useDirectory( self )
+        runBatch( [ "0900-1000 x" ], day=CommandParserTest.DAY )
+        session = WtfdmdgJournal( DAY_PATH( CommandParserTest.DAY ) ).read()
+        self.assertEqual( session[ 0 ].begin, datetime.datetime( 2026, 3, 7, 9 ) )
+
+class ExecuteTransactionTest( unittest.TestCase ):
+
+    class Recorder( object ):
+        """
+        Index recording every call made to it
+        """
+
+        def __init__( self ):
+            self.calls = []
+
+        def put( self, task ):
+            self.calls.append( ( "put", task ) )
+
+        def remove( self, ref ):
+            self.calls.append( ( "remove", ref ) )
+
+    def test_failingLineLeavesEverythingAsItWas( self ):
+        parser = WtfdmdgBaseCommandParser()
+        session = {}
+        executeTransaction( parser, session, [ "0900-1000 a /x", "1000-1100 b /y //p", "1100- c" ] )
+        before = dict( session )
+        taskIndex = WtfdmdgTaskIndex( session )
+        tagIndex = WtfdmdgTagIndex( parser, session )
+        tasks, tagtable, nextRef = taskIndex.getTasks(), tagIndex.getTagTable(), taskIndex.nextRef()
+        tagtable = { cls : list( tags ) for cls, tags in tagtable.items() }
+        revisions = ( taskIndex.revision, tagIndex.revision )
+        recorder = ExecuteTransactionTest.Recorder()
+
+        with self.assertRaisesRegex( ValueError, "line 5" ):
+            executeTransaction( parser, session, [ "1200-1300 d /z", "0:a2 /w", "1:", "2:1130", "7:" ],
+                                ( taskIndex, tagIndex, recorder ) )
+
+        self.assertEqual( session, before )
+        self.assertEqual( taskIndex.getTasks(), tasks )
+        self.assertEqual( taskIndex.nextRef(), nextRef )
+        self.assertEqual( tagIndex.getTagTable(), tagtable )
+        self.assertEqual( { ref : tagIndex.getTaskTags( ref ) for ref in session },
+                          { ref : parser.getTaskTags( task.body ) for ref, task in session.items() } )
+        self.assertEqual( ( taskIndex.revision, tagIndex.revision ), revisions )
+        self.assertEqual( recorder.calls, [] )
+
+class WtfdmdgUndoLogTest( unittest.TestCase ):
+
+    DAY = datetime.date( 2026, 1, 1 )
+
+    def setUp( self ):
+        self.parser = WtfdmdgBaseCommandParser()
+        self.session = {}
+        self.log = WtfdmdgUndoLog( self.session )
+
+    def step( self, *lines ):
+        """
+        Run lines, one execute each as commands are run, as one undo step
+        """
+        for line in lines:
+            self.parser.execute( self.session, line, ( self.log, ), WtfdmdgUndoLogTest.DAY )
+        self.log.commit()
+        return dict( self.session )
+
+    def undo( self ):
+        applyChanges( self.session, *self.log.undo() )
+        return dict( self.session )
+
+    def redo( self ):
+        applyChanges( self.session, *self.log.redo() )
+        return dict( self.session )
+
+    def test_roundTrips( self ):
+        states = [ {} ]
+        states.append( self.step( "0900-1000 create" ) )
+        states.append( self.step( "0:edit" ) )
+        states.append( self.step( "1000-1100 other" ) )
+        states.append( self.step( "0:" ) )
+        # Several lines as one step, touching one task more than once
+        states.append( self.step( "1100-1200 batch", "2:1130", "1:", "2:batch edited", "1200-1300 again" ) )
+        transaction = executeTransaction( self.parser, self.session, [ "1300-1400 tx", "2:", "3:tx edited" ], ( self.log, ),
+                                          WtfdmdgUndoLogTest.DAY )
+        self.assertGreater( transaction, 0 )
+        self.log.commit()
+        states.append( dict( self.session ) )
+
+        for state in reversed( states[ :-1 ] ):
+            self.assertEqual( self.undo(), state )
+        self.assertFalse( self.log.canUndo() )
+        for state in states[ 1: ]:
+            self.assertEqual( self.redo(), state )
+        self.assertFalse( self.log.canRedo() )
+        # And back again, after a full redo
+        for state in reversed( states[ :-1 ] ):
+            self.assertEqual( self.undo(), state )
+
+    def test_commandAfterUndoDropsRedo( self ):
+        self.step( "0900-1000 a" )
+        self.step( "1000-1100 b" )
+        self.undo()
+        self.step( "1100-1200 c" )
+        self.assertEqual( sorted( t.body for t in self.session.values() ), [ " a", " c" ] )
+        self.assertFalse( self.log.canRedo() )
+
+    def test_memoryCapDropsOldestSteps( self ):
+        body = " %s" % ( "x" * 39 )
+        stepBytes = WtfdmdgUndoLog.OPERATION_BYTES + len( body )
+        self.log = WtfdmdgUndoLog( self.session, maxBytes=3 * stepBytes )
+        states = [ self.step( "{:02d}00-{:02d}00{}".format( 9 + i, 10 + i, body ) ) for i in range( 6 ) ]
+        for state in reversed( states[ 2:-1 ] ):
+            self.assertEqual( self.undo(), state )
+        self.assertFalse( self.log.canUndo() )
+
+    def test_memoryCapKeepsTheLatestStep( self ):
+        self.log = WtfdmdgUndoLog( self.session, maxBytes=1 )
+        self.step( "0900-1000 a" )
+        self.step( "1000-1100 b" )
+        self.assertEqual( self.undo(), { 0 : Task( 0, datetime.datetime( 2026, 1, 1, 9 ), datetime.datetime( 2026, 1, 1, 10 ), " a" ) } )
+        self.assertFalse( self.log.canUndo() )
+
+class WtfdmdgJournalTest( unittest.TestCase ):
+
+    def setUp( self ):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup( directory.cleanup )
+        self.path = os.path.join( directory.name, "day.pickle" )
+
+    def task( self, ref, body ):
+        begin = datetime.datetime( 2026, 1, 1, 9 ) + ref * MINUTE
+        return Task( ref, begin, begin + MINUTE, body )
+
+    def test_appendAfterAnotherProcessFolds( self ):
+        ours = WtfdmdgJournal( self.path )
+        ours.load()
+        ours.put( self.task( 0, "mine" ) )
+        # Another process loads the day, adds to it and folds it away
+        theirs = WtfdmdgJournal( self.path )
+        session = theirs.load()
+        session[ 1 ] = self.task( 1, "theirs" )
+        theirs.fold( session )
+        theirs.close()
+        ours.put( self.task( 2, "mine2" ) )
+        ours.close()
+        self.assertEqual( sorted( t.body for t in WtfdmdgJournal( self.path ).read().values() ),
+                          [ "mine", "mine2", "theirs" ] )
+
+    def test_replayAfterReopen( self ):
+        journal = WtfdmdgJournal( self.path )
+        journal.load()
+        journal.put( self.task( 0, "a" ) )
+        journal.put( self.task( 1, "b" ) )
+        journal.reopen()
+        journal.put( self.task( 0, "a2" ) )
+        journal.remove( 1 )
+        journal.close()
+        self.assertEqual( WtfdmdgJournal( self.path ).load(), { 0 : self.task( 0, "a2" ) } )
+
+    def test_repairsTornLastRecord( self ):
+        journal = WtfdmdgJournal( self.path )
+        journal.load()
+        journal.put( self.task( 0, "a" ) )
+        journal.close()
+        good = os.path.getsize( JOURNAL_PATH( self.path ) )
+        # A crash part way through writing the next record
+        with open( JOURNAL_PATH( self.path ), 'ab' ) as f:
+            f.write( pickle.dumps( ( "put", 1, None, None, "torn" ) )[ :-3 ] )
+        journal = WtfdmdgJournal( self.path )
+        self.assertEqual( journal.load(), { 0 : self.task( 0, "a" ) } )
+        self.assertEqual( os.path.getsize( JOURNAL_PATH( self.path ) ), good )
+        journal.put( self.task( 1, "b" ) )
+        journal.close()
+        self.assertEqual( WtfdmdgJournal( self.path ).read(), { 0 : self.task( 0, "a" ), 1 : self.task( 1, "b" ) } )
+
+    def test_compactionRacingAppends( self ):
+        written = []
+        def slowWriteSnapshot( path, session ):
+            # Give appends time to land while the snapshot is written
+            time.sleep( 0.005 )
+            writeSnapshot( path, session )
+            written.append( session )
+        rng = random.Random( 1 )
+        journal = WtfdmdgJournal( self.path )
+        session = journal.load()
+        with mock.patch.object( wtfdmdg_core, "writeSnapshot", side_effect=slowWriteSnapshot ):
+            for i in range( 1000 ):
+                if len( session ) > 0 and rng.random() < 0.2:
+                    ref = rng.choice( list( session ) )
+                    del session[ ref ]
+                    journal.remove( ref )
+                else:
+                    task = self.task( rng.randrange( 100 ), "task %d" % i )
+                    session[ task.ref ] = task
+                    journal.put( task )
+                if i % 50 == 0:
+                    journal.compact( session )
+            journal.close()
+        self.assertGreater( len( written ), 1 )
+        with open( self.path, 'rb' ) as f:
+            self.assertEqual( readSnapshot( f ), written[ -1 ] )
+        self.assertEqual( WtfdmdgJournal( self.path ).read(), session )
+
+class WtfdmdgHistoryStoreTest( unittest.TestCase ):
+
+    DAY = datetime.date( 2026, 1, 1 )
+
+    def setUp( self ):
+        self.directory = useDirectory( self )
+        self.store = WtfdmdgHistoryStore( WtfdmdgBaseCommandParser() )
+        self.addCleanup( self.store.close )
+        self.journal = WtfdmdgJournal( DAY_PATH( WtfdmdgHistoryStoreTest.DAY ) )
+        self.session = self.journal.load()
+        self.addCleanup( self.journal.close )
+        self.changes = WtfdmdgChangeSet()
+
+    def run_( self, line ):
+        """
+        Run a command line against the day, as the application does
+        """
+        WtfdmdgBaseCommandParser().execute( self.session, line, ( self.journal, self.changes ), WtfdmdgHistoryStoreTest.DAY )
+        self.store.putChanges( WtfdmdgHistoryStoreTest.DAY, self.changes )
+
+    def bodies( self ):
+        begin = datetime.datetime.combine( WtfdmdgHistoryStoreTest.DAY, datetime.time() )
+        return sorted( t.body.strip() for _, t in self.store.getTasks( begin, begin + datetime.timedelta( days=1 ) ) )
+
+    def test_putsOnlyChangedRows( self ):
+        self.run_( "0900-1000 a" )
+        self.run_( "1000-1100 b" )
+        with mock.patch.object( self.store, "putDay" ) as putDay:
+            with mock.patch.object( self.store, "_insertTasks", wraps=self.store._insertTasks ) as insert:
+                self.run_( "1100-1200 c" )
+                self.run_( "1:" )
+        putDay.assert_not_called()
+        self.assertEqual( [ [ t.body for t in c[0][1] ] for c in insert.call_args_list ], [ [ " c" ], [] ] )
+        self.assertEqual( self.bodies(), [ "a", "c" ] )
+
+    def test_recordsTheFilesModifiedTime( self ):
+        self.run_( "0900-1000 a" )
+        self.run_( "1000-1100 b" )
+        self.assertEqual( self.store.importDayFiles(), 0 )
+
+    def test_readsTheDayBackIfStoredElsewhere( self ):
+        self.run_( "0900-1000 a" )
+        # Another process changes the day and leaves the store behind
+        runBatch( [ "1000-1100 theirs" ], day=WtfdmdgHistoryStoreTest.DAY )
+        self.session = self.journal.load()
+        self.run_( "1100-1200 b" )
+        self.assertEqual( self.bodies(), [ "a", "b", "theirs" ] )
+        self.assertEqual( self.store.importDayFiles(), 0 )
+
+    def test_changeSetKeepsLatestState( self ):
+        begin = datetime.datetime( 2026, 1, 1, 9 )
+        self.changes.put( Task( 0, begin, None, "x" ) )
+        self.changes.put( Task( 0, begin, begin + MINUTE, "x" ) )
+        self.changes.put( Task( 1, begin, None, "y" ) )
+        self.changes.remove( 1 )
+        self.changes.remove( 2 )
+        self.assertEqual( self.changes.take(), ( [ Task( 0, begin, begin + MINUTE, "x" ) ], [ 1, 2 ] ) )
+        self.assertEqual( self.changes.take(), ( [], [] ) )
+
+class WtfdmdgDayCacheTest( unittest.TestCase ):
+
+    DAY = datetime.date( 2026, 1, 1 )
+
+    def setUp( self ):
+        useDirectory( self )
+        runBatch( [ "0900-1000 x" ], day=WtfdmdgDayCacheTest.DAY )
+        self.cache = WtfdmdgDayCache( WtfdmdgBaseCommandParser(), 2 )
+        self.addCleanup( self.cache.close )
+
+    def test_peekNeverReads( self ):
+        with mock.patch.object( WtfdmdgJournal, "read" ) as read:
+            self.assertIsNone( self.cache.peek( WtfdmdgDayCacheTest.DAY ) )
+        read.assert_not_called()
+
+    def test_prefetchCallsBackOnceRead( self ):
+        loaded = threading.Event()
+        self.cache.prefetch( ( WtfdmdgDayCacheTest.DAY, ), lambda day: loaded.set() )
+        self.assertTrue( loaded.wait( 5 ) )
+        entry = self.cache.peek( WtfdmdgDayCacheTest.DAY )
+        self.assertEqual( [ t.body for t in entry.session.values() ], [ " x" ] )
+
+    def test_changedDayIsNotPeeked( self ):
+        entry = self.cache.get( WtfdmdgDayCacheTest.DAY )
+        self.assertIs( self.cache.peek( WtfdmdgDayCacheTest.DAY ), entry )
+        runBatch( [ "1000-1100 y" ], day=WtfdmdgDayCacheTest.DAY )
+        self.assertIsNone( self.cache.peek( WtfdmdgDayCacheTest.DAY ) )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+#
+# test_wtfdmdg_daemon.py
+#
+# Tests for the session server and its clients. Run with python -m pytest,
+# or python -m unittest.
+#
+
+import os
+import json
+import queue
+import socket
+import asyncio
+import datetime
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import wtfdmdg_core
+import wtfdmdg_daemon
+from wtfdmdg_core import DAY_PATH, WtfdmdgJournal
+from wtfdmdg_daemon import WtfdmdgSessionServer, WtfdmdgRemoteError
+
+class ServerThread( object ):
+    """
+    A session server running on its own event loop thread, for days in
+    directory
+    """
+
+    def __init__( self, directory ):
+        self.path = os.path.join( directory, "session.sock" )
+        self.server = WtfdmdgSessionServer( path=self.path, directory=directory )
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete( self.server.start() )
+        self._thread = threading.Thread( target=self._loop.run_forever, daemon=True )
+        self._thread.start()
+
+    def connect( self, onChange=None ):
+        return wtfdmdg_daemon.connect( self.path, onChange )
+
+    def stop( self ):
+        """
+        Shut the server down, dropping its clients
+        """
+        async def stop():
+            self.server.close()
+            # Let the client handlers see their connections close
+            await asyncio.sleep( 0.1 )
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe( stop(), self._loop ).result()
+        self._loop.call_soon_threadsafe( self._loop.stop )
+        self._thread.join()
+        self._loop.close()
+
+class WtfdmdgSessionServerTest( unittest.TestCase ):
+
+    DAY = datetime.date( 2026, 1, 1 )
+
+    def setUp( self ):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup( directory.cleanup )
+        self.directory = directory.name
+        patcher = mock.patch.object( wtfdmdg_core, "HISTORY_PATH", os.path.join( self.directory, "history.sqlite3" ) )
+        patcher.start()
+        self.addCleanup( patcher.stop )
+        self.server = ServerThread( self.directory )
+        self.addCleanup( self.server.stop )
+
+    def connect( self, onChange=None ):
+        client = self.server.connect( onChange )
+        self.addCleanup( client.close )
+        return client
+
+    def test_changesReachTheOtherClient( self ):
+        changes = queue.Queue()
+        ours = self.connect( lambda *change: changes.put( ( "ours", ) + change ) )
+        theirs = self.connect( lambda *change: changes.put( ( "theirs", ) + change ) )
+        day = WtfdmdgSessionServerTest.DAY
+
+        tasks, refs = ours.execute( day, [ "0900-1000 a", "1000-1100 b" ] )
+        self.assertEqual( sorted( t.body for t in tasks ), [ " a", " b" ] )
+        self.assertEqual( changes.get( timeout=5 ), ( "theirs", day, tasks, refs ) )
+
+        tasks, refs = theirs.execute( day, [ "0:" ] )
+        self.assertEqual( ( tasks, refs ), ( [], [ 0 ] ) )
+        self.assertEqual( changes.get( timeout=5 ), ( "ours", day, [], [ 0 ] ) )
+
+        self.assertEqual( ours.getSession( day ), theirs.getSession( day ) )
+        self.assertTrue( changes.empty() )
+
+    def test_failingBatchIsRefused( self ):
+        changes = queue.Queue()
+        ours = self.connect()
+        theirs = self.connect( lambda *change: changes.put( change ) )
+        day = WtfdmdgSessionServerTest.DAY
+        ours.execute( day, [ "0900-1000 a" ] )
+        changes.get( timeout=5 )
+
+        with self.assertRaisesRegex( WtfdmdgRemoteError, "line 2" ):
+            ours.execute( day, [ "1000-1100 b", "7:" ] )
+        self.assertEqual( [ t.body for t in theirs.getSession( day ).values() ], [ " a" ] )
+        self.assertTrue( changes.empty() )
+
+        self.server.stop()
+        self.assertEqual( [ t.body for t in WtfdmdgJournal( DAY_PATH( day, self.directory ) ).read().values() ], [ " a" ] )
+
+    def test_requestWithoutAnIdIsAnswered( self ):
+        sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.addCleanup( sock.close )
+        sock.connect( self.server.path )
+        sock.sendall( json.dumps( { "op" : "session", "day" : "2026-01-01" } ).encode( "utf-8" ) + b"\n" )
+        response = json.loads( sock.makefile( "rb" ).readline() )
+        self.assertEqual( response, { "tasks" : [], "id" : None, "ok" : True } )
+
+    def test_clientsHearTheServerGo( self ):
+        closed = threading.Event()
+        client = self.connect()
+        client.onClose = closed.set
+        self.server.stop()
+        self.assertTrue( closed.wait( 5 ) )
+        self.assertFalse( client.isConnected() )
+        with self.assertRaises( WtfdmdgRemoteError ):
+            client.execute( WtfdmdgSessionServerTest.DAY, [ "0900-1000 a" ] )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+#
+# test_wtfdmdg_export.py
+#
+# Tests for wtfdmdg_export. Run with python -m pytest, or python -m unittest.
+#
+
+import os
+import sys
+import datetime
+import tempfile
+import subprocess
+import unittest
+
+import wtfdmdg_export
+from wtfdmdg_core import Task, DAY_PATH, writeSnapshot
+
+class ExportTest( unittest.TestCase ):
+
+    FIRST = datetime.date( 2026, 1, 1 )
+
+    def setUp( self ):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup( directory.cleanup )
+        self.directory = directory.name
+        # Far more than a pipe holds
+        for k in range( 100 ):
+            day = ExportTest.FIRST + datetime.timedelta( days=k )
+            begin = datetime.datetime.combine( day, datetime.time( 9 ) )
+            minute = datetime.timedelta( minutes=1 )
+            writeSnapshot( DAY_PATH( day, self.directory ),
+                           { i : Task( i, begin + i * minute, begin + ( i + 1 ) * minute, "task %d /a //b" % i ) for i in range( 100 ) } )
+
+    def test_readerClosingEarlyIsQuiet( self ):
+        for format in ( "csv", "jsonl" ):
+            script = "import wtfdmdg_export; wtfdmdg_export.export( '-', {!r}, directory={!r} )".format( format, self.directory )
+            process = subprocess.Popen( [ sys.executable, "-c", script ], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        cwd=os.path.dirname( os.path.abspath( wtfdmdg_export.__file__ ) ) )
+            # As head does, read a little and go
+            process.stdout.readline()
+            process.stdout.close()
+            stderr = process.stderr.read()
+            process.stderr.close()
+            self.assertEqual( ( process.wait(), stderr ), ( 0, b"" ) )
+
+    def test_exportsEveryTask( self ):
+        path = self.directory + "/tasks.csv"
+        self.assertEqual( wtfdmdg_export.export( path, directory=self.directory ), 100 * 100 )
+        with open( path ) as f:
+            self.assertEqual( len( f.readlines() ), 1 + 100 * 100 )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#
+# test_wtfdmdg_report.py
+#
+# Tests for wtfdmdg_report. Run with python -m pytest, or python -m unittest.
+#
+
+import os
+import sys
+import pickle
+import datetime
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import wtfdmdg_report
+from wtfdmdg_core import Task, DAY_PATH, writeSnapshot
+
+class MakeReportTest( unittest.TestCase ):
+
+    FIRST = datetime.date( 2026, 1, 1 )
+
+    def setUp( self ):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup( directory.cleanup )
+        self.directory = directory.name
+        for k in range( 20 ):
+            day = MakeReportTest.FIRST + datetime.timedelta( days=k )
+            begin = datetime.datetime.combine( day, datetime.time( 9 ) )
+            hour = datetime.timedelta( hours=1 )
+            writeSnapshot( DAY_PATH( day, self.directory ),
+                           { 0 : Task( 0, begin, begin + hour, "/a" ),
+                             1 : Task( 1, begin + hour, begin + 3 * hour, "/a /b //p" ),
+                             2 : Task( 2, begin + 3 * hour, None, "/open" ),
+                             3 : Task( 3, begin + 3 * hour, begin + 4 * hour, "untagged" ) } )
+
+    def test_splitsTimeBetweenTags( self ):
+        report = wtfdmdg_report.makeReport( 1, "month", directory=self.directory )
+        self.assertEqual( report.periods, [ MakeReportTest.FIRST ] )
+        self.assertEqual( report.getTotals(), { "a" : 20 * 7200.0, "b" : 20 * 3600.0, None : 20 * 3600.0 } )
+
+    def test_workersMatchSerial( self ):
+        serial = wtfdmdg_report.makeReport( 1, "week", directory=self.directory )
+        with mock.patch.object( wtfdmdg_report, "PARALLEL_DAYS", 0 ):
+            parallel = wtfdmdg_report.makeReport( 1, "week", directory=self.directory, workers=3 )
+        self.assertEqual( parallel.periods, serial.periods )
+        self.assertEqual( parallel.tags, serial.tags )
+        self.assertTrue( np.array_equal( parallel.seconds, serial.seconds ) )
+
+    def test_workersImportNoQt( self ):
+        worker = subprocess.run( [ sys.executable, "-X", "importtime", wtfdmdg_report.__file__ ],
+                                 input=pickle.dumps( [] ), capture_output=True, check=True )
+        self.assertEqual( pickle.loads( worker.stdout ), [] )
+        self.assertNotIn( b"PyQt5", worker.stderr )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,77 +6,39 @@
 # A tool to help answer that question.
 #
 
-from PyQt5 import Qt, QtGui, QtWidgets, QtCore
-import pyqtgraph as pg
-
-pg.setConfigOption('background', 'w')
-pg.setConfigOption('foreground', 'k')
-
-import sys
-import re
-import collections
-import datetime
 import time
-import pickle
-import os
-import itertools
-import pylab
-from pathlib import Path
-
-Task = collections.namedtuple( "Task", ( "ref", "begin", "end", "body" ) )
-
-APPDATA_DIR = os.path.join( str( Path.home() ), ".local", "share", "wtfdmdg" )
-
-CMAP = 'gist_rainbow'
-
-def FILE_PATH( dt ):
-    return os.path.join( APPDATA_DIR, datetime.datetime.strftime( dt, "%y-%m-%d.pickle" ) )
+_startTime = time.perf_counter()
 
-class WtfdmdgCommandParserInterface( object ):
+import sys
+import wtfdmdg_core
 
-    def getCommandLineHighlighter( self, document ):
-        """
-        Return a QSyntaxHighlighter
-        """
-        raise NotImplementedError
+if __name__ == "__main__":
+    # Headless modes should neither need nor pay for Qt, so run them first
+    _args, _qtArgs = wtfdmdg_core.parseArgs( sys.argv )
+    _exitCode = wtfdmdg_core.runHeadless( _args )
+    if _exitCode is not None:
+        sys.exit( _exitCode )
 
-    def getTagBankHighlighter( self, document ):
-        """
-        Return a QSyntaxHighlighter
-        """
-        raise NotImplementedError
+from PyQt5 import Qt, QtGui, QtWidgets, QtCore
 
-    def execute( self, session, line ):
-        """
-        Evaluate line and execute against session
-        """
-        raise NotImplementedError
+import datetime
+import os
 
-    def getTaskTags( self, body ):
-        """
-        Return a dict mapping tag class to a list of tags, given
-        the body of a task.
-        """
-        raise NotImplementedError
+from wtfdmdg_core import ( APPDATA_DIR, JOURNAL_PATH, writeSnapshot, readSnapshot, getColorMap,
+                           WtfdmdgTaskIndex, WtfdmdgTagIndex, WtfdmdgJournal, WtfdmdgHistoryStore,
+                           WtfdmdgBackgroundWriter, WtfdmdgDeferredIndex, WtfdmdgChangeSet, WtfdmdgDayCache, DAY_PATH,
+                           profiler, profiled, WtfdmdgBaseCommandParser, WtfdmdgUndoLog,
+                           executeTransaction, diffSessions, applyChanges )
 
-    def encodeTask( self, task ):
-        """
-        Return a command string that yields this task exactly
-        """
-        raise NotImplementedError
+CMAP = 'gist_rainbow'
 
-class WtfdmdgDefaultCommandParser( WtfdmdgCommandParserInterface ):
+_importTime = time.perf_counter()
 
-    REF   = r"(?:(?P<ref>(?:\d+)|\*):)?"
-    BODY  = r"(?:(?P<body>.+))?"
-    TIME  = r"(?:\d+)|n"
-    BEGIN = r"(?:(?P<begin>" + TIME + "))?"
-    END   = r"(?:(?P<end>" + TIME + "))?"
-    TAG   = r"(/+)(\S+)"
+class WtfdmdgDefaultCommandParser( WtfdmdgBaseCommandParser ):
 
-    TAG_REGEX     = re.compile( TAG )
-    LINE_REGEX    = re.compile( REF + BEGIN + "-?" + END + "\.?" + BODY )
-    TAGBANK_REGEX = re.compile( r"\S+" )
+    def __init__( self ):
+        super( WtfdmdgDefaultCommandParser, self ).__init__()
+        self._formats = self._makeFormats()
 
     class CommandLineSyntaxHighlighter( QtGui.QSyntaxHighlighter ):
         def __init__( self, parser, document ):
@@ -93,18 +55,8 @@ class WtfdmdgDefaultCommandParser( WtfdmdgCommandParserInterface ):
             self.parser = parser
             self.tagclass = tagclass
         def highlightBlock( self, block ):
-            app = WtfdmdgApplication.instance()
-            if self.tagclass is not app.getSelectedTagClass():
-                # Nothing to do
-                return
-            tagRanges = self.parser._getTagBankRanges( block )
-            tagColors = [ app.getTagColor( self.tagclass, block[ x[0]:x[1] ] ) for x in tagRanges ]
-            for rng, clr in zip( tagRanges, tagColors ):
-                if rng[0] >= 0 and rng[1] >= 0:
-                    fmt = QtGui.QTextCharFormat()
-                    fmt.setFontWeight( QtGui.QFont.Bold )
-                    fmt.setForeground( QtGui.QColor( *clr ) )
-                    self.setFormat( rng[0], rng[1], fmt )
+            for rng in self.parser.getTagBankFormats( self.tagclass, block ):
+                self.setFormat( rng.start, rng.length, rng.format )
 
     def getCommandLineHighlighter( self, document ):
         return WtfdmdgDefaultCommandParser.CommandLineSyntaxHighlighter( self, document )
@@ -112,60 +64,29 @@ class WtfdmdgDefaultCommandParser( WtfdmdgCommandParserInterface ):
     def getTagBankHighlighter( self, tagclass, document ):
         return WtfdmdgDefaultCommandParser.TagBankSyntaxHighlighter( self, tagclass, document )
 
-    def execute( self, tasks, line ):
+    def getTagBankFormats( self, tagclass, text ):
+        """
+        Color each tag in text, but only for the selected tag class
+        """
         app = WtfdmdgApplication.instance()
-        ref, begin, end, body = self._getParts( line )
-        begin = self._getDatetime( begin )
-        end = self._getDatetime( end )
-        if all( x is None for x in [ ref, begin, end, body ] ):
-            print( "NOP" )
-        elif ref is not None and all( x is None for x in ( begin, end, body ) ):
-            if ref != "*":
-                del tasks[ int( ref ) ]
-        elif ( ref is None or int( ref ) not in app.session ) and any( x is not None for x in [ begin, end, body ] ):
-            if body is None:
-                # New tasks must always have body
-                print( "NOP" )
-            else:
-                ref = int( ref or app.generateTaskId() )
-                tasks[ int( ref ) ] = Task( ref, begin, end, body )
-        elif ref != "*":
-            a, b, c, d = tasks[ int( ref ) ]
-            if begin is not None:
-                b = begin
-            if end is not None:
-                c = end
-            if body is not None:
-                d = body
-            tasks[ int( ref ) ] = Task( a, b, c, d )
-
-    def getTaskTags( self, body ):
-        tagtable = {}
-        for tagmatch in WtfdmdgDefaultCommandParser.TAG_REGEX.findall( body ):
-            tagclass = len( tagmatch[0] )
-            tagtext = tagmatch[1].lower()
-            if tagclass not in tagtable:
-                tagtable[ tagclass ] = []
-            if tagtext not in tagtable[ tagclass ]:
-                tagtable[ tagclass ].append( tagtext )
-        return tagtable
-
-    def _getParts( self, line ):
-        m = WtfdmdgDefaultCommandParser.LINE_REGEX.match( line )
-        if m is None:
-            return None
-        return [ m.group( x ) for x in [ "ref", "begin", "end", "body" ] ]
-
-    def _getRanges( self, line ):
-        m = WtfdmdgDefaultCommandParser.LINE_REGEX.match( line )
-        if m is None:
-            return None
-        return [ m.span( x ) for x in [ "ref", "begin", "end", "body" ] ]
-
-    def _getTagBankRanges( self, line ):
-        return [ m.span() for m in WtfdmdgDefaultCommandParser.TAGBANK_REGEX.finditer( line ) ]
+        if tagclass != app.getSelectedTagClass():
+            return []
+        ranges = []
+        for start, end in self._getTagBankRanges( text ):
+            fmt = QtGui.QTextCharFormat()
+            fmt.setFontWeight( QtGui.QFont.Bold )
+            fmt.setForeground( app.tagColors.getQColor( tagclass, text[ start:end ] ) )
+            rng = QtGui.QTextLayout.FormatRange()
+            rng.start = start
+            rng.length = end - start
+            rng.format = fmt
+            ranges.append( rng )
+        return ranges
 
     def _getFormats( self ):
+        return self._formats
+
+    def _makeFormats( self ):
         reff   = QtGui.QTextCharFormat()
         beginf = QtGui.QTextCharFormat()
         endf   = QtGui.QTextCharFormat()
@@ -184,92 +105,675 @@ class WtfdmdgDefaultCommandParser( WtfdmdgCommandParserInterface ):
 
         return [ reff, beginf, endf, bodyf ]
 
-    def _getDatetime( self, string ):
-        if string is None:
-            return None
-        if string == "n":
-            dt = datetime.datetime.now()
-            dt.replace( second=0 )
-            return dt
-        if string.isdigit():
-            if len( string ) <= 2:
-                hr = int( string )
-                mn = 0
-            else:
-                mn = int( string[-2:] )
-                hr = int( string[ :-2 ] )
-            dt = datetime.datetime.now()
-            dt = dt.replace( hour=hr, minute=mn, second=0 )
-            return dt
-        assert( False )
-        return None
+class WtfdmdgTagColorCache( object ):
+    """
+    Colors and brushes for tags, computed once per tag class and reused
+    until that class's tag list changes.
+    """
+
+    UNTAGGED_BRUSH = QtGui.QBrush( QtGui.QColor( 200, 200, 200 ) )
+
+    def __init__( self, tagIndex, colorMap ):
+        """
+        Initialize cache over tagIndex, coloring with colorMap
+        """
+        self._tagIndex = tagIndex
+        self._colorMap = colorMap
+        self._classes = {}
+
+    def getColor( self, tagclass, tag ):
+        """
+        Get (r,g,b) color for tag in tagclass
+        """
+        return self._getClass( tagclass )[ "colors" ][ tag.lower() ]
+
+    def getQColor( self, tagclass, tag ):
+        """
+        Get QColor for tag in tagclass
+        """
+        return self._getClass( tagclass )[ "qcolors" ][ tag.lower() ]
 
-    def encodeTask( self, task ):
-        text = ""
-        if task.ref is not None:
-            text += str( task.ref ) + ":"
-        if task.begin is not None:
-            text += datetime.datetime.strftime( task.begin, "%H%M" )
-        if task.end is not None:
-            text += "-" + datetime.datetime.strftime( task.end, "%H%M" )
-        if task.body is not None:
-            text += "." + task.body
-        return text
+    def getBrush( self, tagclass, tags ):
+        """
+        Get brush for a task carrying tags (a sequence of tags in tagclass).
+        A single tag is a solid color, several are a gradient.
+        """
+        if len( tags ) <= 0:
+            return WtfdmdgTagColorCache.UNTAGGED_BRUSH
+        entry = self._getClass( tagclass )
+        key = tuple( tags )
+        if key not in entry[ "brushes" ]:
+            if len( tags ) == 1:
+                brush = QtGui.QBrush( entry[ "qcolors" ][ tags[0] ] )
+            else:
+                nc = len( tags )
+                gradient = QtGui.QLinearGradient( QtCore.QPointF( 0, 0 ), QtCore.QPointF( 1, 0 ) )
+                gradient.setSpread( QtGui.QGradient.RepeatSpread )
+                gradient.setCoordinateMode( QtGui.QGradient.ObjectMode );
+                for i, t in enumerate( tags ):
+                    gradient.setColorAt( float( i ) / ( nc - 1 ), entry[ "qcolors" ][ t ] )
+                brush = QtGui.QBrush( gradient )
+            entry[ "brushes" ][ key ] = brush
+            profiler.count( "brushes created" )
+        return entry[ "brushes" ][ key ]
+
+    def _getClass( self, tagclass ):
+        revision = self._tagIndex.getClassRevision( tagclass )
+        entry = self._classes.get( tagclass )
+        if entry is None or entry[ "revision" ] != revision:
+            tags = self._tagIndex.getTagTable().get( tagclass, [] )
+            nc = len( tags )
+            entry = { "revision" : revision, "colors" : {}, "qcolors" : {}, "brushes" : {} }
+            for i, tag in enumerate( tags ):
+                rgb = self._colorMap( float( i ) / nc )[:-1]
+                entry[ "colors" ][ tag ] = [ 255 * x for x in rgb ]
+                entry[ "qcolors" ][ tag ] = QtGui.QColor.fromRgbF( *rgb )
+            self._classes[ tagclass ] = entry
+        return entry
 
 class WtfdmdgApplication( QtWidgets.QApplication ):
 
-    def __init__( self, argv, parser=None ):
+    # Views which can be invalidated independently
+    VIEW_TASKS     = "tasks"
+    VIEW_TAGS      = "tags"
+    VIEW_TIMELINE  = "timeline"
+    VIEW_SELECTION = "selection"
+    ALL_VIEWS      = ( VIEW_TASKS, VIEW_TAGS, VIEW_TIMELINE, VIEW_SELECTION )
+
+    # Quiet time after a change on disk before reloading, so that a burst of
+    # writes costs a single reload
+    RELOAD_DELAY_MS = 250
+
+    # Days kept read, enough for the timeline's widest view of history
+    DAY_CACHE_DAYS = 400
+
+    # Emitted from the writer thread, delivered on the GUI thread
+    writeFailed = QtCore.pyqtSignal( str )
+
+    # Emitted from the session client's thread when another client changes a
+    # day, with the day, the tasks put and the refs removed
+    remoteChanged = QtCore.pyqtSignal( object, object, object )
+
+    # Emitted from the session client's thread if the server goes away
+    serverLost = QtCore.pyqtSignal()
+
+    # Emitted from the day cache's thread once a day asked for by
+    # getDayEntry is read, with the day
+    dayLoaded = QtCore.pyqtSignal( object )
+
+    def __init__( self, argv, parser=None, journal=True, reportStartup=False, client=None ):
         """
-        Initialize application
+        Initialize application. With journal, each command appends to a
+        journal rather than rewriting the whole day file. With reportStartup,
+        print how long each phase of startup took. With client, a
+        wtfdmdg_daemon.WtfdmdgSessionClient, sessions are kept by the
+        session server rather than read and written here.
         """
         super( WtfdmdgApplication, self ).__init__( argv )
+        self._reportStartup = reportStartup
+        self._startupPhases = [ ( "imports", _importTime ) ]
+        self._useJournal = journal
+        self._journal = None
         self.session = {}
-        self.tagtable = {}
         self.selectedTask = None
         self.selectedTagClass = None
+        self._dirtyViews = set()
+        self._redrawPending = False
+        self._reportDialog = None
         if parser is None:
             parser = WtfdmdgDefaultCommandParser()
-        self._tagColorMap = pylab.get_cmap( CMAP )
+        self._tagColorMap = getColorMap( CMAP )
         self._commandParser = parser
-        self.loadFile()
+        self._historyStore = None
+        self._historyChanges = {}       # Date to WtfdmdgChangeSet not yet in the history store
+        self._writer = WtfdmdgBackgroundWriter( self._onWriteError )
+        self._writerClosed = False
+        self._dayCache = WtfdmdgDayCache( parser, WtfdmdgApplication.DAY_CACHE_DAYS )
+        self._day = None
+        self.day = self._today = datetime.date.today()
+        self._client = client
+        self._watcher = None
+        self._diskSignature = None      # Of the current day's files, as last read or written here
+        self._diskUnchanged = False     # Whether they were so before the last command's writes
+        self._setSession( {} )
+        if client is None:
+            self.loadFile()
+        else:
+            self.remoteChanged.connect( self._applyChanges )
+            self.serverLost.connect( self._onServerLost )
+            client.onChange = self.remoteChanged.emit
+            client.onClose = self.serverLost.emit
+            self._setSession( client.getSession( self.day ) )
+        if client is None:
+            self._watchFiles()
+        self.aboutToQuit.connect( self.closeFile )
         self._mainWindow = WtfdmdgMainWindow()
+        self.writeFailed.connect( self.showError )
+        self.dayLoaded.connect( lambda day: self.invalidate( WtfdmdgApplication.VIEW_TIMELINE ) )
         self._mainWindow._commandTextEdit.setFocus()
         self.redraw()
+        self.markStartup( "window shown" )
+
+        # The timeline is the slowest widget to build, so wait until the
+        # window is up and accepting keys
+        QtCore.QTimer.singleShot( 0, self._createTimeline )
 
+    def _createTimeline( self ):
+        self._mainWindow.createTimeline()
+        self.invalidate( WtfdmdgApplication.VIEW_TIMELINE )
+        self.markStartup( "timeline ready" )
+        # Startup is done, so read yesterday ahead of stepping back to it
+        if self._client is None:
+            self._dayCache.prefetch( ( self.day - datetime.timedelta( days=1 ), ) )
+        if self._reportStartup:
+            self.reportStartup()
+
+    def markStartup( self, phase ):
+        """
+        Note that a phase of startup has completed
+        """
+        self._startupPhases.append( ( phase, time.perf_counter() ) )
+
+    def reportStartup( self ):
+        """
+        Print time taken by each startup phase, and in total
+        """
+        t0 = _startTime
+        for phase, t in self._startupPhases:
+            sys.stderr.write( "{:>16}: {:7.1f} ms (+{:.1f} ms)\n".format( phase, 1000 * ( t - _startTime ), 1000 * ( t - t0 ) ) )
+            t0 = t
+
+    @profiled( "WtfdmdgApplication.loadFile" )
     def loadFile( self, path=None ):
         """
-        Load state from file.
+        Load state from file, by default the current day's, which is then
+        cached for switching back to.
+        """
+        cache = path is None
+        path = path or DAY_PATH( self.day )
+        # Let pending writes land first, and keep the writer off the journal
+        self._writer.flush()
+        if self._useJournal:
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = WtfdmdgJournal( path )
+            self._setSession( self._journal.load() )
+            if cache:
+                self._diskSignature = self._journal.getSignature()
+        elif os.path.exists( path ):
+            with open( path, 'rb' ) as f:
+                self._setSession( readSnapshot( f ) )
+        if cache:
+            self._dayCache.put( self.day, self._day )
+
+    def _setSession( self, session ):
+        """
+        Replace the session, rebuilding everything derived from it
+        """
+        self._setDay( WtfdmdgDayCache.Entry( session, WtfdmdgTaskIndex( session ),
+                                             WtfdmdgTagIndex( self._commandParser, session ) ) )
+
+    def _setDay( self, entry ):
+        """
+        Make the session and indexes of a WtfdmdgDayCache.Entry current. The
+        current entry is held in the cache, as it is edited in place.
+        """
+        if self._day is not None:
+            self._releaseDay()
+        self._dayCache.hold( entry )
+        self._day = entry
+        self.session = entry.session
+        self.taskIndex = entry.taskIndex
+        self.tagIndex = entry.tagIndex
+        self.tagtable = self.tagIndex.getTagTable()
+        self.tagColors = WtfdmdgTagColorCache( self.tagIndex, self._tagColorMap )
+        self._undoLog = WtfdmdgUndoLog( self.session )
+
+    def _releaseDay( self ):
+        """
+        Release the current entry once everything queued for it is written
+        """
+        self._writer.submit( None, self._dayCache.release, self.day, self._day )
+
+    @profiled( "WtfdmdgApplication.showDay" )
+    def showDay( self, day ):
+        """
+        Switch to day (a datetime.date), which commands then edit. Days are
+        cached, and the days either side are read ahead in the background,
+        so stepping from day to day rarely waits on the disk.
         """
-        path = path or FILE_PATH( datetime.datetime.now() )
-        if os.path.exists( path ):
-            self.session = pickle.load( open( path, 'rb' ) )
-            self.__refreshTags()
+        if day == self.day:
+            return
+        try:
+            if self._client is None:
+                entry = self._dayCache.get( day )
+            else:
+                session = self._client.getSession( day )
+                entry = WtfdmdgDayCache.Entry( session, WtfdmdgTaskIndex( session ),
+                                               WtfdmdgTagIndex( self._commandParser, session ) )
+        except Exception as e:
+            self.showError( "Could not load {}: {}".format( day, e ) )
+            return
+        if self._journal is not None:
+            self._writer.submit( None, self._journal.close )
+        self._setDay( entry )
+        self.day = day
+        self._diskSignature = None
+        if self._watcher is not None:
+            self._watchFiles()
+        if self._journal is not None:
+            # Repair the day's journal for appending, behind any writes to it
+            self._journal = WtfdmdgJournal( DAY_PATH( day ) )
+            self._writer.submit( None, self._journal.load )
+        if self._client is None:
+            oneDay = datetime.timedelta( days=1 )
+            self._dayCache.prefetch( ( day - oneDay, day + oneDay ) )
+        self.selectedTask = None
+        self._mainWindow.setDay( day )
+        self.invalidate( *WtfdmdgApplication.ALL_VIEWS )
 
+    def stepDay( self, offset ):
+        """
+        Switch to the day offset days from the current one
+        """
+        self.showDay( self.day + datetime.timedelta( days=offset ) )
+
+    def showToday( self ):
+        self.showDay( datetime.date.today() )
+
+    def getDay( self ):
+        """
+        Get the date of the current session
+        """
+        return self.day
+
+    @profiled( "WtfdmdgApplication.dumpFile" )
     def dumpFile( self ):
         """
-        Export state to file
+        Export state to file, in the background
+        """
+        if self._client is not None:
+            return
+        path = DAY_PATH( self.day )
+        self._writer.submit( ( "snapshot", path ), writeSnapshot, path, dict( self.session ) )
+
+    def _watchFiles( self ):
+        """
+        Watch the data directory, and the current day's files, for changes
+        made by other processes
+        """
+        if self._watcher is None:
+            if not os.path.exists( APPDATA_DIR ):
+                os.makedirs( APPDATA_DIR )
+            self._reloadTimer = QtCore.QTimer( self )
+            self._reloadTimer.setSingleShot( True )
+            self._reloadTimer.setInterval( WtfdmdgApplication.RELOAD_DELAY_MS )
+            self._reloadTimer.timeout.connect( self.reloadChanges )
+            self._watcher = QtCore.QFileSystemWatcher( self )
+            # Every change restarts the timer, so bursts are debounced
+            self._watcher.directoryChanged.connect( self._reloadTimer.start )
+            self._watcher.fileChanged.connect( self._reloadTimer.start )
+            self._watcher.addPath( APPDATA_DIR )
+        # Files replaced since the last call are no longer watched
+        if len( self._watcher.files() ) > 0:
+            self._watcher.removePaths( self._watcher.files() )
+        path = DAY_PATH( self.day )
+        paths = [ p for p in ( path, JOURNAL_PATH( path ) ) if os.path.exists( p ) ]
+        if len( paths ) > 0:
+            self._watcher.addPaths( paths )
+
+    @profiled( "WtfdmdgApplication.reloadChanges" )
+    def reloadChanges( self ):
+        """
+        Pick up changes another process made to the current day's files.
+        Only tasks which differ between disk and session are applied, to
+        the session, its indexes and the views.
+        """
+        self._watchFiles()
+        if not self._writer.isIdle():
+            # Our own writes are still landing, so disk is behind the session
+            self._reloadTimer.start()
+            return
+        journal = WtfdmdgJournal( DAY_PATH( self.day ) )
+        signature = journal.getSignature()
+        if signature != self._diskSignature:
+            session = journal.read()
+            if journal.getSignature() != signature:
+                # Written to while being read, so the read may be torn
+                self._reloadTimer.start()
+                return
+            self._diskSignature = signature
+            tasks, refs = diffSessions( self.session, session )
+            if len( tasks ) + len( refs ) > 0:
+                profiler.count( "tasks reloaded", len( tasks ) + len( refs ) )
+                if self._journal is not None:
+                    self._writer.submit( None, self._journal.reopen )
+                self._applyChanges( self.day, tasks, refs )
+                changes = self._getHistoryChanges( self.day )
+                for task in tasks:
+                    changes.put( task )
+                for ref in refs:
+                    changes.remove( ref )
+                self._writer.submit( ( "history", self.day ), self._putHistory, self.day )
+        # Other days may have changed too
+        timeline = self._mainWindow._timelineWidget
+        if timeline is not None and timeline.getSpan() != 1:
+            self.invalidate( WtfdmdgApplication.VIEW_TIMELINE )
+
+    def getJournal( self ):
+        """
+        Get the journal for the current day's file, or None when not
+        journaling. Only the writer thread may touch it once loaded, so it
+        is returned wrapped to queue its records there.
+        """
+        self._checkRollover()
+        if self._journal is None:
+            return None
+        return WtfdmdgDeferredIndex( self._writer, self._journal )
+
+    def _checkDisk( self ):
+        """
+        Before a command, pick up any change another process made to the
+        current day which the file watcher has not reported yet, so that the
+        command neither overwrites it nor reuses its refs. While our own
+        writes are still landing, the writer thread checks instead.
+        """
+        if self._client is not None:
+            return
+        path = DAY_PATH( self.day )
+        if self._writer.isIdle() and WtfdmdgJournal( path ).getSignature() != self._diskSignature:
+            self.reloadChanges()
+        self._writer.submit( None, self._checkUnchanged, path )
+
+    def _checkRollover( self ):
+        """
+        If the day rolled over while today was current, carry the session
+        into the new day
+        """
+        today = datetime.date.today()
+        if today == self._today:
+            return
+        if self.day == self._today and self._client is not None:
+            # The server holds the day, so move to the new one
+            self._today = today
+            self.showDay( today )
+            return
+        if self.day == self._today:
+            changes = self._getHistoryChanges( today )
+            for task in self.session.values():
+                changes.put( task )
+            self._dayCache.discard( self.day )
+            self._dayCache.put( today, self._day )
+            self.day = today
+            if self._journal is not None:
+                self._writer.submit( None, self._journal.close )
+                self._journal = WtfdmdgJournal( DAY_PATH( today ) )
+                self._writer.submit( None, self._journal.compact, dict( self.session ) )
+            self._mainWindow.setDay( today )
+        self._today = today
+
+    @profiled( "WtfdmdgApplication.persist" )
+    def persist( self ):
+        """
+        Save changes made by the last command, in the background. Bursts of
+        commands to a day are coalesced into one write. With a session
+        server, it saves instead.
+        """
+        if self._client is not None:
+            return
+        if self._journal is None:
+            self.dumpFile()
+        else:
+            self._writer.submit( ( "compact", self._journal.path ), self._journal.compactIfNeeded, dict( self.session ) )
+        self._writer.submit( ( "history", self.day ), self._putHistory, self.day )
+        path = DAY_PATH( self.day )
+        self._writer.submit( None, self._stampSignature, path )
+
+    def _checkUnchanged( self, path ):
+        """
+        Note whether the day files at path are as we last read or wrote
+        them, before a command's writes to them. Runs on the writer thread.
+        """
+        self._diskUnchanged = path == DAY_PATH( self.day ) and WtfdmdgJournal( path ).getSignature() == self._diskSignature
+
+    def _stampSignature( self, path ):
+        """
+        Note the signature of the day files at path once a command's writes
+        to them have landed, so that reloadChanges only reads them again for
+        changes made elsewhere. If they had changed before the writes, the
+        change is left for reloadChanges. Runs on the writer thread.
+        """
+        if self._diskUnchanged and path == DAY_PATH( self.day ):
+            self._diskSignature = WtfdmdgJournal( path ).getSignature()
+        self._diskUnchanged = False
+
+    def _getHistoryChanges( self, day ):
+        """
+        Get the WtfdmdgChangeSet of day's tasks which have yet to be put in
+        the history store. Handed to execute along with the indexes.
+        """
+        if day not in self._historyChanges:
+            self._historyChanges[ day ] = WtfdmdgChangeSet()
+        return self._historyChanges[ day ]
+
+    def _putHistory( self, day ):
+        """
+        Put the tasks changed on day since last time in the history store,
+        once they are on disk. Runs on the writer thread, which owns the
+        store's connection.
+        """
+        if day not in self._historyChanges:
+            return
+        if self._historyStore is None:
+            self._historyStore = WtfdmdgHistoryStore( self._commandParser )
+        self._historyStore.putChanges( day, self._historyChanges[ day ] )
+
+    def _closeHistory( self ):
+        if self._historyStore is not None:
+            self._historyStore.close()
+            self._historyStore = None
+
+    def _onWriteError( self, error ):
+        """
+        Called on the writer thread when a write fails
         """
-        if not os.path.exists( APPDATA_DIR ):
-            os.makedirs( APPDATA_DIR )
-        pickle.dump( self.session, open( FILE_PATH( datetime.datetime.now() ), 'wb' ) )
+        self.writeFailed.emit( "Could not save: {}".format( error ) )
 
+    def showError( self, message ):
+        """
+        Report an error, without interrupting typing
+        """
+        sys.stderr.write( message + "\n" )
+        self._mainWindow.statusBar().showMessage( message, 10000 )
+
+    def closeFile( self ):
+        """
+        Flush and close persistent state
+        """
+        if self._writerClosed:
+            return
+        if self._client is not None:
+            self._client.close()
+        if self._journal is not None:
+            self._writer.submit( None, self._journal.close )
+        self._writer.submit( None, self._closeHistory )
+        self._writer.close()
+        self._writerClosed = True
+        self._dayCache.close()
+
+    @profiled( "WtfdmdgApplication.redraw" )
     def redraw( self ):
         """
-        Redraw application
+        Redraw the entire application immediately
         """
-        self._mainWindow._taskTable.redraw( self.session )
-        self._mainWindow._tagTable.redraw( self.tagtable )
-        self._mainWindow._timelineWidget.redraw()
+        self._dirtyViews.update( WtfdmdgApplication.ALL_VIEWS )
+        self.redrawDirtyViews()
 
-    def processLine( self, line ):
+    def invalidate( self, *views ):
         """
-        Parse and process a line of input
+        Mark views as needing a repaint. Repaints are deferred to the event
+        loop, so any number of invalidations in one tick cost a single repaint.
         """
-        self._commandParser.execute( self.session, line )
-        self.__refreshTags()
-        self.dumpFile()
+        self._dirtyViews.update( views )
+        if not self._redrawPending:
+            self._redrawPending = True
+            QtCore.QTimer.singleShot( 0, self.redrawDirtyViews )
+
+    @profiled( "WtfdmdgApplication.redrawDirtyViews" )
+    def redrawDirtyViews( self ):
+        """
+        Repaint only those views which have been invalidated
+        """
+        self._redrawPending = False
+        dirty = self._dirtyViews
+        self._dirtyViews = set()
+        if WtfdmdgApplication.VIEW_TASKS in dirty:
+            self._mainWindow._taskTable.redraw( self.session )
+        elif WtfdmdgApplication.VIEW_SELECTION in dirty:
+            self._mainWindow._taskTable.redrawSelection()
+        if WtfdmdgApplication.VIEW_TAGS in dirty:
+            self._mainWindow._tagTable.redraw( self.tagtable )
+        if WtfdmdgApplication.VIEW_TIMELINE in dirty:
+            if self._mainWindow._timelineWidget is None:
+                # Not built yet; it will be drawn when it is
+                self._dirtyViews.add( WtfdmdgApplication.VIEW_TIMELINE )
+            else:
+                self._mainWindow._timelineWidget.redraw()
+
+    @profiled( "WtfdmdgApplication.processLine" )
+    def processLine( self, line ):
+        """
+        Parse and process a line of input. Return whether it was processed,
+        which it is not if the session server could not take it.
+        """
+        if self._client is not None:
+            return self.processLines( [ line ] )
+        self._checkDisk()
+        tagRevision = self.tagIndex.revision
+        indexes = ( self.taskIndex, self.tagIndex )
+        journal = self.getJournal()
+        if journal is not None:
+            indexes += ( journal, )
+        indexes += ( self._getHistoryChanges( self.day ), )
+        try:
+            self._commandParser.execute( self.session, line, indexes + ( self._undoLog, ), self.day )
+        finally:
+            self._undoLog.commit()
+        self.persist()
         self.deselectTask()
-        self.redraw()
+        self.invalidate( WtfdmdgApplication.VIEW_TASKS, WtfdmdgApplication.VIEW_TIMELINE )
+        if self.tagIndex.revision != tagRevision:
+            self.invalidate( WtfdmdgApplication.VIEW_TAGS )
+        return True
+
+    @profiled( "WtfdmdgApplication.processLines" )
+    def processLines( self, lines ):
+        """
+        Process several lines of input as one transaction, with a single
+        persist and redraw. If any line fails, none are applied. Return
+        whether they were. With a session server, the lines run there.
+        """
+        self._checkDisk()
+        tagRevision = self.tagIndex.revision
+        indexes = ( self.taskIndex, self.tagIndex )
+        journal = self.getJournal()
+        if journal is not None:
+            indexes += ( journal, )
+        indexes += ( self._getHistoryChanges( self.day ), )
+        try:
+            if self._client is None:
+                executeTransaction( self._commandParser, self.session, lines, indexes + ( self._undoLog, ), self.day )
+            else:
+                self._applyLocal( *self._client.execute( self.day, lines ), indexes=( self._undoLog, ) )
+            self._undoLog.commit()
+        except ValueError as e:
+            self.showError( str( e ) )
+            return False
+        self.persist()
+        self.deselectTask()
+        self.invalidate( WtfdmdgApplication.VIEW_TASKS, WtfdmdgApplication.VIEW_TIMELINE )
+        if self.tagIndex.revision != tagRevision:
+            self.invalidate( WtfdmdgApplication.VIEW_TAGS )
+        return True
+
+    def _onServerLost( self ):
+        """
+        Carry on without the session server once it goes away, reading and
+        writing the day files directly, as if started without one
+        """
+        if self._client is None or self._writerClosed:
+            return
+        self._client.close()
+        self._client = None
+        self.loadFile()
+        self._watchFiles()
+        self.selectedTask = None
+        self.invalidate( *WtfdmdgApplication.ALL_VIEWS )
+        self.showError( "Lost the session server, so saving to the day files directly" )
+
+    def _applyChanges( self, day, tasks, refs ):
+        """
+        Apply tasks put and refs removed elsewhere, by the session server or
+        another process, to day if it is the current day. Undo history is
+        forgotten, as it may no longer apply.
+        """
+        if day != self.day:
+            return
+        self._applyLocal( tasks, refs )
+        self._undoLog.reset( self.session )
+
+    def _applyLocal( self, tasks, refs, indexes=() ):
+        """
+        Put tasks and remove refs in the session, its indexes and any other
+        indexes given, and invalidate the views
+        """
+        tagRevision = self.tagIndex.revision
+        if self.selectedTask in refs:
+            self.deselectTask()
+        applyChanges( self.session, tasks, refs, ( self.taskIndex, self.tagIndex ) + tuple( indexes ) )
+        self.invalidate( WtfdmdgApplication.VIEW_TASKS, WtfdmdgApplication.VIEW_TIMELINE )
+        if self.tagIndex.revision != tagRevision:
+            self.invalidate( WtfdmdgApplication.VIEW_TAGS )
+
+    @profiled( "WtfdmdgApplication.undo" )
+    def undo( self ):
+        """
+        Undo the last command which changed the current day
+        """
+        self._checkDisk()
+        if not self._undoLog.canUndo():
+            self._mainWindow.statusBar().showMessage( "Nothing to undo", 3000 )
+            return
+        self._replay( *self._undoLog.undo() )
+
+    @profiled( "WtfdmdgApplication.redo" )
+    def redo( self ):
+        """
+        Redo the last command undone
+        """
+        self._checkDisk()
+        if not self._undoLog.canRedo():
+            self._mainWindow.statusBar().showMessage( "Nothing to redo", 3000 )
+            return
+        self._replay( *self._undoLog.redo() )
+
+    def _replay( self, tasks, refs ):
+        """
+        Apply changes from the undo log, and save them as a command would
+        """
+        if self._client is not None:
+            try:
+                tasks, refs = self._client.apply( self.day, tasks, refs )
+            except ValueError as e:
+                self.showError( str( e ) )
+                self._undoLog.reset( self.session )
+                return
+            self._applyLocal( tasks, refs )
+            return
+        journal = self.getJournal()
+        indexes = ( self._getHistoryChanges( self.day ), )
+        self._applyLocal( tasks, refs, indexes if journal is None else indexes + ( journal, ) )
+        self.persist()
 
     def checkTaskSelect( self, line ):
         """
@@ -300,10 +804,34 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
         """
         Get (r,g,b) color for tag in tagclass
         """
-        assert( tagclass in self.tagtable and tag in self.tagtable[ tagclass ] )
-        i = self.tagtable[ tagclass ].index( tag.lower() )
-        nc = len( self.tagtable[ tagclass ] )
-        return [ 255 * x for x in ( self._tagColorMap( float( i ) / nc )[:-1] ) ]
+        assert( tagclass in self.tagtable )
+        return self.tagColors.getColor( tagclass, tag )
+
+    def getTagBankFormats( self, tagclass, text ):
+        """
+        Get QTextLayout.FormatRanges coloring text, the tags of tagclass
+        """
+        return self._commandParser.getTagBankFormats( tagclass, text )
+
+    def createTagColorCache( self, tagIndex ):
+        """
+        Create a WtfdmdgTagColorCache coloring the tags of tagIndex, which
+        may be anything providing getTagTable and getClassRevision
+        """
+        return WtfdmdgTagColorCache( tagIndex, self._tagColorMap )
+
+    def cycleTimelineSpan( self ):
+        """
+        Switch the timeline between today, the last week and the last month
+        """
+        if self._mainWindow._timelineWidget is not None:
+            self._mainWindow._timelineWidget.cycleSpan()
+
+    def getTagBrush( self, tagclass, tags ):
+        """
+        Get QBrush for a task carrying tags in tagclass
+        """
+        return self.tagColors.getBrush( tagclass, tags )
 
     def getSession( self ):
         """
@@ -311,16 +839,37 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
         """
         return self.session
 
+    def getDayEntry( self, day ):
+        """
+        Get the WtfdmdgDayCache.Entry of day without waiting on the disk, if
+        it is the current day or cached. Otherwise return None, and read it
+        in the background; the timeline is redrawn once it is.
+        """
+        if day == self.day:
+            return self._day
+        entry = self._dayCache.peek( day )
+        if entry is None:
+            self._dayCache.prefetch( ( day, ), self.dayLoaded.emit )
+        return entry
+
     def getTags( self ):
         """
         Get the tags dict
         """
         return self.tagtable
 
+    def getCommandParser( self ):
+        """
+        Get the parser commands and tags are parsed with
+        """
+        return self._commandParser
+
     def getTagsForTask( self, task ):
         """
         Get tags referenced by this task
         """
+        if self.session.get( task.ref ) is task:
+            return self.tagIndex.getTaskTags( task.ref )
         if task.body is None:
             return {}
         return self._commandParser.getTaskTags( task.body )
@@ -341,15 +890,19 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
         """
         Create a unique task id
         """
-        if len( self.session ) == 0:
-            return 0
-        return max( self.session.keys() ) + 1
+        return self.taskIndex.nextRef()
 
     def getTaskByIndex( self, index ):
         """
         Get a task by its order in the session.
         """
-        return self.__getSortedTaskList()[ index ]
+        return self.taskIndex.getTask( index )
+
+    def getSortedTasks( self ):
+        """
+        Get all tasks, in the order they are displayed.
+        """
+        return self.taskIndex.getTasks()
 
     def getSelectedTask( self ):
         """
@@ -365,16 +918,16 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
         """
         if self.selectedTask is None:
             return None
-        refs = [ x.ref for x in self.__getSortedTaskList() ]
-        assert( self.selectedTask in refs )
-        return refs.index( self.selectedTask )
+        assert( self.selectedTask in self.taskIndex )
+        return self.taskIndex.indexOf( self.selectedTask )
 
     def selectTaskByRef( self, ref ):
         """
         Set selected task by ref ID
         """
-        if ref in self.session:
+        if ref in self.session and ref != self.selectedTask:
             self.selectedTask = ref
+            self.invalidate( WtfdmdgApplication.VIEW_SELECTION )
 
     def reverseTask( self, task ):
         """
@@ -390,10 +943,15 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
 
         No selection can be thought of as a final "invisible" item.
         """
-        refs = [ x.ref for x in self.__getSortedTaskList() ] + [ None ]
-        assert( self.selectedTask in refs )
-        curi = refs.index( self.selectedTask )
-        self.selectedTask = refs[ ( curi + offset ) % len( refs ) ]
+        n = len( self.taskIndex )
+        if self.selectedTask is None:
+            curi = n
+        else:
+            curi = self.taskIndex.indexOf( self.selectedTask )
+        newi = ( curi + offset ) % ( n + 1 )
+        if newi != curi:
+            self.selectedTask = None if newi == n else self.taskIndex.getTask( newi ).ref
+            self.invalidate( WtfdmdgApplication.VIEW_SELECTION )
 
     def selectNextTask( self ):
         """
@@ -414,6 +972,8 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
         clss = sorted( list( self.tagtable.keys() ) ) + [ None ]
         curi = clss.index( self.selectedTagClass )
         self.selectedTagClass = clss[ ( curi + offset ) % len( clss ) ]
+        if self.selectedTagClass != clss[ curi ]:
+            self.invalidate( WtfdmdgApplication.VIEW_TAGS, WtfdmdgApplication.VIEW_TIMELINE )
 
     def selectNextTagClass( self ):
         """
@@ -427,40 +987,25 @@ class WtfdmdgApplication( QtWidgets.QApplication ):
         """
         self.stepTagClass( -1 )
 
-    def deselectTask( self ):
-        """
-        Don't select any tasks
-        """
-        self.selectedTask = None
-
-    def __getSortedTaskList( self ):
-        """
-        Return list of tasks, sorted by start time.
-        """
-        tasks = self.session.values()
-        startedTasks =   [ t for t in tasks if t.begin is not None ]
-        unstartedTasks = [ t for t in tasks if t.begin is None ]
-        return ( unstartedTasks + sorted( startedTasks, key=lambda r: r.begin ) )
-
-    def __mergeTags( self, tags ):
+    def showReport( self ):
         """
-        Given a dict mapping tag class to tag list, merge it
-        into self.tagtable.
+        Open a report of time spent per tag of the selected tag class (or
+        of single slash tags, if none is selected) over all history
         """
-        for cls in tags:
-            if cls not in self.tagtable:
-                self.tagtable[ cls ] = []
-            for tag in tags[ cls ]:
-                if tag not in self.tagtable[ cls ]:
-                    self.tagtable[ cls ].append( tag )
+        if self._reportDialog is None:
+            self._reportDialog = WtfdmdgReportDialog( self._mainWindow )
+        self._writer.flush()
+        self._reportDialog.setTagClass( self.selectedTagClass or 1 )
+        self._reportDialog.show()
+        self._reportDialog.raise_()
 
-    def __refreshTags( self ):
+    def deselectTask( self ):
         """
-        Search current session for any tags.
+        Don't select any tasks
         """
-        self.tagtable = {}
-        for task in self.session.values():
-            self.__mergeTags( self._commandParser.getTaskTags( task.body ) )
+        if self.selectedTask is not None:
+            self.selectedTask = None
+            self.invalidate( WtfdmdgApplication.VIEW_SELECTION )
 
 class WtfdmdgMainWindow( QtWidgets.QMainWindow ):
 
@@ -490,7 +1035,8 @@ class WtfdmdgMainWindow( QtWidgets.QMainWindow ):
         self._commandTextEdit = WtfdmdgCommandTextEdit()
         self._taskTable = WtfdmdgTaskTable()
         self._tagTable = WtfdmdgTagTable()
-        self._timelineWidget = WtfdmdgTimelineWidget()
+        self._timelineWidget = None
+        self._timelinePlaceholder = QtWidgets.QWidget()
 
         anotherAnotherLayout.addWidget( self._tagTable )
         anotherAnotherLayout.addWidget( self._taskTable )
@@ -498,7 +1044,8 @@ class WtfdmdgMainWindow( QtWidgets.QMainWindow ):
         anotherAnotherLayout.setStretch( 1, 5 )
 
         anotherlayout.addLayout( anotherAnotherLayout )
-        anotherlayout.addWidget( self._timelineWidget )
+        anotherlayout.addWidget( self._timelinePlaceholder )
+        self._timelineLayout = anotherlayout
         anotherlayout.setStretch( 0, 2 )
         anotherlayout.setStretch( 1, 1 )
 
@@ -509,10 +1056,31 @@ class WtfdmdgMainWindow( QtWidgets.QMainWindow ):
         topLevelLayout.setStretch( 1, 1 )
 
         # Set title
-        self.setWindowTitle( "Where The Fuck Did My Day Go?" )
+        self.setDay( datetime.date.today() )
 
         self.show()
 
+    def setDay( self, day ):
+        """
+        Title the window with day, unless it is today
+        """
+        title = "Where The Fuck Did My Day Go?"
+        if day != datetime.date.today():
+            title = "{} - {}".format( title, day.strftime( "%a %d %b %Y" ) )
+        self.setWindowTitle( title )
+
+    def createTimeline( self ):
+        """
+        Build the timeline widget in place of its placeholder
+        """
+        if self._timelineWidget is not None:
+            return
+        from wtfdmdg_timeline import WtfdmdgTimelineWidget
+        self._timelineWidget = WtfdmdgTimelineWidget()
+        self._timelineLayout.replaceWidget( self._timelinePlaceholder, self._timelineWidget )
+        self._timelinePlaceholder.deleteLater()
+        self._timelinePlaceholder = None
+
 class WtfdmdgCommandTextEdit( QtWidgets.QTextEdit ):
 
     def __init__( self ):
@@ -523,15 +1091,23 @@ class WtfdmdgCommandTextEdit( QtWidgets.QTextEdit ):
         self.setVerticalScrollBarPolicy( QtCore.Qt.ScrollBarAlwaysOff )
         self._hilighter = WtfdmdgApplication.instance().getCommandLineHighlighter( self.document() )
         self.setFont( QtGui.QFontDatabase.systemFont( QtGui.QFontDatabase.FixedFont ) )
-        self.setMinimumHeight( self.document().size().height() )
+        self.setMinimumHeight( int( self.document().size().height() ) )
 
     def keyPressEvent( self, event ):
         """
         Capture some keys
         """
-        if( event.key() == QtCore.Qt.Key_Return ):
-            WtfdmdgApplication.instance().processLine( self.toPlainText() )
-            self.clear()
+        if( event.key() == QtCore.Qt.Key_Return and event.modifiers() == QtCore.Qt.ShiftModifier ):
+            self.insertPlainText( "\n" )
+        elif( event.key() == QtCore.Qt.Key_Return ):
+            lines = self.toPlainText().splitlines()
+            if len( lines ) <= 1:
+                if WtfdmdgApplication.instance().processLine( self.toPlainText() ):
+                    self.clear()
+            elif WtfdmdgApplication.instance().processLines( lines ):
+                # A failed batch, or one the session server never took, is
+                # left in place to be fixed or sent again
+                self.clear()
         elif( event.key() == QtCore.Qt.Key_Down ):
             if event.modifiers() == QtCore.Qt.ShiftModifier:
                 WtfdmdgApplication.instance().selectNextTagClass()
@@ -548,13 +1124,28 @@ class WtfdmdgCommandTextEdit( QtWidgets.QTextEdit ):
                 self.preloadTask( task )
         elif( event.key() == QtCore.Qt.Key_Escape ):
             self.clear()
+        elif( event.key() == QtCore.Qt.Key_Z and event.modifiers() == QtCore.Qt.ControlModifier ):
+            WtfdmdgApplication.instance().undo()
+        elif( ( event.key() == QtCore.Qt.Key_Z and event.modifiers() == QtCore.Qt.ControlModifier | QtCore.Qt.ShiftModifier ) or
+              ( event.key() == QtCore.Qt.Key_Y and event.modifiers() == QtCore.Qt.ControlModifier ) ):
+            WtfdmdgApplication.instance().redo()
+        elif( event.key() == QtCore.Qt.Key_Left and event.modifiers() == QtCore.Qt.AltModifier ):
+            WtfdmdgApplication.instance().stepDay( -1 )
+        elif( event.key() == QtCore.Qt.Key_Right and event.modifiers() == QtCore.Qt.AltModifier ):
+            WtfdmdgApplication.instance().stepDay( 1 )
+        elif( event.key() == QtCore.Qt.Key_Home and event.modifiers() == QtCore.Qt.AltModifier ):
+            WtfdmdgApplication.instance().showToday()
+        elif( event.key() == QtCore.Qt.Key_F6 ):
+            WtfdmdgApplication.instance().cycleTimelineSpan()
+        elif( event.key() == QtCore.Qt.Key_F9 ):
+            WtfdmdgApplication.instance().showReport()
+        elif( event.key() == QtCore.Qt.Key_F12 ):
+            profiler.report()
         else:
             super( WtfdmdgCommandTextEdit, self ).keyPressEvent( event )
 
         WtfdmdgApplication.instance().checkTaskSelect( self.toPlainText() )
 
-        WtfdmdgApplication.instance().redraw()
-
     def preloadTask( self, task ):
         """
         Set contents to this task
@@ -565,14 +1156,137 @@ class WtfdmdgCommandTextEdit( QtWidgets.QTextEdit ):
         text = WtfdmdgApplication.instance().reverseTask( task )
         self.setText( text )
 
-class WtfdmdgTaskTable( QtWidgets.QTableWidget ):
+class WtfdmdgTaskTableModel( QtCore.QAbstractTableModel ):
+
+    HEADERS = ( "Ref", "Begin", "End", "Body" )
+
+    def __init__( self, parent=None ):
+        """
+        Initialize task table model
+        """
+        super( WtfdmdgTaskTableModel, self ).__init__( parent )
+        self._tasks = []
+        self._rows = {}
+        self._selectedRow = None
+
+        # Shared by every cell, rather than allocated per item
+        self._openFont = QtGui.QFont()
+        self._openFont.setWeight( QtGui.QFont.Bold )
+        self._closedForeground = QtGui.QBrush( QtGui.QColor( 150, 150, 150 ) )
+        self._selectedBackground = QtGui.QBrush( QtGui.QColor( 230, 230, 230 ) )
+
+    def rowCount( self, parent=QtCore.QModelIndex() ):
+        if parent.isValid():
+            return 0
+        return len( self._tasks )
+
+    def columnCount( self, parent=QtCore.QModelIndex() ):
+        if parent.isValid():
+            return 0
+        return len( WtfdmdgTaskTableModel.HEADERS )
+
+    def headerData( self, section, orientation, role=QtCore.Qt.DisplayRole ):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return WtfdmdgTaskTableModel.HEADERS[ section ]
+        return None
+
+    def data( self, index, role=QtCore.Qt.DisplayRole ):
+        """
+        Serve a single cell. Only called by Qt for rows in view.
+        """
+        if not index.isValid():
+            return None
+        task = self._tasks[ index.row() ]
+        if role == QtCore.Qt.DisplayRole:
+            c = index.column()
+            if c == 0:
+                return str( task.ref )
+            elif c == 1:
+                return "" if task.begin is None else datetime.datetime.strftime( task.begin, "%H:%M" )
+            elif c == 2:
+                return "" if task.end is None else datetime.datetime.strftime( task.end, "%H:%M" )
+            return str( task.body )
+        elif role == QtCore.Qt.FontRole:
+            if task.begin is None or task.end is None:
+                return self._openFont
+        elif role == QtCore.Qt.ForegroundRole:
+            if task.begin is not None and task.end is not None:
+                return self._closedForeground
+        elif role == QtCore.Qt.BackgroundRole:
+            if index.row() == self._selectedRow:
+                return self._selectedBackground
+        return None
+
+    def refresh( self, tasks ):
+        """
+        Replace the list of displayed tasks with tasks, emitting row-level
+        signals for only the rows which actually changed.
+        """
+        old = self._tasks
+        oldRefs = [ t.ref for t in old ]
+        newRefs = [ t.ref for t in tasks ]
+
+        # Rows outside of the common prefix and suffix have moved, appeared
+        # or disappeared
+        head = 0
+        limit = min( len( oldRefs ), len( newRefs ) )
+        while head < limit and oldRefs[ head ] == newRefs[ head ]:
+            head += 1
+        tail = 0
+        limit -= head
+        while tail < limit and oldRefs[ -1 - tail ] == newRefs[ -1 - tail ]:
+            tail += 1
+        oldEnd = len( oldRefs ) - tail
+        newEnd = len( newRefs ) - tail
+
+        if oldEnd - head != newEnd - head and oldEnd > head:
+            self.beginRemoveRows( QtCore.QModelIndex(), head, oldEnd - 1 )
+            self._setTasks( old[ :head ] + old[ oldEnd: ] )
+            self.endRemoveRows()
+        if oldEnd - head != newEnd - head and newEnd > head:
+            self.beginInsertRows( QtCore.QModelIndex(), head, newEnd - 1 )
+            self._setTasks( tasks )
+            self.endInsertRows()
+        else:
+            self._setTasks( tasks )
+
+        # Rows which kept their position, but whose task was modified
+        changed = [ i for i in range( head ) if old[ i ] is not tasks[ i ] ]
+        if oldEnd - head == newEnd - head:
+            changed += range( head, newEnd )
+        changed += [ newEnd + i for i in range( tail ) if old[ oldEnd + i ] is not tasks[ newEnd + i ] ]
+        for rowi in changed:
+            self._emitRowChanged( rowi )
+
+    def setSelectedRef( self, ref ):
+        """
+        Highlight the row holding ref, or nothing if ref is None
+        """
+        selectedRow = self._rows.get( ref )
+        if selectedRow == self._selectedRow:
+            return
+        previousRow = self._selectedRow
+        self._selectedRow = selectedRow
+        for rowi in ( previousRow, selectedRow ):
+            if rowi is not None and rowi < len( self._tasks ):
+                self._emitRowChanged( rowi, [ QtCore.Qt.BackgroundRole ] )
+
+    def _setTasks( self, tasks ):
+        self._tasks = tasks
+        self._rows = { t.ref : i for i, t in enumerate( tasks ) }
+
+    def _emitRowChanged( self, rowi, roles=None ):
+        self.dataChanged.emit( self.index( rowi, 0 ), self.index( rowi, self.columnCount() - 1 ), roles or [] )
+
+class WtfdmdgTaskTable( QtWidgets.QTableView ):
 
     def __init__( self ):
         """
         Initialize task table widget
         """
         super( WtfdmdgTaskTable, self ).__init__()
-        self.setColumnCount( 4 )
+        self._model = WtfdmdgTaskTableModel( self )
+        self.setModel( self._model )
         self.setGridStyle( QtCore.Qt.NoPen )
         self.verticalHeader().setVisible( False )
         self.hv = QtWidgets.QHeaderView( QtCore.Qt.Horizontal, self )
@@ -581,41 +1295,80 @@ class WtfdmdgTaskTable( QtWidgets.QTableWidget ):
         self.hv.setSectionResizeMode( 1, QtWidgets.QHeaderView.ResizeToContents )
         self.hv.setSectionResizeMode( 2, QtWidgets.QHeaderView.ResizeToContents )
         self.hv.setSectionResizeMode( 3, QtWidgets.QHeaderView.Stretch )
-        self.setHorizontalHeaderLabels( ( "Ref", "Begin", "End", "Body" ) )
+        self.hv.setResizeContentsPrecision( 0 ) # Size to visible rows only
+        self.verticalHeader().setSectionResizeMode( QtWidgets.QHeaderView.Fixed )
         self.verticalHeader().setDefaultSectionSize( 15 )
         self.setEditTriggers( QtWidgets.QAbstractItemView.NoEditTriggers )
         self.setSelectionMode( QtWidgets.QAbstractItemView.NoSelection )
-        self.redraw( {} )
 
+    @profiled( "WtfdmdgTaskTable.redraw" )
     def redraw( self, session ):
         """
-        Draw all items in session
+        Synchronize rows with session
         """
         app = WtfdmdgApplication.instance()
+        self._model.refresh( app.getSortedTasks() )
+        self.redrawSelection()
+
+    @profiled( "WtfdmdgTaskTable.redrawSelection" )
+    def redrawSelection( self ):
+        """
+        Move the selection highlight, leaving all other rows untouched
+        """
+        task = WtfdmdgApplication.instance().getSelectedTask()
+        self._model.setSelectedRef( None if task is None else task.ref )
+
+class WtfdmdgTagBankDelegate( QtWidgets.QStyledItemDelegate ):
+    """
+    Paints a tag bank (the tags of a class) from a cached QTextLayout. A
+    layout is rebuilt only when its class's tags, whether it is the
+    selected class, or the font change.
+    """
+
+    def __init__( self, parent=None ):
+        """
+        Initialize delegate
+        """
+        super( WtfdmdgTagBankDelegate, self ).__init__( parent )
+        self._layouts = {}  # Tag class to ( key, QTextLayout )
+
+    def paint( self, painter, option, index ):
+        """
+        Paint the cell background as usual, then the cached tags over it
+        """
+        option = QtWidgets.QStyleOptionViewItem( option )
+        self.initStyleOption( option, index )
+        layout = self._getLayout( index.data( QtCore.Qt.UserRole ), option.text, option.font )
+        option.text = ""
+        widget = option.widget
+        style = widget.style() if widget is not None else QtWidgets.QApplication.style()
+        style.drawControl( QtWidgets.QStyle.CE_ItemViewItem, option, painter, widget )
+        painter.save()
+        painter.setClipRect( option.rect )
+        top = option.rect.top() + ( option.rect.height() - layout.boundingRect().height() ) / 2
+        layout.draw( painter, QtCore.QPointF( option.rect.left() + 2, top ) )
+        painter.restore()
+
+    def sizeHint( self, option, index ):
+        layout = self._getLayout( index.data( QtCore.Qt.UserRole ), index.data(), option.font )
+        rect = layout.boundingRect()
+        return QtCore.QSize( int( rect.width() ) + 4, int( rect.height() ) )
 
-        selectedRow = app.getSelectedTaskIndex()
-
-        self.setRowCount( len( session ) )
-
-        for rowi in range( len( session ) ):
-            task = app.getTaskByIndex( rowi )
-            cols = range( 4 )
-            vals = [
-                str( task.ref ),
-                str( "" if task.begin is None else datetime.datetime.strftime( task.begin, "%H:%M" ) ),
-                str( "" if task.end is None else datetime.datetime.strftime( task.end, "%H:%M" ) ),
-                str( task.body ) ]
-            for c, v in zip( cols, vals ):
-                i = QtWidgets.QTableWidgetItem( v )
-                if rowi == selectedRow:
-                    i.setBackground( QtGui.QBrush( QtGui.QColor( 230, 230, 230 ) ) )
-                if task.begin is None or task.end is None:
-                    fnt = QtGui.QFont()
-                    fnt.setWeight( QtGui.QFont.Bold )
-                    i.setFont( fnt )
-                else:
-                    i.setForeground( QtGui.QColor( 150, 150, 150 ) )
-                self.setItem( rowi, c, i )
+    def _getLayout( self, tagclass, text, font ):
+        app = WtfdmdgApplication.instance()
+        key = ( text, tagclass == app.getSelectedTagClass(), font.key() )
+        entry = self._layouts.get( tagclass )
+        if entry is None or entry[0] != key:
+            layout = QtGui.QTextLayout( text, font )
+            layout.setFormats( app.getTagBankFormats( tagclass, text ) )
+            layout.beginLayout()
+            line = layout.createLine()
+            if line.isValid():
+                line.setPosition( QtCore.QPointF( 0, 0 ) )
+            layout.endLayout()
+            entry = self._layouts[ tagclass ] = ( key, layout )
+            profiler.count( "tag bank layouts built" )
+        return entry[1]
 
 class WtfdmdgTagTable( QtWidgets.QTableWidget ):
 
@@ -635,6 +1388,8 @@ class WtfdmdgTagTable( QtWidgets.QTableWidget ):
         self.verticalHeader().setDefaultSectionSize( 15 )
         self.setEditTriggers( QtWidgets.QAbstractItemView.NoEditTriggers )
         self.setSelectionBehavior( QtWidgets.QAbstractItemView.SelectRows )
+        self._delegate = WtfdmdgTagBankDelegate( self )
+        self.setItemDelegateForColumn( 1, self._delegate )
         self.redraw( {} )
 
     def getSelectedTags( self ):
@@ -647,137 +1402,70 @@ class WtfdmdgTagTable( QtWidgets.QTableWidget ):
             return tags[ cls ]
         return {}
 
+    @profiled( "WtfdmdgTagTable.redraw" )
     def redraw( self, tagtable ):
         """
-        Draw all items in session
+        Draw all items in session. Items are only touched where a class or
+        its tags changed; the delegate paints the tags.
         """
-        app = WtfdmdgApplication.instance()
-
         self.setRowCount( len( tagtable ) )
 
         for rowi, ( cls, tags ) in enumerate( sorted( tagtable.items(), key=lambda x: x[0] ) ):
-            ci = QtWidgets.QTableWidgetItem( str( cls ) )
-            self.setItem( rowi, 0, ci )
-
-            te = QtGui.QTextEdit( " ".join( tags ) )
-            te.setReadOnly( True )
-            te.hl = app.getTagBankHighlighter( cls, te.document() )
-            te.setMinimumHeight( te.document().size().height() )
-            te.setVerticalScrollBarPolicy( QtCore.Qt.ScrollBarAlwaysOff )
-            te.document().setDocumentMargin( 0 )
-            te.setFrameStyle( QtGui.QFrame.NoFrame )
-            self.setCellWidget( rowi, 1, te )
-
-class WtfdmdgTimelineWidget( pg.PlotWidget ):
-
-    class DateAxis( pg.AxisItem ):
-
-        def __init__( self, *args, **kwargs ):
-            super( WtfdmdgTimelineWidget.DateAxis, self ).__init__( *args, **kwargs )
-            fnt = WtfdmdgApplication.instance().font()
-            self.setStyle( tickFont=fnt )
-
-        def tickStrings( self, values, scale, spacing ):
-            strings = []
-            for v in values:
-                # vs is the original tick value
-                vs = v * scale
-                vstr = time.strftime( "%H:%M", time.localtime( vs ) )
-                strings.append( vstr )
-            return strings
-
-    def __init__( self ):
-        """
-        Initialize the timeline widget
-        """
-        ax = WtfdmdgTimelineWidget.DateAxis( orientation='left')
-        super( WtfdmdgTimelineWidget, self ).__init__( axisItems={'left': ax } )
-        self._barGraphItem = pg.BarGraphItem( x0=[], x1=[], y0=[], y1=[] )
-        self.addItem( self._barGraphItem )
-        self.getViewBox().setMouseEnabled( False, False )
-        self.hideAxis( 'bottom' )
-        self.invertY( True )
+            text = " ".join( tags )
+            ci = self.item( rowi, 0 )
+            ti = self.item( rowi, 1 )
+            if ci is None or ci.data( QtCore.Qt.UserRole ) != cls:
+                ci = QtWidgets.QTableWidgetItem( str( cls ) )
+                ci.setData( QtCore.Qt.UserRole, cls )
+                self.setItem( rowi, 0, ci )
+            if ti is None or ti.data( QtCore.Qt.UserRole ) != cls or ti.text() != text:
+                ti = QtWidgets.QTableWidgetItem( text )
+                ti.setData( QtCore.Qt.UserRole, cls )
+                self.setItem( rowi, 1, ti )
+
+        # The selected class may have changed, which only the delegate sees
+        self.viewport().update()
+
+class WtfdmdgReportDialog( QtWidgets.QDialog ):
+
+    def __init__( self, parent=None ):
+        """
+        Initialize report dialog
+        """
+        super( WtfdmdgReportDialog, self ).__init__( parent )
+        self._tagclass = 1
+        self._period = QtWidgets.QComboBox()
+        self._period.addItems( [ "day", "week", "month" ] )
+        self._period.setCurrentText( "week" )
+        self._period.currentTextChanged.connect( self.redraw )
+        self._text = QtWidgets.QPlainTextEdit()
+        self._text.setReadOnly( True )
+        self._text.setFont( QtGui.QFontDatabase.systemFont( QtGui.QFontDatabase.FixedFont ) )
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget( self._period )
+        layout.addWidget( self._text )
+        self.setLayout( layout )
+        self.setWindowTitle( "Where Did My Time Go?" )
+        self.resize( 400, 600 )
+
+    def setTagClass( self, tagclass ):
+        """
+        Report on tagclass
+        """
+        self._tagclass = tagclass
+        self.redraw()
 
     def redraw( self ):
         """
-        Plot everything
-        """
-        self.clear()
-
-        tasks =  [ x for x in WtfdmdgApplication.instance().getSession().values() if x.begin is not None and x.end is not None ]
-        tags = WtfdmdgApplication.instance().getSelectedTags()
-
-        if len( tasks ) <= 0:
-            return
-
-        def activeAt( t0, t1 ):
-            minute = datetime.timedelta( minutes=1 )
-            t0 = t0 + minute # Add a minute to prevent creating columns when one task ends exactly as another starts
-            return [ x for x in tasks if not ( t1 < ( x.begin ) or t0 > ( x.end ) ) ]
-        def numActiveAt( t0, t1 ):
-            return len( activeAt( t0, t1 ) )
-        importantTimes = sorted( set( x.begin for x in tasks ) | set( x.end for x in tasks ) )
-        s = [ numActiveAt( x, x ) for x in importantTimes ]
-        maxConcurrent = max( s )
-        width = 1.0 / maxConcurrent
-
-        columnAssignments = {}
-        for task in tasks:
-            columnAssignments[ task ] = None
-        for task in tasks:
-            conflicts = activeAt( task.begin, task.end )
-            for i in range( maxConcurrent ):
-                if i not in [ columnAssignments[ x ] for x in conflicts ]:
-                    columnAssignments[ task ] = i
-                    break
-
-        x0 = []
-        x1 = []
-        y0 = []
-        y1 = []
-        brushes = []
-        for task in sorted( tasks, key=lambda x: x.begin ):
-            coeff = columnAssignments[ task ]
-            x = coeff * width
-            x0.append( x )
-            x1.append( x + width )
-            y0.append( time.mktime( task.begin.timetuple() ) )
-            y1.append( time.mktime( task.end.timetuple() ) )
-            brushes.append( self._getBrush( task ) )
-
-        self._barGraphItem = pg.BarGraphItem( x0=x0, x1=x1, y0=y0, y1=y1, brushes=brushes )
-        self.addItem( self._barGraphItem )
-
-    def _getBrush( self, task ):
-        """
-        Construct brush for this task
+        Recompute and show the report
         """
-        app = WtfdmdgApplication.instance()
-        selectedTagClass = WtfdmdgApplication.instance().getSelectedTagClass()
-        allTags = WtfdmdgApplication.instance().getTags()
-        theseTags = WtfdmdgApplication.instance().getTagsForTask( task )
-        if selectedTagClass not in theseTags or len( theseTags[ selectedTagClass ] ) <= 0:
-            # This task has no tags in currently selected class, so no color
-            return pg.mkBrush( 200, 200, 200 )
-
-        theseTags = theseTags[ selectedTagClass ]
-        if len( theseTags ) == 1:
-            # This task has a single tag in the current class, solid color
-            return pg.mkBrush( *app.getTagColor( selectedTagClass, theseTags[0] ) )
-        else:
-            # This task has multiple colors in the current class, use a gradient
-            nc = len( theseTags )
-            gradient = QtGui.QLinearGradient( QtCore.QPointF( 0, 0 ), QtCore.QPointF( 1, 0 ) )
-            gradient.setSpread( QtGui.QGradient.RepeatSpread )
-            gradient.setCoordinateMode( QtGui.QGradient.ObjectMode );
-            for i, t in enumerate( theseTags ):
-                offset = float( i ) / ( nc - 1 )
-                color = QtGui.QColor( *app.getTagColor( selectedTagClass, t ) )
-                gradient.setColorAt( offset, color )
-            return pg.mkBrush( QtGui.QBrush( gradient ) )
+        import wtfdmdg_report
+        report = wtfdmdg_report.makeReport( self._tagclass, self._period.currentText() )
+        self._text.setPlainText( report.format() )
 
 #
 # DEBUG DRIVER
 #
 if __name__ == "__main__":
-    sys.exit( WtfdmdgApplication( sys.argv ).exec_() )
+    sys.exit( WtfdmdgApplication( sys.argv[:1] + _qtArgs, reportStartup=_args.startup_time,
+                                  client=wtfdmdg_core.connectServer( _args ) ).exec_() )
@@ -0,0 +1,354 @@
+#
+# wtfdmdg_bench.py
+#
+# Synthetic benchmarks for the paths which scale with the size of a session.
+#
+#   python wtfdmdg_bench.py --sizes 100,10000,1000000 --output new.json
+#   python wtfdmdg_bench.py --output new.json --compare old.json
+#
+
+import sys
+import os
+import json
+import time
+import random
+import datetime
+import platform
+import argparse
+import tempfile
+import subprocess
+import collections
+import tracemalloc
+
+import wtfdmdg_core
+from wtfdmdg_core import ( Task, layoutTimeline, writeSnapshot, readSnapshot,
+                           WtfdmdgTaskIndex, WtfdmdgTagIndex, WtfdmdgJournal, WtfdmdgTaskStore,
+                           WtfdmdgBaseCommandParser )
+
+def makeSession( n, overlap=2.0, tagClasses=3, tagsPerClass=20, tagsPerTask=2, todoFraction=0.05, seed=0 ):
+    """
+    Generate a session of n tasks. Closed tasks average overlap concurrent
+    tasks at any moment. Each body carries tagsPerTask tags, drawn from
+    tagsPerClass tags in each of tagClasses classes.
+    """
+    rng = random.Random( seed )
+    meanMinutes = 30
+    span = max( 1, int( n * meanMinutes / overlap ) )
+    start = datetime.datetime.combine( datetime.date.today(), datetime.time( 0, 0 ) )
+    session = {}
+    for ref in range( n ):
+        tags = []
+        for _ in range( tagsPerTask ):
+            cls = rng.randint( 1, tagClasses )
+            tags.append( "/" * cls + "tag{}x{}".format( cls, rng.randrange( tagsPerClass ) ) )
+        body = "Synthetic task {} {}".format( ref, " ".join( tags ) )
+        if rng.random() < todoFraction:
+            session[ ref ] = Task( ref, None, None, body )
+            continue
+        begin = start + datetime.timedelta( minutes=rng.randrange( span ) )
+        end = begin + datetime.timedelta( minutes=rng.randint( 1, 2 * meanMinutes ) )
+        session[ ref ] = Task( ref, begin, end, body )
+    return session
+
+def makeCommands( session, count, seed=0 ):
+    """
+    Generate count command lines against session: new tasks, retitled
+    tasks and closed tasks in roughly equal measure.
+    """
+    rng = random.Random( seed )
+    refs = list( session.keys() ) or [ 0 ]
+    lines = []
+    for i in range( count ):
+        kind = rng.randrange( 3 )
+        if kind == 0:
+            lines.append( "0900-1000.New task {} /tag1x{} //tag2x{}".format( i, rng.randrange( 20 ), rng.randrange( 20 ) ) )
+        elif kind == 1:
+            lines.append( "{}:.Retitled {} /tag1x{}".format( rng.choice( refs ), i, rng.randrange( 20 ) ) )
+        else:
+            lines.append( "{}:-1730".format( rng.choice( refs ) ) )
+    return lines
+
+def timeBest( run, setup=None, repeat=3 ):
+    """
+    Return the best wall time, in seconds, of repeat calls to run. If given,
+    setup is called before each, untimed, and its result passed to run.
+    """
+    best = None
+    for _ in range( repeat ):
+        state = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        run( state ) if setup is not None else run()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min( best, elapsed )
+    return best
+
+#
+# Benchmarks. Each takes ( session, context ), and returns seconds.
+#
+
+def benchExecute( session, context ):
+    """
+    Per command cost of execute, keeping task and tag indexes up to date
+    """
+    parser = context[ "parser" ]
+    lines = makeCommands( session, context[ "commands" ] )
+    def setup():
+        tasks = dict( session )
+        return tasks, ( WtfdmdgTaskIndex( tasks ), WtfdmdgTagIndex( parser, tasks ) )
+    def run( state ):
+        tasks, indexes = state
+        for line in lines:
+            parser.execute( tasks, line, indexes )
+    return timeBest( run, setup, context[ "repeat" ] ) / len( lines )
+
+def benchTaskTags( session, context ):
+    """
+    Parse tags out of every task body
+    """
+    parser = context[ "parser" ]
+    bodies = [ t.body for t in session.values() ]
+    def run():
+        for body in bodies:
+            parser.getTaskTags( body )
+    return timeBest( run, repeat=context[ "repeat" ] )
+
+def benchTagIndex( session, context ):
+    """
+    Build the tag index for a whole session, as loadFile does
+    """
+    parser = context[ "parser" ]
+    return timeBest( lambda: WtfdmdgTagIndex( parser, session ), repeat=context[ "repeat" ] )
+
+def benchSortedTasks( session, context ):
+    """
+    Build the sorted task index, and list the session in display order
+    """
+    return timeBest( lambda: WtfdmdgTaskIndex( session ).getTasks(), repeat=context[ "repeat" ] )
+
+def benchTimelineLayout( session, context ):
+    """
+    Assign timeline columns to every closed task
+    """
+    tasks = [ t for t in session.values() if t.begin is not None and t.end is not None ]
+    return timeBest( lambda: layoutTimeline( tasks ), repeat=context[ "repeat" ] )
+
+def benchTaskTable( session, context ):
+    """
+    Redraw the task table for a freshly loaded session, offscreen
+    """
+    app = context[ "app" ]()
+    table = app._mainWindow._taskTable
+    def setup():
+        app._setSession( {} )
+        table.redraw( app.session )
+        app._setSession( dict( session ) )
+    def run( state ):
+        table.redraw( app.session )
+        app.processEvents()
+    return timeBest( run, setup, context[ "repeat" ] )
+
+def benchTimelineRedraw( session, context ):
+    """
+    Redraw the whole timeline, offscreen
+    """
+    app = context[ "app" ]()
+    app._setSession( dict( session ) )
+    app._mainWindow.createTimeline()
+    timeline = app._mainWindow._timelineWidget
+    return timeBest( timeline.redraw, repeat=context[ "repeat" ] )
+
+def benchDumpFile( session, context ):
+    """
+    Write a full snapshot of the session
+    """
+    path = os.path.join( context[ "directory" ], "dump.pickle" )
+    return timeBest( lambda: writeSnapshot( path, session ), repeat=context[ "repeat" ] )
+
+def benchLoadFile( session, context ):
+    """
+    Read a full snapshot of the session back
+    """
+    path = os.path.join( context[ "directory" ], "load.pickle" )
+    writeSnapshot( path, session )
+    def run():
+        with open( path, 'rb' ) as f:
+            readSnapshot( f )
+    return timeBest( run, repeat=context[ "repeat" ] )
+
+def benchJournalAppend( session, context ):
+    """
+    Per record cost of appending to the journal
+    """
+    path = os.path.join( context[ "directory" ], "journal.pickle" )
+    tasks = list( session.values() )[ :200 ]
+    def setup():
+        for p in ( path, wtfdmdg_core.JOURNAL_PATH( path ) ):
+            if os.path.exists( p ):
+                os.remove( p )
+        return WtfdmdgJournal( path )
+    def run( journal ):
+        for task in tasks:
+            journal.put( task )
+        journal.close()
+    return timeBest( run, setup, context[ "repeat" ] ) / max( 1, len( tasks ) )
+
+def measureMemory( session, context ):
+    """
+    Bytes per task held by a session loaded from a day file, as a dict of
+    Tasks and as a WtfdmdgTaskStore
+    """
+    path = os.path.join( context[ "directory" ], "memory.pickle" )
+    writeSnapshot( path, session )
+    n = max( 1, len( session ) )
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        with open( path, 'rb' ) as f:
+            loaded = readSnapshot( f )
+        sessionBytes = tracemalloc.get_traced_memory()[0] - base
+        store = WtfdmdgTaskStore( context[ "parser" ], loaded.values(), datetime.date.today() )
+        del loaded
+        storeBytes = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    del store
+    return collections.OrderedDict( [ ( "session", sessionBytes / n ), ( "taskStore", storeBytes / n ) ] )
+
+BENCHMARKS = collections.OrderedDict( [
+    ( "execute",         ( benchExecute,        False ) ),
+    ( "getTaskTags",     ( benchTaskTags,       False ) ),
+    ( "tagIndex",        ( benchTagIndex,       False ) ),
+    ( "sortedTasks",     ( benchSortedTasks,    False ) ),
+    ( "timelineLayout",  ( benchTimelineLayout, False ) ),
+    ( "taskTable",       ( benchTaskTable,      True ) ),
+    ( "timelineRedraw",  ( benchTimelineRedraw, True ) ),
+    ( "dumpFile",        ( benchDumpFile,       False ) ),
+    ( "loadFile",        ( benchLoadFile,       False ) ),
+    ( "journalAppend",   ( benchJournalAppend,  False ) ),
+] )
+
+def makeApp():
+    """
+    Return a function creating, once, an offscreen application
+    """
+    instance = []
+    def getApp():
+        if len( instance ) == 0:
+            os.environ.setdefault( "QT_QPA_PLATFORM", "offscreen" )
+            import wtfdmdg
+            instance.append( wtfdmdg.WtfdmdgApplication( sys.argv[:1] ) )
+        return instance[0]
+    return getApp
+
+def getRevision():
+    try:
+        out = subprocess.check_output( [ "git", "rev-parse", "HEAD" ], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname( os.path.abspath( __file__ ) ) )
+        return out.decode().strip()
+    except Exception:
+        return None
+
+def runBenchmarks( names, sizes, sessionArgs, context, log=sys.stdout, memory=False ):
+    """
+    Run named benchmarks at each size, and with memory, measure bytes per
+    task. Return a results dict, suitable for saving as JSON.
+    """
+    results = collections.OrderedDict()
+    memoryResults = collections.OrderedDict()
+    for n in sizes:
+        session = makeSession( n, **sessionArgs )
+        if memory:
+            memoryResults[ str( n ) ] = measureMemory( session, context )
+            for kind, perTask in memoryResults[ str( n ) ].items():
+                log.write( "{:>16} {:>9} {:12.1f} bytes/task\n".format( kind, n, perTask ) )
+        for name in names:
+            bench, needsQt = BENCHMARKS[ name ]
+            if needsQt and context[ "app" ] is None:
+                continue
+            seconds = bench( session, context )
+            results.setdefault( name, collections.OrderedDict() )[ str( n ) ] = seconds
+            log.write( "{:>16} {:>9} {:12.6f} s\n".format( name, n, seconds ) )
+            log.flush()
+    return {
+        "revision" : getRevision(),
+        "python"   : platform.python_version(),
+        "platform" : platform.platform(),
+        "date"     : datetime.datetime.now().isoformat(),
+        "sizes"    : sizes,
+        "session"  : sessionArgs,
+        "results"  : results,
+        "memory"   : memoryResults,
+    }
+
+def compareResults( old, new, threshold, log=sys.stdout ):
+    """
+    Print new timings relative to old. Return the number of timings which
+    got slower by more than threshold (a fraction).
+    """
+    regressions = 0
+    for name, bySize in new[ "results" ].items():
+        for size, seconds in bySize.items():
+            before = old[ "results" ].get( name, {} ).get( size )
+            if before is None or before <= 0:
+                continue
+            ratio = seconds / before
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            log.write( "{:>16} {:>9} {:8.2f}x{}\n".format( name, size, ratio, flag ) )
+    return regressions
+
+def main( argv ):
+    argParser = argparse.ArgumentParser( description="Benchmark wtfdmdg against synthetic sessions" )
+    argParser.add_argument( "--sizes", default="100,1000,10000",
+                            help="comma separated session sizes (default: %(default)s)" )
+    argParser.add_argument( "--only", help="comma separated benchmarks to run, out of: " + ", ".join( BENCHMARKS ) )
+    argParser.add_argument( "--overlap", type=float, default=2.0, help="mean concurrent tasks (default: %(default)s)" )
+    argParser.add_argument( "--tag-classes", type=int, default=3, help="number of tag classes (default: %(default)s)" )
+    argParser.add_argument( "--tags-per-class", type=int, default=20, help="distinct tags per class (default: %(default)s)" )
+    argParser.add_argument( "--tags-per-task", type=int, default=2, help="tags in each body (default: %(default)s)" )
+    argParser.add_argument( "--commands", type=int, default=1000, help="commands per execute run (default: %(default)s)" )
+    argParser.add_argument( "--repeat", type=int, default=3, help="runs per timing, best is kept (default: %(default)s)" )
+    argParser.add_argument( "--no-qt", action="store_true", help="skip benchmarks which need Qt" )
+    argParser.add_argument( "--memory", action="store_true",
+                            help="also measure bytes per task, as loaded and in a WtfdmdgTaskStore" )
+    argParser.add_argument( "--output", help="write results as JSON to this file" )
+    argParser.add_argument( "--compare", help="compare against results previously written with --output" )
+    argParser.add_argument( "--threshold", type=float, default=0.25,
+                            help="slowdown counted as a regression by --compare (default: %(default)s)" )
+    args = argParser.parse_args( argv[1:] )
+
+    names = args.only.split( "," ) if args.only else list( BENCHMARKS )
+    for name in names:
+        if name not in BENCHMARKS:
+            argParser.error( "unknown benchmark " + name )
+    sizes = [ int( x ) for x in args.sizes.split( "," ) ]
+    sessionArgs = { "overlap" : args.overlap, "tagClasses" : args.tag_classes,
+                    "tagsPerClass" : args.tags_per_class, "tagsPerTask" : args.tags_per_task }
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Keep the real day files and history out of it
+        wtfdmdg_core.APPDATA_DIR = directory
+        wtfdmdg_core.HISTORY_PATH = os.path.join( directory, "history.sqlite3" )
+        context = {
+            "parser"    : WtfdmdgBaseCommandParser(),
+            "commands"  : args.commands,
+            "repeat"    : args.repeat,
+            "directory" : directory,
+            "app"       : None if args.no_qt else makeApp(),
+        }
+        results = runBenchmarks( names, sizes, sessionArgs, context, memory=args.memory )
+
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( results, f, indent=2 )
+    if args.compare:
+        with open( args.compare ) as f:
+            old = json.load( f )
+        if compareResults( old, results, args.threshold ) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main( sys.argv ) )
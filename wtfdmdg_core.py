@@ -0,0 +1,1784 @@
+#
+# wtfdmdg_core.py
+#
+# The parts of wtfdmdg which need no GUI: the session model, command
+# parsing, persistence and history. Nothing here may import Qt.
+#
+
+import sys
+import re
+import collections
+import collections.abc
+import datetime
+import pickle
+import sqlite3
+import os
+import itertools
+import heapq
+import bisect
+import threading
+import concurrent.futures
+import argparse
+import array
+import functools
+import atexit
+import time
+from pathlib import Path
+
+Task = collections.namedtuple( "Task", ( "ref", "begin", "end", "body" ) )
+
+APPDATA_DIR = os.path.join( str( Path.home() ), ".local", "share", "wtfdmdg" )
+
+HISTORY_PATH = os.path.join( APPDATA_DIR, "history.sqlite3" )
+
+SOCKET_PATH = os.path.join( APPDATA_DIR, "session.sock" )
+
+def FILE_PATH( dt ):
+    return os.path.join( APPDATA_DIR, datetime.datetime.strftime( dt, "%y-%m-%d.pickle" ) )
+
+def DAY_PATH( day, directory=None ):
+    return os.path.join( directory or APPDATA_DIR, day.strftime( "%y-%m-%d.pickle" ) )
+
+def listDays( directory=None ):
+    """
+    Return the sorted dates of every day with a day file (or journal) under
+    directory, APPDATA_DIR by default
+    """
+    directory = directory or APPDATA_DIR
+    if not os.path.isdir( directory ):
+        return []
+    days = set()
+    for name in os.listdir( directory ):
+        try:
+            days.add( datetime.datetime.strptime( name.split( "." )[0], "%y-%m-%d" ).date() )
+        except ValueError:
+            continue
+    return sorted( days )
+
+class WtfdmdgProfiler( object ):
+    """
+    Opt-in timing of the hot paths. While disabled, a profiled call costs a
+    single attribute check. While enabled, each stage keeps a latency
+    histogram, named counters can be bumped, and in "cprofile" mode a
+    cProfile capture runs alongside. The summary is printed at exit.
+    """
+
+    MODES = ( "timings", "cprofile" )
+
+    # Bucket i counts latencies below 2**i microseconds
+    BUCKETS = 28
+
+    def __init__( self ):
+        self.enabled = False
+        self.mode = None
+        self._stages = {}
+        self._counters = collections.Counter()
+        self._cProfile = None
+        self._reportAtExit = False
+
+    def enable( self, mode="timings" ):
+        """
+        Start recording. In "cprofile" mode, also capture a cProfile.
+        """
+        assert( mode in WtfdmdgProfiler.MODES )
+        if mode == "cprofile" and self._cProfile is None:
+            import cProfile
+            self._cProfile = cProfile.Profile()
+            self._cProfile.enable()
+        self.enabled = True
+        self.mode = mode
+        if not self._reportAtExit:
+            atexit.register( self.report )
+            self._reportAtExit = True
+
+    def reset( self ):
+        """
+        Forget everything recorded so far
+        """
+        self._stages = {}
+        self._counters = collections.Counter()
+        if self._cProfile is not None:
+            self._cProfile.clear()
+
+    def record( self, stage, seconds ):
+        """
+        Record one call to stage which took seconds
+        """
+        entry = self._stages.get( stage )
+        if entry is None:
+            entry = self._stages[ stage ] = { "calls" : 0, "total" : 0.0, "max" : 0.0,
+                                              "histogram" : [ 0 ] * WtfdmdgProfiler.BUCKETS }
+        entry[ "calls" ] += 1
+        entry[ "total" ] += seconds
+        entry[ "max" ] = max( entry[ "max" ], seconds )
+        bucket = int( seconds * 1e6 ).bit_length()
+        entry[ "histogram" ][ min( bucket, WtfdmdgProfiler.BUCKETS - 1 ) ] += 1
+
+    def count( self, counter, n=1 ):
+        """
+        Add n to counter, if enabled
+        """
+        if self.enabled:
+            self._counters[ counter ] += n
+
+    def getStages( self ):
+        """
+        Get the dict of stage name to its calls, total, max and histogram
+        """
+        return self._stages
+
+    def getCounters( self ):
+        """
+        Get the dict of counter name to count
+        """
+        return self._counters
+
+    def report( self, stream=None ):
+        """
+        Write a summary of everything recorded to stream (stderr by default)
+        """
+        stream = stream or sys.stderr
+        if not self.enabled:
+            return
+        stream.write( "{:<40} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}\n".format(
+            "stage", "calls", "total ms", "mean ms", "p50 ms", "p99 ms", "max ms" ) )
+        for stage, entry in sorted( self._stages.items(), key=lambda x: -x[1][ "total" ] ):
+            stream.write( "{:<40} {:>7} {:>10.2f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}\n".format(
+                stage, entry[ "calls" ], 1000 * entry[ "total" ], 1000 * entry[ "total" ] / entry[ "calls" ],
+                self._percentile( entry, 0.5 ), self._percentile( entry, 0.99 ), 1000 * entry[ "max" ] ) )
+            stream.write( "    " + "  ".join( "<{}: {}".format( self._formatBound( i ), n )
+                                              for i, n in enumerate( entry[ "histogram" ] ) if n > 0 ) + "\n" )
+        for counter, n in sorted( self._counters.items() ):
+            stream.write( "{:<40} {:>7}\n".format( counter, n ) )
+        if self._cProfile is not None:
+            self._cProfile.disable()
+            import pstats
+            pstats.Stats( self._cProfile, stream=stream ).sort_stats( "cumulative" ).print_stats( 30 )
+            self._cProfile.enable()
+        stream.flush()
+
+    def _percentile( self, entry, fraction ):
+        """
+        Estimate a latency percentile in ms, as the upper bound of the
+        histogram bucket it falls in
+        """
+        seen = 0
+        for i, n in enumerate( entry[ "histogram" ] ):
+            seen += n
+            if seen >= fraction * entry[ "calls" ]:
+                return min( 2 ** i / 1000.0, 1000 * entry[ "max" ] )
+        return 1000 * entry[ "max" ]
+
+    def _formatBound( self, i ):
+        micros = 2 ** i
+        if micros < 1000:
+            return "{}us".format( micros )
+        if micros < 1000000:
+            return "{:g}ms".format( micros / 1000.0 )
+        return "{:g}s".format( micros / 1000000.0 )
+
+profiler = WtfdmdgProfiler()
+
+if os.environ.get( "WTFDMDG_PROFILE" ):
+    profiler.enable( "cprofile" if os.environ[ "WTFDMDG_PROFILE" ] == "cprofile" else "timings" )
+
+def profiled( stage ):
+    """
+    Decorate a function so that, while profiling, its calls are timed as stage
+    """
+    def decorate( f ):
+        @functools.wraps( f )
+        def wrapper( *args, **kwargs ):
+            if not profiler.enabled:
+                return f( *args, **kwargs )
+            t0 = time.perf_counter()
+            try:
+                return f( *args, **kwargs )
+            finally:
+                profiler.record( stage, time.perf_counter() - t0 )
+        return wrapper
+    return decorate
+
+# Anchor points of matplotlib's gist_rainbow colormap
+GIST_RAINBOW = (
+    ( 0.000, ( 1.00, 0.00, 0.16 ) ),
+    ( 0.030, ( 1.00, 0.00, 0.00 ) ),
+    ( 0.215, ( 1.00, 1.00, 0.00 ) ),
+    ( 0.400, ( 0.00, 1.00, 0.00 ) ),
+    ( 0.586, ( 0.00, 1.00, 1.00 ) ),
+    ( 0.770, ( 0.00, 0.00, 1.00 ) ),
+    ( 0.954, ( 1.00, 0.00, 1.00 ) ),
+    ( 1.000, ( 1.00, 0.00, 0.75 ) ),
+)
+
+COLORMAPS = { "gist_rainbow" : GIST_RAINBOW }
+
+def makeColorMap( anchors, n=256 ):
+    """
+    Build the same n entry lookup table that matplotlib builds from anchors,
+    a sequence of ( position, ( r, g, b ) ). Return a function which, like a
+    matplotlib colormap, maps a float in [0, 1] to an ( r, g, b, a ) tuple.
+    """
+    # Follows matplotlib's arithmetic exactly, so colors match to the bit
+    xs = [ x * ( n - 1 ) for x, _ in anchors ]
+    lut = [ tuple( anchors[0][1] ) + ( 1.0, ) ]
+    for i in range( 1, n - 1 ):
+        x = ( n - 1 ) * ( i * ( 1.0 / ( n - 1 ) ) )
+        j = bisect.bisect_left( xs, x )
+        distance = ( x - xs[ j - 1 ] ) / ( xs[ j ] - xs[ j - 1 ] )
+        rgb = [ distance * ( b - a ) + a for a, b in zip( anchors[ j - 1 ][1], anchors[ j ][1] ) ]
+        lut.append( tuple( min( max( c, 0.0 ), 1.0 ) for c in rgb ) + ( 1.0, ) )
+    lut.append( tuple( anchors[-1][1] ) + ( 1.0, ) )
+    def colorMap( x ):
+        return lut[ min( max( int( x * n ), 0 ), n - 1 ) ]
+    return colorMap
+
+def getColorMap( name ):
+    """
+    Get a colormap by name. Those in COLORMAPS are built in, anything else
+    comes from matplotlib.
+    """
+    if name in COLORMAPS:
+        return makeColorMap( COLORMAPS[ name ] )
+    import pylab
+    return pylab.get_cmap( name )
+
+def JOURNAL_PATH( path ):
+    return os.path.splitext( path )[0] + ".journal"
+
+@profiled( "writeSnapshot" )
+def writeSnapshot( path, session ):
+    """
+    Pickle session to path. The write goes to a temporary file which then
+    replaces path, so a crash never leaves a partial snapshot behind.
+    """
+    directory = os.path.dirname( path )
+    if not os.path.exists( directory ):
+        os.makedirs( directory )
+    tmp = path + ".tmp"
+    with open( tmp, 'wb' ) as f:
+        pickle.dump( session, f )
+        f.flush()
+        os.fsync( f.fileno() )
+    os.replace( tmp, path )
+
+class _SessionUnpickler( pickle.Unpickler ):
+    """
+    Resolve Task wherever the pickling process had it, which for older day
+    files is __main__ (wtfdmdg.py run as a script).
+    """
+    def find_class( self, module, name ):
+        if name == "Task" and module in ( "__main__", "wtfdmdg", "wtfdmdg_core" ):
+            return Task
+        return super( _SessionUnpickler, self ).find_class( module, name )
+
+@profiled( "readSnapshot" )
+def readSnapshot( f ):
+    """
+    Unpickle a session from open file f
+    """
+    return _SessionUnpickler( f ).load()
+
+@profiled( "layoutTimeline" )
+def layoutTimeline( tasks ):
+    """
+    Assign each closed task a timeline column, such that no two concurrent
+    tasks share a column. Return ( maxConcurrent, columnAssignments ), where
+    columnAssignments maps task to column.
+
+    Tasks are swept in order of start time. Each task holds its column until
+    one minute before it ends, so a task ending exactly as another starts
+    does not conflict with it.
+    """
+    minute = datetime.timedelta( minutes=1 )
+    columnAssignments = {}
+    maxConcurrent = 0
+    active = [] # Heap of ( last minute held, column ) for running tasks
+    free = []   # Heap of released columns
+    for _, task in sorted( enumerate( tasks ), key=lambda x: ( x[1].begin, x[0] ) ):
+        while len( active ) > 0 and active[0][0] < task.begin:
+            heapq.heappush( free, heapq.heappop( active )[1] )
+        column = free[0] if len( free ) > 0 else len( active )
+        last = task.end - minute
+        if last < task.begin:
+            # Shorter than a minute, so it holds no column and conflicts with nothing
+            columnAssignments[ task ] = column if column < maxConcurrent else 0
+            continue
+        if len( free ) > 0:
+            heapq.heappop( free )
+        heapq.heappush( active, ( last, column ) )
+        maxConcurrent = max( maxConcurrent, len( active ) )
+        columnAssignments[ task ] = column
+    return maxConcurrent, columnAssignments
+
+class WtfdmdgTaskIndex( object ):
+    """
+    Ordered index over a session. Unstarted tasks come first, in the order
+    they were created, followed by started tasks ordered by begin time.
+    Lookup by position or by ref is O(log n) or better.
+    """
+
+    def __init__( self, tasks=None ):
+        """
+        Initialize index, optionally from a dict mapping ref to task
+        """
+        self._keys = []     # Sorted order keys
+        self._tasks = []    # Tasks, parallel to _keys
+        self._keyByRef = {}
+        self._refs = []     # Sorted refs, for generating new ones
+        self._sequence = itertools.count()
+        self.revision = 0   # Bumped whenever a task is put or removed
+        for task in ( tasks or {} ).values():
+            self.put( task )
+
+    def __len__( self ):
+        return len( self._tasks )
+
+    def __contains__( self, ref ):
+        return ref in self._keyByRef
+
+    def put( self, task ):
+        """
+        Insert task, or update the task with the same ref
+        """
+        if task.ref in self._keyByRef:
+            seq = self._keyByRef[ task.ref ][ -1 ]
+            self._removeKey( self._keyByRef[ task.ref ] )
+        else:
+            seq = next( self._sequence )
+            bisect.insort( self._refs, task.ref )
+        if task.begin is None:
+            key = ( 0, seq )
+        else:
+            key = ( 1, task.begin, seq )
+        i = bisect.bisect_left( self._keys, key )
+        self._keys.insert( i, key )
+        self._tasks.insert( i, task )
+        self._keyByRef[ task.ref ] = key
+        self.revision += 1
+
+    def remove( self, ref ):
+        """
+        Remove the task with this ref
+        """
+        self._removeKey( self._keyByRef.pop( ref ) )
+        del self._refs[ bisect.bisect_left( self._refs, ref ) ]
+        self.revision += 1
+
+    def getTask( self, index ):
+        """
+        Get task by position
+        """
+        return self._tasks[ index ]
+
+    def indexOf( self, ref ):
+        """
+        Get position of the task with this ref
+        """
+        return bisect.bisect_left( self._keys, self._keyByRef[ ref ] )
+
+    def getTasks( self ):
+        """
+        Get a list of all tasks, in order
+        """
+        return list( self._tasks )
+
+    def nextRef( self ):
+        """
+        Get a ref one greater than any in the index
+        """
+        if len( self._refs ) == 0:
+            return 0
+        return self._refs[ -1 ] + 1
+
+    def _removeKey( self, key ):
+        i = bisect.bisect_left( self._keys, key )
+        del self._keys[ i ]
+        del self._tasks[ i ]
+
+class WtfdmdgTagIndex( object ):
+    """
+    Inverted index of the tags used in a session, maintained one task at a
+    time. Holds tag class to ordered tags, tag to refs, and ref to parsed
+    tags, so bodies are only parsed when they change.
+
+    Tags within a class are ordered by first appearance, scanning tasks in
+    the order they were created, just as a full rescan of the session would
+    find them.
+    """
+
+    def __init__( self, parser, tasks=None ):
+        """
+        Initialize index, optionally from a dict mapping ref to task
+        """
+        self._parser = parser
+        self._tagtable = {}     # Class to ordered tags
+        self._orderKeys = {}    # Class to sorted order keys, parallel to _tagtable
+        self._keyByTag = {}     # ( class, tag ) to order key
+        self._refsByTag = {}    # ( class, tag ) to set of refs
+        self._tagsByRef = {}    # Ref to parsed tags
+        self._seqByRef = {}
+        self._sequence = itertools.count()
+        self._classRevisions = {}
+        self.revision = 0       # Bumped whenever the tag table changes
+        for task in ( tasks or {} ).values():
+            self.put( task )
+
+    @profiled( "WtfdmdgTagIndex.put" )
+    def put( self, task ):
+        """
+        Index tags for task, replacing those of any task with the same ref
+        """
+        tags = {} if task.body is None else self._parser.getTaskTags( task.body )
+        if task.ref in self._tagsByRef:
+            if tags == self._tagsByRef[ task.ref ]:
+                return
+            self._unlink( task.ref )
+        else:
+            self._seqByRef[ task.ref ] = next( self._sequence )
+        self._tagsByRef[ task.ref ] = tags
+        seq = self._seqByRef[ task.ref ]
+        for cls in tags:
+            for pos, tag in enumerate( tags[ cls ] ):
+                refs = self._refsByTag.setdefault( ( cls, tag ), set() )
+                refs.add( task.ref )
+                key = ( seq, pos )
+                if len( refs ) == 1:
+                    self._insertTag( cls, tag, key )
+                elif key < self._keyByTag[ ( cls, tag ) ]:
+                    self._removeTag( cls, tag )
+                    self._insertTag( cls, tag, key )
+
+    def remove( self, ref ):
+        """
+        Drop tags for the task with this ref
+        """
+        self._unlink( ref )
+        del self._tagsByRef[ ref ]
+        del self._seqByRef[ ref ]
+
+    def getTagTable( self ):
+        """
+        Get the dict mapping tag class to ordered list of tags. This is
+        updated in place as the index changes.
+        """
+        return self._tagtable
+
+    def getTaskTags( self, ref ):
+        """
+        Get the dict mapping tag class to tags for the task with this ref
+        """
+        return self._tagsByRef[ ref ]
+
+    def getClassRevision( self, tagclass ):
+        """
+        Get a number which changes whenever the tags in tagclass change
+        """
+        return self._classRevisions.get( tagclass, 0 )
+
+    def getRefsWithTag( self, tagclass, tag ):
+        """
+        Get the set of refs for tasks carrying tag in tagclass
+        """
+        return self._refsByTag.get( ( tagclass, tag ), set() )
+
+    def _unlink( self, ref ):
+        seq = self._seqByRef[ ref ]
+        tags = self._tagsByRef[ ref ]
+        for cls in tags:
+            for tag in tags[ cls ]:
+                refs = self._refsByTag[ ( cls, tag ) ]
+                refs.discard( ref )
+                if len( refs ) == 0:
+                    del self._refsByTag[ ( cls, tag ) ]
+                    self._removeTag( cls, tag )
+                elif self._keyByTag[ ( cls, tag ) ][ 0 ] == seq:
+                    # This task introduced the tag, so the next oldest user now does
+                    key = min( ( self._seqByRef[ r ], self._tagsByRef[ r ][ cls ].index( tag ) ) for r in refs )
+                    self._removeTag( cls, tag )
+                    self._insertTag( cls, tag, key )
+
+    def _insertTag( self, cls, tag, key ):
+        keys = self._orderKeys.setdefault( cls, [] )
+        i = bisect.bisect_left( keys, key )
+        keys.insert( i, key )
+        self._tagtable.setdefault( cls, [] ).insert( i, tag )
+        self._keyByTag[ ( cls, tag ) ] = key
+        self.revision += 1
+        self._classRevisions[ cls ] = self.revision
+
+    def _removeTag( self, cls, tag ):
+        keys = self._orderKeys[ cls ]
+        i = bisect.bisect_left( keys, self._keyByTag.pop( ( cls, tag ) ) )
+        del keys[ i ]
+        del self._tagtable[ cls ][ i ]
+        if len( keys ) == 0:
+            del self._orderKeys[ cls ]
+            del self._tagtable[ cls ]
+        self.revision += 1
+        self._classRevisions[ cls ] = self.revision
+
+class WtfdmdgTaskStore( collections.abc.Sequence ):
+    """
+    Compact, append-only columnar store of tasks, for holding long
+    histories in memory. Refs and times are machine integers in arrays,
+    bodies are UTF-8 in one shared buffer, and tags are integer ids into a
+    table of ( class, tag ). Reads as a sequence of Task, built on demand,
+    so anything which consumes a list of tasks can consume a store.
+
+    Each task may be stamped with the day it came from, since refs are only
+    unique within a day.
+    """
+
+    EPOCH = datetime.datetime( 1970, 1, 1 )
+
+    # Stands in for a missing begin or end time, or day
+    NONE = -2 ** 63
+
+    def __init__( self, parser, tasks=None, day=None ):
+        """
+        Initialize store, optionally with tasks (an iterable of Task) from
+        day. Tags are parsed from bodies by parser.
+        """
+        self._parser = parser
+        self._refs = array.array( "q" )
+        self._begins = array.array( "q" )       # Microseconds since EPOCH, wall clock
+        self._ends = array.array( "q" )
+        self._days = array.array( "q" )         # Date ordinals
+        self._bodies = bytearray()
+        self._bodyOffsets = array.array( "q", [ 0 ] )
+        self._noBody = set()                    # Rows whose body is None
+        self._tags = array.array( "i" )         # Tag ids of all rows, back to back
+        self._tagOffsets = array.array( "q", [ 0 ] )
+        self._tagNames = []                     # Tag id to ( class, tag )
+        self._tagIds = {}
+        if tasks is not None:
+            self.extend( tasks, day )
+
+    def __len__( self ):
+        return len( self._refs )
+
+    def __getitem__( self, i ):
+        """
+        Get row i as a Task
+        """
+        if isinstance( i, slice ):
+            return [ self[ j ] for j in range( *i.indices( len( self ) ) ) ]
+        if i < 0:
+            i += len( self )
+        if i < 0 or i >= len( self ):
+            raise IndexError( "task store index out of range" )
+        return Task( self._refs[ i ], self._decodeTime( self._begins[ i ] ), self._decodeTime( self._ends[ i ] ),
+                     self.getBody( i ) )
+
+    def append( self, task, day=None ):
+        """
+        Add task, from day (a datetime.date) if given
+        """
+        self._refs.append( task.ref )
+        self._begins.append( self._encodeTime( task.begin ) )
+        self._ends.append( self._encodeTime( task.end ) )
+        self._days.append( WtfdmdgTaskStore.NONE if day is None else day.toordinal() )
+        if task.body is None:
+            self._noBody.add( len( self._refs ) - 1 )
+            tags = {}
+        else:
+            self._bodies += task.body.encode( "utf-8" )
+            tags = self._parser.getTaskTags( task.body )
+        self._bodyOffsets.append( len( self._bodies ) )
+        for cls in tags:
+            for tag in tags[ cls ]:
+                tagId = self._tagIds.get( ( cls, tag ) )
+                if tagId is None:
+                    tagId = self._tagIds[ ( cls, tag ) ] = len( self._tagNames )
+                    self._tagNames.append( ( cls, tag ) )
+                self._tags.append( tagId )
+        self._tagOffsets.append( len( self._tags ) )
+
+    def extend( self, tasks, day=None ):
+        """
+        Add each of tasks, from day if given
+        """
+        for task in tasks:
+            self.append( task, day )
+
+    def getBody( self, i ):
+        """
+        Get body of row i
+        """
+        if i in self._noBody:
+            return None
+        return self._bodies[ self._bodyOffsets[ i ] : self._bodyOffsets[ i + 1 ] ].decode( "utf-8" )
+
+    def getDay( self, i ):
+        """
+        Get the day row i came from, or None
+        """
+        day = self._days[ i ]
+        return None if day == WtfdmdgTaskStore.NONE else datetime.date.fromordinal( day )
+
+    def getTagIds( self, i ):
+        """
+        Get the ids of tags in row i
+        """
+        return self._tags[ self._tagOffsets[ i ] : self._tagOffsets[ i + 1 ] ]
+
+    def getTagNames( self ):
+        """
+        Get the table of tag id to ( class, tag )
+        """
+        return self._tagNames
+
+    def getTaskTags( self, i ):
+        """
+        Get tags of row i, as getTaskTags would parse them from its body
+        """
+        tagtable = {}
+        for tagId in self.getTagIds( i ):
+            cls, tag = self._tagNames[ tagId ]
+            tagtable.setdefault( cls, [] ).append( tag )
+        return tagtable
+
+    def getColumn( self, name ):
+        """
+        Get the array of "ref", "begin", "end" (microseconds since EPOCH, or
+        NONE) or "day" (date ordinal, or NONE) for all rows. Arrays support
+        the buffer protocol, so numpy.frombuffer can view them without a copy.
+        """
+        return { "ref" : self._refs, "begin" : self._begins, "end" : self._ends, "day" : self._days }[ name ]
+
+    def getSession( self, day=None ):
+        """
+        Get a session dict, mapping ref to Task, for the rows from day
+        """
+        day = WtfdmdgTaskStore.NONE if day is None else day.toordinal()
+        return { self._refs[ i ] : self[ i ] for i in range( len( self ) ) if self._days[ i ] == day }
+
+    def _encodeTime( self, dt ):
+        if dt is None:
+            return WtfdmdgTaskStore.NONE
+        return ( dt - WtfdmdgTaskStore.EPOCH ) // datetime.timedelta( microseconds=1 )
+
+    def _decodeTime( self, value ):
+        if value == WtfdmdgTaskStore.NONE:
+            return None
+        return WtfdmdgTaskStore.EPOCH + datetime.timedelta( microseconds=value )
+
+class WtfdmdgJournal( object ):
+    """
+    Append-only log of task mutations, kept beside a session snapshot. Each
+    record is fsynced as it is written, so a crash loses at most the record
+    being written. Once enough records build up, they are folded into the
+    snapshot on a background thread.
+
+    Like the indexes, a journal can be handed to execute, and records
+    every put( task ) and remove( ref ).
+    """
+
+    COMPACT_RECORDS = 256
+
+    def __init__( self, path ):
+        """
+        Initialize journal for the snapshot at path
+        """
+        self.path = path
+        self._journalPath = JOURNAL_PATH( path )
+        self._compactingPath = self._journalPath + ".compacting"
+        self._file = None
+        self._records = 0
+        self._compactor = None
+        self._compactorError = None
+
+    def load( self ):
+        """
+        Return the session stored in the snapshot, with the journal replayed
+        on top of it. Repairs the journal for appending.
+        """
+        session = self.read( repair=True )
+        if os.path.exists( self._compactingPath ):
+            # An earlier compaction never finished; finish it now
+            self.fold( session )
+        return session
+
+    def read( self, repair=False ):
+        """
+        Return the session stored in the snapshot, with the journal replayed
+        on top of it, without modifying anything on disk unless repair.
+        """
+        session = {}
+        if os.path.exists( self.path ):
+            with open( self.path, 'rb' ) as f:
+                session = readSnapshot( f )
+        self._replay( self._compactingPath, session, False )
+        self._records = self._replay( self._journalPath, session, repair )
+        return session
+
+    def getModifiedTime( self ):
+        """
+        Return the latest modification time of the snapshot or journal
+        """
+        paths = ( self.path, self._compactingPath, self._journalPath )
+        return max( [ os.path.getmtime( p ) for p in paths if os.path.exists( p ) ] or [ 0 ] )
+
+    def getSignature( self ):
+        """
+        Return the modification time, inode and size of the snapshot and
+        journals present, which changes whenever any of them is written,
+        replaced or removed
+        """
+        signature = []
+        for path in ( self.path, self._compactingPath, self._journalPath ):
+            try:
+                st = os.stat( path )
+            except FileNotFoundError:
+                continue
+            signature.append( ( path, st.st_mtime_ns, st.st_ino, st.st_size ) )
+        return tuple( signature )
+
+    def put( self, task ):
+        self._append( ( "put", task.ref, task.begin, task.end, task.body ) )
+
+    def remove( self, ref ):
+        self._append( ( "remove", ref ) )
+
+    def compactIfNeeded( self, session ):
+        """
+        Compact if enough records have been written since the last compaction,
+        or if a failed compaction left records behind
+        """
+        if self._records >= WtfdmdgJournal.COMPACT_RECORDS or os.path.exists( self._compactingPath ):
+            self.compact( session )
+
+    def compact( self, session ):
+        """
+        Fold the journal into a snapshot of session, in the background.
+        Records appended meanwhile go to a fresh journal. Raises the error
+        of a failed earlier compaction, once.
+        """
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._raiseCompactorError()
+        if os.path.exists( self._compactingPath ):
+            # A failed compaction left records behind, which session already
+            # holds. Renaming the journal would clobber them, so fold now.
+            self.fold( session )
+            return
+        self._closeFile()
+        if os.path.exists( self._journalPath ):
+            os.replace( self._journalPath, self._compactingPath )
+        self._records = 0
+        self._compactor = threading.Thread( target=self._writeSnapshot, args=( dict( session ), ) )
+        self._compactor.start()
+
+    def fold( self, session ):
+        """
+        Write a snapshot of session, which must hold every record journaled
+        so far, and drop the journals, before returning
+        """
+        self.wait()
+        self._closeFile()
+        writeSnapshot( self.path, session )
+        for path in ( self._compactingPath, self._journalPath ):
+            if os.path.exists( path ):
+                os.remove( path )
+        self._records = 0
+
+    def wait( self ):
+        """
+        Block until any running compaction is done
+        """
+        if self._compactor is not None:
+            self._compactor.join()
+
+    def close( self ):
+        """
+        Finish compaction and close the journal. Raises the error of a failed
+        compaction, if not raised already.
+        """
+        self.wait()
+        self._closeFile()
+        self._raiseCompactorError()
+
+    def reopen( self ):
+        """
+        Close the journal file, so that the next record opens it afresh. For
+        when another process may have compacted it away.
+        """
+        self._closeFile()
+
+    def _writeSnapshot( self, session ):
+        # Runs on the compactor thread, so keep any error for the caller
+        try:
+            writeSnapshot( self.path, session )
+            if os.path.exists( self._compactingPath ):
+                os.remove( self._compactingPath )
+        except Exception as e:
+            self._compactorError = e
+
+    def _raiseCompactorError( self ):
+        error, self._compactorError = self._compactorError, None
+        if error is not None:
+            raise error
+
+    @profiled( "WtfdmdgJournal.append" )
+    def _append( self, record ):
+        if self._file is not None and self._isStale():
+            # Another process compacted the journal away or wrote to it, so
+            # appending to the open file could write to a deleted one
+            self._closeFile()
+        if self._file is None:
+            directory = os.path.dirname( self._journalPath )
+            if not os.path.exists( directory ):
+                os.makedirs( directory )
+            # Cut off any record torn by another process, and count records
+            # toward the next compaction
+            self._records = self._replay( self._journalPath, {}, True )
+            self._file = open( self._journalPath, 'ab' )
+        pickle.dump( record, self._file )
+        self._file.flush()
+        os.fsync( self._file.fileno() )
+        self._records += 1
+
+    def _isStale( self ):
+        """
+        Return whether the open journal file is no longer the one at the
+        journal's path, or has been appended to by another process
+        """
+        try:
+            st = os.stat( self._journalPath )
+        except FileNotFoundError:
+            return True
+        fst = os.fstat( self._file.fileno() )
+        return ( fst.st_nlink == 0 or ( st.st_dev, st.st_ino ) != ( fst.st_dev, fst.st_ino ) or
+                 fst.st_size != self._file.tell() )
+
+    def _closeFile( self ):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _replay( self, path, session, repair ):
+        """
+        Apply records in the journal at path to session. Return the number
+        of records applied.
+        """
+        if not os.path.exists( path ):
+            return 0
+        n = 0
+        with open( path, 'r+b' if repair else 'rb' ) as f:
+            good = 0
+            while True:
+                try:
+                    record = pickle.load( f )
+                except Exception:
+                    # End of journal, or a record torn by a crash. Cut off any
+                    # torn record, so that new ones are not appended to garbage.
+                    if repair:
+                        f.truncate( good )
+                    break
+                if record[0] == "put":
+                    session[ record[1] ] = Task( *record[1:] )
+                elif record[0] == "remove":
+                    session.pop( record[1], None )
+                good = f.tell()
+                n += 1
+        return n
+
+class WtfdmdgBackgroundWriter( object ):
+    """
+    Runs writes, in the order submitted, on a background thread, so callers
+    never wait on the disk. A write submitted under a key replaces any write
+    under that key which is still waiting, so a burst of snapshots costs a
+    single write. Errors are handed to onError, on the writer thread.
+    """
+
+    def __init__( self, onError=None ):
+        """
+        Initialize writer, and start its thread
+        """
+        self._onError = onError
+        self._pending = collections.OrderedDict()   # Key to ( write, args ), in order to run
+        self._sequence = itertools.count()
+        self._busy = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread( target=self._run, name="wtfdmdg writer", daemon=True )
+        self._thread.start()
+
+    def submit( self, key, write, *args ):
+        """
+        Queue a call to write( *args ). Unless key is None, a queued write
+        with the same key is dropped in its favor.
+        """
+        with self._condition:
+            assert( not self._closed )
+            if key is None:
+                key = ( None, next( self._sequence ) )
+            self._pending.pop( key, None )
+            self._pending[ key ] = ( write, args )
+            self._condition.notify_all()
+
+    def isIdle( self ):
+        """
+        Return whether every queued write is done
+        """
+        with self._condition:
+            return len( self._pending ) == 0 and not self._busy
+
+    def flush( self ):
+        """
+        Block until every queued write is done
+        """
+        with self._condition:
+            while len( self._pending ) > 0 or self._busy:
+                self._condition.wait()
+
+    def close( self ):
+        """
+        Finish every queued write, then stop the thread
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run( self ):
+        while True:
+            with self._condition:
+                while len( self._pending ) == 0 and not self._closed:
+                    self._condition.wait()
+                if len( self._pending ) == 0:
+                    return
+                _, ( write, args ) = self._pending.popitem( last=False )
+                self._busy = True
+            try:
+                write( *args )
+            except Exception as e:
+                if self._onError is not None:
+                    self._onError( e )
+                else:
+                    sys.stderr.write( "write failed: {!r}\n".format( e ) )
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+class WtfdmdgDeferredIndex( object ):
+    """
+    Stands in for an index handed to execute, such as a journal, passing
+    its put and remove calls to a background writer
+    """
+
+    def __init__( self, writer, index ):
+        self._writer = writer
+        self._index = index
+
+    def put( self, task ):
+        self._writer.submit( None, self._index.put, task )
+
+    def remove( self, ref ):
+        self._writer.submit( None, self._index.remove, ref )
+
+class WtfdmdgChangeSet( object ):
+    """
+    Index recording the latest state of each task put or removed since the
+    changes were last taken. Changes are recorded on one thread, such as
+    the GUI's, and taken on another, such as a background writer's.
+    """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._changes = {}  # Ref to task, or None if removed
+        self.mtime = None   # Of the day's files, as last put in the history store
+
+    def put( self, task ):
+        with self._lock:
+            self._changes[ task.ref ] = task
+
+    def remove( self, ref ):
+        with self._lock:
+            self._changes[ ref ] = None
+
+    def take( self ):
+        """
+        Return ( tasks, refs ), the tasks put and refs removed since the last
+        call, and forget them
+        """
+        with self._lock:
+            changes, self._changes = self._changes, {}
+        return ( [ task for task in changes.values() if task is not None ],
+                 [ ref for ref, task in changes.items() if task is None ] )
+
+class WtfdmdgDayCache( object ):
+    """
+    Bounded LRU cache of day sessions along with their task and tag indexes,
+    keyed by date. A cached day is reused only while its day file is
+    unchanged since it was read. Days can be loaded ahead of time on a
+    background thread.
+
+    A day being edited is held: its disk files lag behind its session, so
+    it is neither checked against them nor evicted until released.
+    """
+
+    CAPACITY = 16
+
+    class Entry( object ):
+        """
+        A day's session and indexes, and the modification time of its files
+        when they were read. Anything else worked out from the session, such
+        as a view's drawing data, can be kept in derived and goes with it.
+        """
+
+        def __init__( self, session, taskIndex, tagIndex, mtime=None ):
+            self.session = session
+            self.taskIndex = taskIndex
+            self.tagIndex = tagIndex
+            self.mtime = mtime
+            self.holds = 0
+            self.derived = {}
+
+    def __init__( self, parser, capacity=None, directory=None ):
+        """
+        Initialize cache of at most capacity days (CAPACITY by default, not
+        counting held days) read from directory, APPDATA_DIR by default
+        """
+        self._parser = parser
+        self._capacity = capacity or WtfdmdgDayCache.CAPACITY
+        self._directory = directory
+        self._entries = collections.OrderedDict()  # Date to Entry, least recently used first
+        self._loading = {}                         # Date to Future of Entry
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor( 1, thread_name_prefix="wtfdmdg prefetch" )
+
+    def get( self, day ):
+        """
+        Get the Entry for day, reading it unless cached and still current.
+        If day is being read in the background, wait for that instead.
+        """
+        with self._lock:
+            entry = self._getCurrent( day )
+            future = self._loading.get( day )
+        if entry is not None:
+            profiler.count( "day cache hits" )
+            return entry
+        if future is not None:
+            return future.result()
+        return self._load( day )
+
+    def peek( self, day ):
+        """
+        Get the Entry for day if cached and still current, else None. Never
+        reads the day.
+        """
+        with self._lock:
+            return self._getCurrent( day )
+
+    def prefetch( self, days, onLoad=None ):
+        """
+        Read any of days not cached or being read, in the background. If
+        given, onLoad( day ) is called on the reading thread once each of
+        them is read.
+        """
+        futures = []
+        with self._lock:
+            for day in days:
+                if day not in self._loading and self._getCurrent( day ) is None:
+                    self._loading[ day ] = self._executor.submit( self._load, day )
+                if day in self._loading:
+                    futures.append( ( day, self._loading[ day ] ) )
+        if onLoad is not None:
+            for day, future in futures:
+                future.add_done_callback( lambda f, day=day: f.cancelled() or f.exception() is not None or onLoad( day ) )
+
+    def put( self, day, entry ):
+        """
+        Cache entry as day, replacing anything cached for it
+        """
+        with self._lock:
+            self._entries.pop( day, None )
+            self._entries[ day ] = entry
+            self._evict()
+
+    def discard( self, day ):
+        with self._lock:
+            self._entries.pop( day, None )
+
+    def hold( self, entry ):
+        """
+        Keep entry as it is, whatever happens on disk, until released
+        """
+        with self._lock:
+            entry.holds += 1
+
+    def release( self, day, entry ):
+        """
+        Undo one hold on entry. Call once its edits have all been written, so
+        that the files' modification time can be taken as its own.
+        """
+        with self._lock:
+            entry.holds -= 1
+            if entry.holds == 0 and self._entries.get( day ) is entry:
+                entry.mtime = self._getJournal( day ).getModifiedTime()
+                self._evict()
+
+    def close( self ):
+        """
+        Stop reading ahead
+        """
+        self._executor.shutdown( wait=False, cancel_futures=True )
+
+    def _getJournal( self, day ):
+        return WtfdmdgJournal( DAY_PATH( day, self._directory ) )
+
+    def _getCurrent( self, day ):
+        """
+        Return the cached Entry for day and mark it used, or None if there is
+        none or its files have changed since. Call with the lock held.
+        """
+        entry = self._entries.get( day )
+        if entry is None:
+            return None
+        if entry.holds == 0 and entry.mtime != self._getJournal( day ).getModifiedTime():
+            del self._entries[ day ]
+            return None
+        self._entries.move_to_end( day )
+        return entry
+
+    @profiled( "WtfdmdgDayCache.load" )
+    def _load( self, day ):
+        try:
+            journal = self._getJournal( day )
+            # Taken first, so that a write racing the read leaves it stale
+            mtime = journal.getModifiedTime()
+            session = journal.read()
+            entry = WtfdmdgDayCache.Entry( session, WtfdmdgTaskIndex( session ),
+                                           WtfdmdgTagIndex( self._parser, session ), mtime )
+            with self._lock:
+                held = self._entries.get( day )
+                if held is not None and held.holds > 0:
+                    # Edited while being read, so the read is already stale
+                    return held
+                self._entries.pop( day, None )
+                self._entries[ day ] = entry
+                self._evict()
+            return entry
+        finally:
+            with self._lock:
+                self._loading.pop( day, None )
+
+    def _evict( self ):
+        unheld = [ day for day, entry in self._entries.items() if entry.holds == 0 ]
+        for day in unheld[ :max( 0, len( unheld ) - self._capacity ) ]:
+            del self._entries[ day ]
+
+class WtfdmdgUndoLog( object ):
+    """
+    Undo and redo history of a session, kept as a log of inverse operations.
+    Handed to execute like an index, it records what each put and remove
+    replaced, so a step costs memory in proportion to the tasks it changed,
+    never a copy of the session. Once the log outgrows its memory budget,
+    the oldest steps are forgotten.
+    """
+
+    MAX_BYTES = 16 << 20
+
+    # Rough bytes held per recorded operation, besides task bodies
+    OPERATION_BYTES = 160
+
+    def __init__( self, session, maxBytes=None ):
+        """
+        Initialize empty history of session, keeping at most maxBytes
+        (MAX_BYTES by default) of it
+        """
+        self._maxBytes = maxBytes or WtfdmdgUndoLog.MAX_BYTES
+        self.reset( session )
+
+    def reset( self, session ):
+        """
+        Forget all history, and take session as it now is
+        """
+        self._tasks = dict( session )   # Ref to task, as of the last operation
+        self._step = []                 # ( ref, before, after ) operations not yet committed
+        self._undo = collections.deque()
+        self._redo = []
+        self._bytes = 0
+
+    def put( self, task ):
+        self._step.append( ( task.ref, self._tasks.get( task.ref ), task ) )
+        self._tasks[ task.ref ] = task
+
+    def remove( self, ref ):
+        self._step.append( ( ref, self._tasks.pop( ref ), None ) )
+
+    def commit( self ):
+        """
+        Close the operations recorded since the last commit into one step,
+        which can be undone. Any steps undone before are no longer redoable.
+        """
+        if len( self._step ) == 0:
+            return
+        self._push( self._undo, self._step )
+        self._step = []
+        for step in self._redo:
+            self._bytes -= self._getSize( step )
+        self._redo = []
+        while self._bytes > self._maxBytes and len( self._undo ) > 1:
+            self._bytes -= self._getSize( self._undo.popleft() )
+            profiler.count( "undo steps evicted" )
+
+    def canUndo( self ):
+        return len( self._undo ) > 0
+
+    def canRedo( self ):
+        return len( self._redo ) > 0
+
+    def undo( self ):
+        """
+        Step back. Return ( tasks, refs ), the tasks to put and the refs to
+        remove to restore the session as it was before the last step.
+        """
+        step = self._undo.pop()
+        self._redo.append( step )
+        return self._replay( [ ( ref, after, before ) for ref, before, after in reversed( step ) ] )
+
+    def redo( self ):
+        """
+        Step forward again. Return ( tasks, refs ) as for undo.
+        """
+        step = self._redo.pop()
+        self._undo.append( step )
+        return self._replay( step )
+
+    def _replay( self, operations ):
+        """
+        Apply ( ref, before, after ) operations to the log's view of the
+        session, and return their net effect as ( tasks, refs )
+        """
+        final = collections.OrderedDict()
+        for ref, _, after in operations:
+            final[ ref ] = after
+            if after is None:
+                self._tasks.pop( ref, None )
+            else:
+                self._tasks[ ref ] = after
+        return ( [ task for task in final.values() if task is not None ],
+                 [ ref for ref, task in final.items() if task is None ] )
+
+    def _push( self, steps, step ):
+        steps.append( step )
+        self._bytes += self._getSize( step )
+
+    def _getSize( self, step ):
+        size = 0
+        for _, before, after in step:
+            size += WtfdmdgUndoLog.OPERATION_BYTES
+            for task in ( before, after ):
+                if task is not None and task.body is not None:
+                    size += len( task.body )
+        return size
+
+class WtfdmdgHistoryStore( object ):
+    """
+    SQLite store of tasks across all days, indexed by begin time, end time
+    and tag, so that ranges of history can be queried without loading whole
+    day files. Day files remain the source of truth; the store is filled
+    from them by importDayFiles and putDay, and kept in sync as commands
+    run with putChanges.
+    """
+
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS days  ( day TEXT PRIMARY KEY, mtime REAL );
+        CREATE TABLE IF NOT EXISTS tasks ( day TEXT, ref INTEGER, begin TEXT, end TEXT, body TEXT,
+                                           PRIMARY KEY ( day, ref ) );
+        CREATE TABLE IF NOT EXISTS tags  ( day TEXT, ref INTEGER, class INTEGER, tag TEXT );
+        CREATE TABLE IF NOT EXISTS meta  ( key TEXT PRIMARY KEY, value REAL );
+        CREATE INDEX IF NOT EXISTS tasks_begin ON tasks ( begin );
+        CREATE INDEX IF NOT EXISTS tasks_end   ON tasks ( end );
+        CREATE INDEX IF NOT EXISTS tags_tag    ON tags ( class, tag );
+        CREATE INDEX IF NOT EXISTS tags_task   ON tags ( day, ref );
+    """
+
+    def __init__( self, parser, path=None ):
+        """
+        Open (creating if needed) the store at path. Tags are parsed from
+        task bodies by parser.
+        """
+        self.path = path or HISTORY_PATH
+        self._parser = parser
+        directory = os.path.dirname( self.path )
+        if not os.path.exists( directory ):
+            os.makedirs( directory )
+        self._db = sqlite3.connect( self.path )
+        self._db.executescript( WtfdmdgHistoryStore.SCHEMA )
+        row = self._db.execute( "SELECT value FROM meta WHERE key = 'maxDuration'" ).fetchone()
+        self._maxDuration = 0 if row is None else row[0]
+
+    def close( self ):
+        self._db.close()
+
+    @profiled( "WtfdmdgHistoryStore.putDay" )
+    def putDay( self, day, session, mtime=None ):
+        """
+        Replace everything stored for day (a datetime.date) with session
+        """
+        day = day.isoformat()
+        with self._db:
+            self._db.execute( "DELETE FROM tasks WHERE day = ?", ( day, ) )
+            self._db.execute( "DELETE FROM tags WHERE day = ?", ( day, ) )
+            self._insertTasks( day, session.values() )
+            self._db.execute( "INSERT OR REPLACE INTO days VALUES ( ?, ? )", ( day, mtime ) )
+
+    @profiled( "WtfdmdgHistoryStore.putChanges" )
+    def putChanges( self, day, changes, directory=None ):
+        """
+        Put the tasks of day recorded by the WtfdmdgChangeSet changes since
+        the last call, once they have reached the day's files in directory
+        (APPDATA_DIR by default), leaving its other tasks alone. If the day
+        was last stored by anything else it may be missing changes made
+        elsewhere, so it is read back whole from its files instead.
+        """
+        tasks, refs = changes.take()
+        journal = WtfdmdgJournal( DAY_PATH( day, directory ) )
+        mtime = journal.getModifiedTime()
+        # With no changes the mtime may still need noting, if the last call
+        # took changes which had yet to reach the files
+        if len( tasks ) + len( refs ) == 0 and mtime == changes.mtime:
+            return
+        key = day.isoformat()
+        row = self._db.execute( "SELECT mtime FROM days WHERE day = ?", ( key, ) ).fetchone()
+        if changes.mtime is None or row is None or row[0] != changes.mtime:
+            self.putDay( day, journal.read(), mtime )
+        else:
+            with self._db:
+                for ref in itertools.chain( refs, ( task.ref for task in tasks ) ):
+                    self._db.execute( "DELETE FROM tasks WHERE day = ? AND ref = ?", ( key, ref ) )
+                    self._db.execute( "DELETE FROM tags WHERE day = ? AND ref = ?", ( key, ref ) )
+                self._insertTasks( key, tasks )
+                self._db.execute( "UPDATE days SET mtime = ? WHERE day = ?", ( mtime, key ) )
+        changes.mtime = mtime
+
+    def _insertTasks( self, day, tasks ):
+        maxDuration = self._maxDuration
+        for task in tasks:
+            self._db.execute( "INSERT INTO tasks VALUES ( ?, ?, ?, ?, ? )",
+                              ( day, task.ref, self._encodeTime( task.begin ), self._encodeTime( task.end ), task.body ) )
+            tags = {} if task.body is None else self._parser.getTaskTags( task.body )
+            self._db.executemany( "INSERT INTO tags VALUES ( ?, ?, ?, ? )",
+                                  [ ( day, task.ref, cls, tag ) for cls in tags for tag in tags[ cls ] ] )
+            if task.begin is not None and task.end is not None:
+                maxDuration = max( maxDuration, ( task.end - task.begin ).total_seconds() )
+        if maxDuration != self._maxDuration:
+            self._maxDuration = maxDuration
+            self._db.execute( "INSERT OR REPLACE INTO meta VALUES ( 'maxDuration', ? )", ( maxDuration, ) )
+
+    def getTasks( self, begin, end, tagclass=None, tag=None ):
+        """
+        Return a list of ( day, task ) for closed tasks overlapping the time
+        range from begin to end, optionally only those carrying tag in
+        tagclass, ordered by begin time.
+        """
+        # Bounding begin from below lets the begin index do the work
+        earliest = begin - datetime.timedelta( seconds=self._maxDuration )
+        query = "SELECT t.day, t.ref, t.begin, t.end, t.body FROM tasks t"
+        args = []
+        if tag is not None:
+            query += " JOIN tags g ON g.day = t.day AND g.ref = t.ref AND g.class = ? AND g.tag = ?"
+            args += [ tagclass, tag.lower() ]
+        query += " WHERE t.begin >= ? AND t.begin < ? AND t.end > ? ORDER BY t.begin"
+        args += [ self._encodeTime( earliest ), self._encodeTime( end ), self._encodeTime( begin ) ]
+        return [ ( datetime.date.fromisoformat( day ),
+                   Task( ref, self._decodeTime( b ), self._decodeTime( e ), body ) )
+                 for day, ref, b, e, body in self._db.execute( query, args ) ]
+
+    def importDayFiles( self, directory=None ):
+        """
+        Load every day file under directory (APPDATA_DIR by default) which is
+        new or has changed since it was last imported. Return the number of
+        days imported.
+        """
+        directory = directory or APPDATA_DIR
+        known = dict( self._db.execute( "SELECT day, mtime FROM days" ) )
+        n = 0
+        for day in listDays( directory ):
+            journal = WtfdmdgJournal( DAY_PATH( day, directory ) )
+            mtime = journal.getModifiedTime()
+            if known.get( day.isoformat() ) == mtime:
+                continue
+            self.putDay( day, journal.read(), mtime )
+            n += 1
+        return n
+
+    def _encodeTime( self, dt ):
+        if dt is None:
+            return None
+        return datetime.datetime.strftime( dt, WtfdmdgHistoryStore.TIME_FORMAT )
+
+    def _decodeTime( self, string ):
+        if string is None:
+            return None
+        return datetime.datetime.strptime( string, WtfdmdgHistoryStore.TIME_FORMAT )
+
+class WtfdmdgCommandParserInterface( object ):
+
+    def getCommandLineHighlighter( self, document ):
+        """
+        Return a QSyntaxHighlighter
+        """
+        raise NotImplementedError
+
+    def getTagBankHighlighter( self, document ):
+        """
+        Return a QSyntaxHighlighter
+        """
+        raise NotImplementedError
+
+    def getTagBankFormats( self, tagclass, text ):
+        """
+        Return a list of QTextLayout.FormatRange for text, the tags of
+        tagclass separated by spaces
+        """
+        raise NotImplementedError
+
+    def execute( self, session, line, indexes=(), day=None ):
+        """
+        Evaluate line and execute against session, keeping each of indexes
+        (objects with put( task ) and remove( ref ), such as
+        WtfdmdgTaskIndex) up to date. Times in line are on day (a
+        datetime.date, today by default), the day session holds.
+        """
+        raise NotImplementedError
+
+    def getTaskTags( self, body ):
+        """
+        Return a dict mapping tag class to a list of tags, given
+        the body of a task.
+        """
+        raise NotImplementedError
+
+    def encodeTask( self, task ):
+        """
+        Return a command string that yields this task exactly
+        """
+        raise NotImplementedError
+
+class WtfdmdgBaseCommandParser( WtfdmdgCommandParserInterface ):
+    """
+    The default command syntax, without any of the Qt specific pieces, so
+    that commands can be executed headless.
+    """
+
+    REF   = r"(?:(?P<ref>(?:\d+)|\*):)?"
+    BODY  = r"(?:(?P<body>.+))?"
+    TIME  = r"(?:\d+)|n"
+    BEGIN = r"(?:(?P<begin>" + TIME + "))?"
+    END   = r"(?:(?P<end>" + TIME + "))?"
+    TAG   = r"(/+)(\S+)"
+
+    TAG_REGEX     = re.compile( TAG )
+    LINE_REGEX    = re.compile( REF + BEGIN + "-?" + END + "\.?" + BODY )
+    TAGBANK_REGEX = re.compile( r"\S+" )
+
+    PARSE_CACHE_SIZE = 64
+
+    def __init__( self ):
+        # Highlighting, task selection and execution all parse the same
+        # line, so remember recent parses by line text
+        self._parseCache = collections.OrderedDict()
+
+    @profiled( "execute" )
+    def execute( self, tasks, line, indexes=(), day=None ):
+        ref, begin, end, body = self._getParts( line )
+        begin = self._getDatetime( begin, day )
+        end = self._getDatetime( end, day )
+        if all( x is None for x in [ ref, begin, end, body ] ):
+            print( "NOP" )
+        elif ref is not None and all( x is None for x in ( begin, end, body ) ):
+            if ref != "*":
+                del tasks[ int( ref ) ]
+                for index in indexes:
+                    index.remove( int( ref ) )
+        elif ( ref is None or int( ref ) not in tasks ) and any( x is not None for x in [ begin, end, body ] ):
+            if body is None:
+                # New tasks must always have body
+                print( "NOP" )
+            else:
+                ref = int( ref or self._generateTaskId( tasks, indexes ) )
+                self._putTask( tasks, indexes, Task( ref, begin, end, body ) )
+        elif ref != "*":
+            a, b, c, d = tasks[ int( ref ) ]
+            if begin is not None:
+                b = begin
+            if end is not None:
+                c = end
+            if body is not None:
+                d = body
+            self._putTask( tasks, indexes, Task( a, b, c, d ) )
+
+    def _putTask( self, tasks, indexes, task ):
+        tasks[ task.ref ] = task
+        for index in indexes:
+            index.put( task )
+
+    def _generateTaskId( self, tasks, indexes ):
+        for index in indexes:
+            if isinstance( index, WtfdmdgTaskIndex ):
+                return index.nextRef()
+        return max( tasks.keys(), default=-1 ) + 1
+
+    def getTaskTags( self, body ):
+        tagtable = {}
+        for tagmatch in WtfdmdgBaseCommandParser.TAG_REGEX.findall( body ):
+            tagclass = len( tagmatch[0] )
+            tagtext = tagmatch[1].lower()
+            if tagclass not in tagtable:
+                tagtable[ tagclass ] = []
+            if tagtext not in tagtable[ tagclass ]:
+                tagtable[ tagclass ].append( tagtext )
+        return tagtable
+
+    def _parse( self, line ):
+        """
+        Match line, returning ( parts, ranges ), or None if it doesn't match.
+        Results for recently seen lines are cached.
+        """
+        cache = self._parseCache
+        if line in cache:
+            cache.move_to_end( line )
+            return cache[ line ]
+        m = WtfdmdgBaseCommandParser.LINE_REGEX.match( line )
+        if m is None:
+            result = None
+        else:
+            groups = ( "ref", "begin", "end", "body" )
+            result = ( tuple( m.group( x ) for x in groups ), tuple( m.span( x ) for x in groups ) )
+        cache[ line ] = result
+        if len( cache ) > WtfdmdgBaseCommandParser.PARSE_CACHE_SIZE:
+            cache.popitem( last=False )
+        return result
+
+    def _getParts( self, line ):
+        result = self._parse( line )
+        if result is None:
+            return None
+        return result[0]
+
+    def _getRanges( self, line ):
+        result = self._parse( line )
+        if result is None:
+            return None
+        return result[1]
+
+    def _getTagBankRanges( self, line ):
+        return [ m.span() for m in WtfdmdgBaseCommandParser.TAGBANK_REGEX.finditer( line ) ]
+
+    def _getDatetime( self, string, day=None ):
+        """
+        Parse a time of day, or "n" for now, into a datetime on day (today
+        by default)
+        """
+        if string is None:
+            return None
+        day = day or datetime.date.today()
+        if string == "n":
+            now = datetime.datetime.now()
+            return datetime.datetime.combine( day, now.time() ).replace( second=0, microsecond=0 )
+        if string.isdigit():
+            if len( string ) <= 2:
+                hr = int( string )
+                mn = 0
+            else:
+                mn = int( string[-2:] )
+                hr = int( string[ :-2 ] )
+            return datetime.datetime.combine( day, datetime.time( hr, mn ) )
+        assert( False )
+        return None
+
+    def encodeTask( self, task ):
+        text = ""
+        if task.ref is not None:
+            text += str( task.ref ) + ":"
+        if task.begin is not None:
+            text += datetime.datetime.strftime( task.begin, "%H%M" )
+        if task.end is not None:
+            text += "-" + datetime.datetime.strftime( task.end, "%H%M" )
+        if task.body is not None:
+            text += "." + task.body
+        return text
+
+def diffSessions( old, new ):
+    """
+    Compare two sessions by ref. Return ( tasks, refs ), the tasks of new
+    which are not in old as they are, and the refs of old not in new.
+    """
+    tasks = [ task for ref, task in new.items() if old.get( ref ) != task ]
+    refs = [ ref for ref in old if ref not in new ]
+    return tasks, refs
+
+def applyChanges( session, tasks, refs, indexes=() ):
+    """
+    Remove refs from session, then put tasks, keeping indexes up to date.
+    Refs not in session are ignored.
+    """
+    for ref in refs:
+        if ref in session:
+            del session[ ref ]
+            for index in indexes:
+                index.remove( ref )
+    for task in tasks:
+        session[ task.ref ] = task
+        for index in indexes:
+            index.put( task )
+
+def executeTransaction( parser, session, lines, indexes=(), day=None ):
+    """
+    Execute command lines against session, the tasks of day (today by
+    default), as a single transaction: either every line applies, or none
+    do and session and indexes are untouched. Lines run against a copy of
+    session, then only the tasks which ended up added, changed or removed
+    are applied to session and indexes. Raise ValueError naming the first
+    line which could not be executed. Return the number of tasks touched.
+    """
+    working = dict( session )
+    for lineno, line in enumerate( lines, 1 ):
+        if len( line.strip() ) == 0:
+            continue
+        try:
+            parser.execute( working, line, day=day )
+        except ( KeyError, ValueError, AssertionError ) as e:
+            raise ValueError( "line {}: cannot execute {!r} ({!r})".format( lineno, line, e ) ) from e
+    removed = [ ref for ref in session if ref not in working ]
+    changed = [ task for ref, task in working.items() if session.get( ref ) is not task ]
+    for ref in removed:
+        del session[ ref ]
+        for index in indexes:
+            index.remove( ref )
+    for task in changed:
+        session[ task.ref ] = task
+        for index in indexes:
+            index.put( task )
+    return len( removed ) + len( changed )
+
+def runBatch( lines, day=None, parser=None ):
+    """
+    Apply command lines to the session for day (a datetime.date, today by
+    default) without any GUI, then persist once at the end. Lines which
+    fail to execute are reported on stderr and skipped. Return the session.
+    """
+    day = day or datetime.date.today()
+    parser = parser or WtfdmdgBaseCommandParser()
+    journal = WtfdmdgJournal( FILE_PATH( day ) )
+    session = journal.load()
+    index = WtfdmdgTaskIndex( session )
+    for lineno, line in enumerate( lines, 1 ):
+        line = line.rstrip( "\r\n" )
+        if len( line.strip() ) == 0:
+            continue
+        try:
+            parser.execute( session, line, ( index, ), day )
+        except ( KeyError, ValueError, AssertionError ) as e:
+            sys.stderr.write( "line {}: cannot execute {!r} ({!r})\n".format( lineno, line, e ) )
+    # Write the snapshot here and now, whatever state earlier runs left
+    journal.fold( session )
+    journal.close()
+    store = WtfdmdgHistoryStore( parser )
+    store.putDay( day, session )
+    store.close()
+    return session
+
+def parseDate( string ):
+    """
+    Parse a YYYY-MM-DD date for the command line
+    """
+    try:
+        return datetime.datetime.strptime( string, "%Y-%m-%d" ).date()
+    except ValueError:
+        raise argparse.ArgumentTypeError( "not a YYYY-MM-DD date: {!r}".format( string ) )
+
+def parseArgs( argv ):
+    """
+    Parse command line arguments. Return ( args, remaining ), where
+    remaining is left for Qt.
+    """
+    argParser = argparse.ArgumentParser( description="Where did my day go?" )
+    argParser.add_argument( "--batch", action="store_true",
+                            help="execute command lines read from stdin without the GUI, then exit" )
+    argParser.add_argument( "--migrate-history", action="store_true",
+                            help="import all day files into the history store, then exit" )
+    argParser.add_argument( "--serve", action="store_true",
+                            help="run a session server, which the GUI and --batch then go through, until interrupted" )
+    argParser.add_argument( "--standalone", action="store_true",
+                            help="read and write day files directly, even if a session server is running" )
+    argParser.add_argument( "--startup-time", action="store_true",
+                            help="print how long each phase of GUI startup took" )
+    argParser.add_argument( "--report", choices=( "day", "week", "month" ),
+                            help="print time spent per tag, per day, week or month, over all history, then exit" )
+    argParser.add_argument( "--export", metavar="PATH",
+                            help="export tasks from all history to PATH (- for stdout), then exit" )
+    argParser.add_argument( "--format", choices=( "csv", "jsonl", "npz" ),
+                            help="format for --export, by default from the extension of PATH" )
+    argParser.add_argument( "--workers", type=int, default=1,
+                            help="worker processes to load day files for --report with, for years of history (default 1)" )
+    argParser.add_argument( "--tag-class", type=int, default=1,
+                            help="tag class to report on, as its number of slashes (default 1)" )
+    argParser.add_argument( "--since", type=parseDate, help="first day to report on or export, as YYYY-MM-DD" )
+    argParser.add_argument( "--until", type=parseDate, help="last day to report on or export, as YYYY-MM-DD" )
+    argParser.add_argument( "--profile", nargs="?", const="timings", choices=WtfdmdgProfiler.MODES,
+                            help="time the hot paths and print a summary at exit (or on F12); "
+                                 "\"cprofile\" also captures a cProfile. Same as setting WTFDMDG_PROFILE" )
+    args, remaining = argParser.parse_known_args( argv[1:] )
+    if args.export:
+        import wtfdmdg_export
+        try:
+            wtfdmdg_export.getFormat( args.export, args.format )
+        except ValueError as e:
+            argParser.error( "--export: {}".format( e ) )
+    return args, remaining
+
+def connectServer( args, onChange=None ):
+    """
+    Connect to the session server, unless args ask to run standalone. Return
+    a wtfdmdg_daemon.WtfdmdgSessionClient, or None if no server is running.
+    """
+    if args.standalone or not os.path.exists( SOCKET_PATH ):
+        return None
+    import wtfdmdg_daemon
+    return wtfdmdg_daemon.connect( SOCKET_PATH, onChange )
+
+def runHeadless( args ):
+    """
+    Run the headless mode requested by args. Return an exit code, or None
+    if no headless mode was requested and the GUI should start. Profiling,
+    if requested, is enabled either way.
+    """
+    if args.profile:
+        profiler.enable( args.profile )
+    if args.migrate_history:
+        store = WtfdmdgHistoryStore( WtfdmdgBaseCommandParser() )
+        print( "Imported {} day(s) into {}".format( store.importDayFiles(), store.path ) )
+        store.close()
+        return 0
+    if args.serve:
+        import wtfdmdg_daemon
+        return wtfdmdg_daemon.serve()
+    if args.batch:
+        client = connectServer( args )
+        if client is None:
+            runBatch( sys.stdin )
+        else:
+            import wtfdmdg_daemon
+            wtfdmdg_daemon.runBatch( client, sys.stdin )
+            client.close()
+        return 0
+    if args.export:
+        import wtfdmdg_export
+        n = wtfdmdg_export.export( args.export, args.format, args.since, args.until )
+        if n is not None:
+            sys.stderr.write( "Exported {} task(s)\n".format( n ) )
+        return 0
+    if args.report:
+        import wtfdmdg_report
+        print( wtfdmdg_report.makeReport( args.tag_class, args.report, args.since, args.until, workers=args.workers ).format() )
+        return 0
+    return None
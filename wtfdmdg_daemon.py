@@ -0,0 +1,395 @@
+#
+# wtfdmdg_daemon.py
+#
+# An optional session server. One process owns the sessions and persists
+# them, and any number of clients (the GUI, --batch, scripts) send it
+# command lines and queries over a Unix domain socket. Every change is
+# pushed to the other clients, so they never reload and never clobber
+# one another's writes.
+#
+# The protocol is one JSON object per line. A request carries an "id" and
+# an "op", and is answered by an object with the same "id" and "ok". Change
+# notifications carry an "event" instead.
+#
+
+import os
+import sys
+import json
+import signal
+import socket
+import asyncio
+import datetime
+import itertools
+import threading
+
+from wtfdmdg_core import ( Task, SOCKET_PATH, DAY_PATH, WtfdmdgJournal, WtfdmdgDayCache, WtfdmdgHistoryStore,
+                           WtfdmdgBackgroundWriter, WtfdmdgDeferredIndex, WtfdmdgChangeSet, WtfdmdgBaseCommandParser,
+                           executeTransaction, applyChanges )
+
+class WtfdmdgRemoteError( ValueError ):
+    """
+    A request was refused by the session server, or the server went away.
+    A ValueError, like executeTransaction's, so callers handle both alike.
+    """
+    pass
+
+def encodeTask( task ):
+    return [ task.ref,
+             None if task.begin is None else task.begin.isoformat(),
+             None if task.end is None else task.end.isoformat(),
+             task.body ]
+
+def decodeTask( record ):
+    ref, begin, end, body = record
+    return Task( ref,
+                 None if begin is None else datetime.datetime.fromisoformat( begin ),
+                 None if end is None else datetime.datetime.fromisoformat( end ),
+                 body )
+
+def decodeDay( string ):
+    return datetime.date.fromisoformat( string )
+
+class _Changes( object ):
+    """
+    Index recording the tasks put and refs removed by a transaction
+    """
+
+    def __init__( self ):
+        self.tasks = []
+        self.refs = []
+
+    def put( self, task ):
+        self.tasks.append( task )
+
+    def remove( self, ref ):
+        self.refs.append( ref )
+
+class WtfdmdgSessionServer( object ):
+    """
+    Owns the session of every day a client asks for, along with its indexes,
+    and applies command lines from clients to them. Days are read through a
+    WtfdmdgDayCache, and edits are journaled on a background writer, just
+    as the GUI does on its own.
+    """
+
+    def __init__( self, parser=None, path=None, directory=None ):
+        """
+        Initialize server listening at path (SOCKET_PATH by default) for days
+        with files in directory (APPDATA_DIR by default)
+        """
+        self._parser = parser or WtfdmdgBaseCommandParser()
+        self.path = path or SOCKET_PATH
+        self._directory = directory
+        self._cache = WtfdmdgDayCache( self._parser, directory=directory )
+        self._writer = WtfdmdgBackgroundWriter()
+        self._edited = {}       # Date to held cache entry, journal and history changes, of each day edited
+        self._historyStore = None
+        self._clients = set()   # StreamWriter of each connected client
+        self._server = None
+
+    async def start( self ):
+        """
+        Start listening. Raise RuntimeError if another server is listening.
+        """
+        if os.path.exists( self.path ):
+            client = connect( self.path )
+            if client is not None:
+                client.close()
+                raise RuntimeError( "a session server is already listening at {}".format( self.path ) )
+            # Left behind by a server which did not shut down
+            os.remove( self.path )
+        directory = os.path.dirname( self.path )
+        if not os.path.exists( directory ):
+            os.makedirs( directory )
+        self._server = await asyncio.start_unix_server( self._serveClient, path=self.path )
+        os.chmod( self.path, 0o600 )
+
+    async def serveForever( self ):
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close( self ):
+        """
+        Stop listening, drop every client, and write out and close everything
+        """
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists( self.path ):
+                os.remove( self.path )
+        for client in list( self._clients ):
+            client.close()
+        for _, journal, _ in self._edited.values():
+            self._writer.submit( None, journal.close )
+        self._writer.submit( None, self._closeHistory )
+        self._writer.close()
+        self._cache.close()
+
+    async def _serveClient( self, reader, writer ):
+        self._clients.add( writer )
+        try:
+            while True:
+                line = await reader.readline()
+                if len( line ) == 0:
+                    break
+                response = await self._respond( line, writer )
+                writer.write( json.dumps( response ).encode( "utf-8" ) + b"\n" )
+                await writer.drain()
+        except ( ConnectionError, asyncio.IncompleteReadError ):
+            pass
+        finally:
+            self._clients.discard( writer )
+            writer.close()
+
+    async def _respond( self, line, client ):
+        """
+        Answer one request line from client
+        """
+        request = {}
+        try:
+            request = json.loads( line )
+            op = getattr( self, "_op_" + request[ "op" ], None )
+            if op is None:
+                raise ValueError( "unknown op {!r}".format( request[ "op" ] ) )
+            result = await op( request, client )
+        except ( KeyError, ValueError, TypeError ) as e:
+            return { "id" : request.get( "id" ), "ok" : False, "error" : str( e ) }
+        result.update( id=request.get( "id" ), ok=True )
+        return result
+
+    async def _getDay( self, day ):
+        """
+        Get the cache entry for day, reading it off the event loop if needed
+        """
+        if day in self._edited:
+            return self._edited[ day ][0]
+        entry = await asyncio.get_running_loop().run_in_executor( None, self._cache.get, day )
+        # The day may have been edited while it was being read
+        return self._edited[ day ][0] if day in self._edited else entry
+
+    async def _op_session( self, request, client ):
+        """
+        Answer with every task of a day
+        """
+        entry = await self._getDay( decodeDay( request[ "day" ] ) )
+        return { "tasks" : [ encodeTask( t ) for t in entry.session.values() ] }
+
+    async def _op_execute( self, request, client ):
+        """
+        Run command lines against a day as one transaction
+        """
+        return await self._edit( request, client,
+                                 lambda session, indexes: executeTransaction( self._parser, session, request[ "lines" ], indexes,
+                                                                              decodeDay( request[ "day" ] ) ) )
+
+    async def _op_apply( self, request, client ):
+        """
+        Put and remove exactly the tasks given, as undo and redo do
+        """
+        tasks = [ decodeTask( t ) for t in request[ "put" ] ]
+        return await self._edit( request, client,
+                                 lambda session, indexes: applyChanges( session, tasks, request[ "removed" ], indexes ) )
+
+    async def _edit( self, request, client, change ):
+        """
+        Call change( session, indexes ) on the session of the request's day,
+        save what it changed, and tell every other client
+        """
+        day = decodeDay( request[ "day" ] )
+        entry = await self._getDay( day )
+        if day not in self._edited:
+            # From now on this process edits the day, so its entry is held
+            self._cache.hold( entry )
+            self._edited[ day ] = ( entry, WtfdmdgJournal( DAY_PATH( day, self._directory ) ), WtfdmdgChangeSet() )
+            self._writer.submit( None, self._edited[ day ][1].load )
+        _, journal, historyChanges = self._edited[ day ]
+        changes = _Changes()
+        change( entry.session, ( entry.taskIndex, entry.tagIndex, WtfdmdgDeferredIndex( self._writer, journal ),
+                                 historyChanges, changes ) )
+        self._writer.submit( ( "compact", day ), journal.compactIfNeeded, dict( entry.session ) )
+        self._writer.submit( ( "history", day ), self._putHistory, day )
+
+        result = { "put" : [ encodeTask( t ) for t in changes.tasks ], "removed" : changes.refs }
+        if len( changes.tasks ) + len( changes.refs ) > 0:
+            event = dict( result, event="changed", day=request[ "day" ] )
+            message = json.dumps( event ).encode( "utf-8" ) + b"\n"
+            for other in self._clients:
+                if other is not client:
+                    other.write( message )
+        return result
+
+    def _putHistory( self, day ):
+        if self._historyStore is None:
+            self._historyStore = WtfdmdgHistoryStore( self._parser )
+        self._historyStore.putChanges( day, self._edited[ day ][2], self._directory )
+
+    def _closeHistory( self ):
+        if self._historyStore is not None:
+            self._historyStore.close()
+            self._historyStore = None
+
+class WtfdmdgSessionClient( object ):
+    """
+    Connection to a session server. Requests block until answered. Changes
+    made by other clients are handed to onChange( day, tasks, refs ), on the
+    client's reader thread, with the tasks put and the refs removed. If the
+    server goes away, onClose() is called, on the same thread.
+    """
+
+    def __init__( self, sock, onChange=None, onClose=None ):
+        """
+        Initialize client over a connected socket
+        """
+        self.onChange = onChange
+        self.onClose = onClose
+        self._socket = sock
+        self._file = sock.makefile( "rb" )
+        self._ids = itertools.count()
+        self._pending = {}      # Request id to [ threading.Event, response ]
+        self._lock = threading.Lock()
+        self._closed = False
+        self._closing = False
+        self._thread = threading.Thread( target=self._run, name="wtfdmdg client", daemon=True )
+        self._thread.start()
+
+    def request( self, op, **args ):
+        """
+        Send a request and wait for its answer. Raise WtfdmdgRemoteError if
+        it is refused, or if the server goes away.
+        """
+        waiter = [ threading.Event(), None ]
+        with self._lock:
+            if self._closed:
+                raise WtfdmdgRemoteError( "not connected to the session server" )
+            requestId = next( self._ids )
+            try:
+                self._socket.sendall( json.dumps( dict( args, op=op, id=requestId ) ).encode( "utf-8" ) + b"\n" )
+            except OSError as e:
+                raise WtfdmdgRemoteError( "lost the connection to the session server ({})".format( e ) ) from e
+            self._pending[ requestId ] = waiter
+        waiter[0].wait()
+        response = waiter[1]
+        if response is None:
+            raise WtfdmdgRemoteError( "lost the connection to the session server" )
+        if not response[ "ok" ]:
+            raise WtfdmdgRemoteError( response[ "error" ] )
+        return response
+
+    def getSession( self, day ):
+        """
+        Get the session for day, as a dict mapping ref to task
+        """
+        response = self.request( "session", day=day.isoformat() )
+        return { t.ref : t for t in map( decodeTask, response[ "tasks" ] ) }
+
+    def execute( self, day, lines ):
+        """
+        Run command lines against the session for day as one transaction.
+        Return ( tasks, refs ), the tasks put and the refs removed.
+        """
+        response = self.request( "execute", day=day.isoformat(), lines=list( lines ) )
+        return [ decodeTask( t ) for t in response[ "put" ] ], response[ "removed" ]
+
+    def apply( self, day, tasks, refs ):
+        """
+        Remove refs from the session for day and put tasks, as one
+        transaction. Return ( tasks, refs ) as for execute.
+        """
+        response = self.request( "apply", day=day.isoformat(), put=[ encodeTask( t ) for t in tasks ], removed=list( refs ) )
+        return [ decodeTask( t ) for t in response[ "put" ] ], response[ "removed" ]
+
+    def isConnected( self ):
+        """
+        Return whether the server can still be reached
+        """
+        with self._lock:
+            return not self._closed
+
+    def close( self ):
+        self._closing = True
+        try:
+            self._socket.shutdown( socket.SHUT_RDWR )
+        except OSError:
+            pass
+        self._thread.join()
+        self._socket.close()
+
+    def _run( self ):
+        try:
+            for line in self._file:
+                message = json.loads( line )
+                if "event" in message:
+                    if self.onChange is not None:
+                        self.onChange( decodeDay( message[ "day" ] ), [ decodeTask( t ) for t in message[ "put" ] ],
+                                       message[ "removed" ] )
+                    continue
+                with self._lock:
+                    waiter = self._pending.pop( message[ "id" ], None )
+                if waiter is not None:
+                    waiter[1] = message
+                    waiter[0].set()
+        except ( OSError, ValueError ):
+            pass
+        finally:
+            # Wake anyone still waiting, with no answer
+            with self._lock:
+                self._closed = True
+                pending = list( self._pending.values() )
+                self._pending = {}
+            for waiter in pending:
+                waiter[0].set()
+            if not self._closing and self.onClose is not None:
+                self.onClose()
+
+def connect( path=None, onChange=None ):
+    """
+    Connect to the session server at path (SOCKET_PATH by default). Return
+    a WtfdmdgSessionClient, or None if no server is listening.
+    """
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        sock.connect( path or SOCKET_PATH )
+    except ( FileNotFoundError, ConnectionRefusedError ):
+        sock.close()
+        return None
+    return WtfdmdgSessionClient( sock, onChange )
+
+def runBatch( client, lines, day=None ):
+    """
+    Like wtfdmdg_core.runBatch, but through a session server. Each line is
+    its own transaction, so failing lines are reported on stderr and skipped.
+    """
+    day = day or datetime.date.today()
+    for lineno, line in enumerate( lines, 1 ):
+        line = line.rstrip( "\r\n" )
+        if len( line.strip() ) == 0:
+            continue
+        try:
+            client.execute( day, [ line ] )
+        except WtfdmdgRemoteError as e:
+            sys.stderr.write( "line {}: {}\n".format( lineno, e ) )
+
+def serve( path=None, directory=None ):
+    """
+    Run a session server until interrupted. Return an exit code.
+    """
+    async def run():
+        server = WtfdmdgSessionServer( path=path, directory=directory )
+        try:
+            await server.start()
+        except RuntimeError as e:
+            sys.stderr.write( "{}\n".format( e ) )
+            return 1
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        for signum in ( signal.SIGINT, signal.SIGTERM ):
+            loop.add_signal_handler( signum, lambda: stopped.done() or stopped.set_result( None ) )
+        sys.stderr.write( "Serving sessions at {}\n".format( server.path ) )
+        serving = asyncio.ensure_future( server.serveForever() )
+        try:
+            await stopped
+        finally:
+            serving.cancel()
+            server.close()
+        return 0
+    return asyncio.run( run() )
@@ -0,0 +1,233 @@
+#
+# wtfdmdg_export.py
+#
+# Stream tasks out of the day files, for use by other tools. Only one day
+# is held in memory at a time, however much history is exported.
+#
+
+import os
+import sys
+import csv
+import json
+import zipfile
+import tempfile
+import datetime
+
+import numpy as np
+
+from wtfdmdg_core import APPDATA_DIR, DAY_PATH, listDays, WtfdmdgJournal, WtfdmdgBaseCommandParser, profiled
+
+FORMATS = ( "csv", "jsonl", "npz" )
+
+EPOCH = datetime.datetime( 1970, 1, 1 )
+
+def iterDays( begin=None, end=None, directory=None ):
+    """
+    Yield ( day, session ) for each day from begin to end inclusive
+    (datetime.date, unbounded if None) with files in directory, APPDATA_DIR
+    by default. Each session is read only when the previous one is done.
+    """
+    directory = directory or APPDATA_DIR
+    for day in listDays( directory ):
+        if ( begin is None or day >= begin ) and ( end is None or day <= end ):
+            yield day, WtfdmdgJournal( DAY_PATH( day, directory ) ).read()
+
+def iterTasks( days, parser=None ):
+    """
+    Yield ( day, task, tags ) for every task of the ( day, session ) pairs
+    in days, in order of ref within each day
+    """
+    parser = parser or WtfdmdgBaseCommandParser()
+    for day, session in days:
+        for ref in sorted( session ):
+            task = session[ ref ]
+            yield day, task, {} if task.body is None else parser.getTaskTags( task.body )
+
+def getEpochSeconds( dt ):
+    """
+    Get wall clock seconds since EPOCH of dt, or NaN for None
+    """
+    if dt is None:
+        return float( "nan" )
+    return ( dt - EPOCH ).total_seconds()
+
+def formatTags( tags ):
+    return " ".join( "/" * cls + tag for cls in sorted( tags ) for tag in tags[ cls ] )
+
+def exportCsv( records, f ):
+    """
+    Write ( day, task, tags ) records to text file f as CSV. Return the
+    number of tasks written.
+    """
+    writer = csv.writer( f )
+    writer.writerow( ( "day", "ref", "begin", "end", "seconds", "body", "tags" ) )
+    n = 0
+    for day, task, tags in records:
+        seconds = None if task.begin is None or task.end is None else ( task.end - task.begin ).total_seconds()
+        writer.writerow( ( day.isoformat(), task.ref,
+                           "" if task.begin is None else task.begin.isoformat(),
+                           "" if task.end is None else task.end.isoformat(),
+                           "" if seconds is None else seconds,
+                           "" if task.body is None else task.body,
+                           formatTags( tags ) ) )
+        n += 1
+    return n
+
+def exportJsonl( records, f ):
+    """
+    Write ( day, task, tags ) records to text file f as JSON Lines, one
+    object per task. Return the number of tasks written.
+    """
+    n = 0
+    for day, task, tags in records:
+        f.write( json.dumps( {
+            "day"   : day.isoformat(),
+            "ref"   : task.ref,
+            "begin" : None if task.begin is None else task.begin.isoformat(),
+            "end"   : None if task.end is None else task.end.isoformat(),
+            "body"  : task.body,
+            "tags"  : { str( cls ) : tags[ cls ] for cls in sorted( tags ) },
+        } ) )
+        f.write( "\n" )
+        n += 1
+    return n
+
+class _ColumnFile( object ):
+    """
+    A column of fixed width values, spooled to a temporary file as it grows
+    """
+
+    def __init__( self, directory, dtype ):
+        self.dtype = np.dtype( dtype )
+        self.length = 0
+        self.file = tempfile.TemporaryFile( dir=directory )
+
+    def extend( self, values ):
+        values = np.asarray( values, dtype=self.dtype )
+        self.file.write( values.tobytes() )
+        self.length += len( values )
+
+    def writeNpy( self, f ):
+        """
+        Write the column to f as a .npy file
+        """
+        np.lib.format.write_array_header_2_0( f, { "descr" : np.lib.format.dtype_to_descr( self.dtype ),
+                                                   "fortran_order" : False, "shape" : ( self.length, ) } )
+        self.file.seek( 0 )
+        while True:
+            chunk = self.file.read( 1 << 20 )
+            if len( chunk ) == 0:
+                break
+            f.write( chunk )
+        self.file.close()
+
+def exportNpz( records, path ):
+    """
+    Write ( day, task, tags ) records to path as a NumPy .npz of columns:
+
+        day            date ordinal of each task
+        ref, begin, end
+                       begin and end as wall clock seconds since 1970, NaN if unset
+        tag_offsets    tags of task i are tag_ids[ tag_offsets[ i ] : tag_offsets[ i + 1 ] ]
+        tag_ids        indexes into tag_classes and tag_names
+        body_offsets   body of task i is body_utf8[ body_offsets[ i ] : body_offsets[ i + 1 ] ]
+        body_utf8
+
+    Columns are spooled to temporary files as days go by, then copied into
+    the archive, so memory use does not grow with history. Return the
+    number of tasks written.
+    """
+    directory = os.path.dirname( os.path.abspath( path ) )
+    columns = { "day" : "i8", "ref" : "i8", "begin" : "f8", "end" : "f8",
+                "tag_offsets" : "i8", "tag_ids" : "i4", "body_offsets" : "i8", "body_utf8" : "u1" }
+    columns = { name : _ColumnFile( directory, dtype ) for name, dtype in columns.items() }
+    columns[ "tag_offsets" ].extend( [ 0 ] )
+    columns[ "body_offsets" ].extend( [ 0 ] )
+    tagIds = {}
+    tagCount = 0
+    bodyLength = 0
+
+    def flush( rows ):
+        rows[ "body_utf8" ] = np.frombuffer( b"".join( rows[ "body_utf8" ] ), dtype=np.uint8 )
+        for name, values in rows.items():
+            columns[ name ].extend( values )
+
+    rows = None
+    lastDay = None
+    for day, task, tags in records:
+        if day != lastDay:
+            # Write out a day's worth of rows at a time
+            if rows is not None:
+                flush( rows )
+            rows = { name : [] for name in columns }
+            lastDay = day
+        body = b"" if task.body is None else task.body.encode( "utf-8" )
+        bodyLength += len( body )
+        rows[ "day" ].append( day.toordinal() )
+        rows[ "ref" ].append( task.ref )
+        rows[ "begin" ].append( getEpochSeconds( task.begin ) )
+        rows[ "end" ].append( getEpochSeconds( task.end ) )
+        for cls in sorted( tags ):
+            for tag in tags[ cls ]:
+                rows[ "tag_ids" ].append( tagIds.setdefault( ( cls, tag ), len( tagIds ) ) )
+                tagCount += 1
+        rows[ "tag_offsets" ].append( tagCount )
+        rows[ "body_utf8" ].append( body )
+        rows[ "body_offsets" ].append( bodyLength )
+    if rows is not None:
+        flush( rows )
+
+    with zipfile.ZipFile( path, "w", zipfile.ZIP_STORED, allowZip64=True ) as archive:
+        for name, column in columns.items():
+            with archive.open( name + ".npy", "w", force_zip64=True ) as f:
+                column.writeNpy( f )
+        names = sorted( tagIds, key=tagIds.get )
+        for name, values in ( ( "tag_classes", np.array( [ cls for cls, _ in names ], dtype="i4" ) ),
+                              ( "tag_names", np.array( [ tag for _, tag in names ], dtype=str ) ) ):
+            with archive.open( name + ".npy", "w", force_zip64=True ) as f:
+                np.lib.format.write_array( f, values )
+    return columns[ "ref" ].length
+
+def getFormat( path, format=None ):
+    """
+    Get the format (one of FORMATS) to export to path in: format if given,
+    else guessed from path's extension. Raise ValueError if there is none.
+    """
+    if format is None:
+        if path == "-":
+            raise ValueError( "a format is needed to export to stdout" )
+        format = os.path.splitext( path )[1].lstrip( "." ).lower()
+    if format not in FORMATS:
+        raise ValueError( "cannot export to {!r}: unknown format {!r}, expected one of {}".format(
+                          path, format, ", ".join( FORMATS ) ) )
+    if format == "npz" and path == "-":
+        raise ValueError( "npz cannot be exported to stdout" )
+    return format
+
+@profiled( "export" )
+def export( path, format=None, begin=None, end=None, directory=None ):
+    """
+    Export tasks from the days between begin and end inclusive (unbounded
+    if None) to path, in format (one of FORMATS, by default guessed from
+    path's extension). A path of "-" writes to stdout, in a format which
+    must be given. Raise ValueError if the format is unknown. Return the
+    number of tasks exported, or None if stdout was closed before they all
+    were, as by | head.
+    """
+    format = getFormat( path, format )
+    records = iterTasks( iterDays( begin, end, directory ) )
+    if format == "npz":
+        return exportNpz( records, path )
+    write = exportCsv if format == "csv" else exportJsonl
+    if path == "-":
+        try:
+            n = write( records, sys.stdout )
+            sys.stdout.flush()
+            return n
+        except BrokenPipeError:
+            # Whatever is still buffered can never be written, so point
+            # stdout at devnull, or flushing it at exit would fail again
+            os.dup2( os.open( os.devnull, os.O_WRONLY ), sys.stdout.fileno() )
+            return None
+    with open( path, "w", newline="" if format == "csv" else None, encoding="utf-8" ) as f:
+        return write( records, f )
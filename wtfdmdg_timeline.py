@@ -0,0 +1,347 @@
+#
+# wtfdmdg_timeline.py
+#
+# The timeline plot. Kept apart from wtfdmdg.py because pyqtgraph is slow
+# to import, so the timeline is only loaded once the window is up.
+#
+# Shows either the current day's session, or a week or month of history
+# with a band per day. Days of history are read through the application's
+# day cache, in the background as they scroll into view, and the further
+# out the view is zoomed, the coarser the blocks drawn.
+#
+
+from PyQt5 import QtWidgets
+import pyqtgraph as pg
+
+pg.setConfigOption('background', 'w')
+pg.setConfigOption('foreground', 'k')
+
+import time
+import math
+import datetime
+import numpy as np
+
+from wtfdmdg_core import layoutTimeline, profiler, profiled, WtfdmdgTaskStore
+
+class WtfdmdgTimelineWidget( pg.PlotWidget ):
+
+    # Number of days shown by each span
+    SPANS = ( 1, 7, 31 )
+
+    # Most visible days drawn as individual tasks, then as hourly blocks.
+    # Any more are drawn as one block per tag per day.
+    TASK_DAYS = 10
+    HOUR_DAYS = 62
+
+    # Fraction of a day's band covered by its bars
+    DAY_WIDTH = 0.9
+
+    class DateAxis( pg.AxisItem ):
+
+        def __init__( self, *args, **kwargs ):
+            super( WtfdmdgTimelineWidget.DateAxis, self ).__init__( *args, **kwargs )
+            fnt = QtWidgets.QApplication.instance().font()
+            self.setStyle( tickFont=fnt )
+
+        def tickStrings( self, values, scale, spacing ):
+            strings = []
+            for v in values:
+                # vs is the original tick value
+                vs = v * scale
+                vstr = time.strftime( "%H:%M", time.gmtime( vs ) )
+                strings.append( vstr )
+            return strings
+
+    class DayAxis( pg.AxisItem ):
+        """
+        Labels the bands of the history view, where x is days from today
+        """
+
+        def __init__( self, *args, **kwargs ):
+            super( WtfdmdgTimelineWidget.DayAxis, self ).__init__( *args, **kwargs )
+            fnt = QtWidgets.QApplication.instance().font()
+            self.setStyle( tickFont=fnt )
+
+        def tickValues( self, minVal, maxVal, size ):
+            first = math.floor( minVal )
+            days = max( 1, int( math.ceil( maxVal ) ) - first )
+            step = max( 1, int( math.ceil( days * 60.0 / max( size, 1 ) ) ) )
+            center = WtfdmdgTimelineWidget.DAY_WIDTH / 2
+            return [ ( step, [ d + center for d in range( first, first + days + 1, step ) ] ) ]
+
+        def tickStrings( self, values, scale, spacing ):
+            today = datetime.date.today()
+            return [ ( today + datetime.timedelta( days=math.floor( v ) ) ).strftime( "%a %d" ) for v in values ]
+
+    def __init__( self ):
+        """
+        Initialize the timeline widget
+        """
+        ax = WtfdmdgTimelineWidget.DateAxis( orientation='left')
+        dayAx = WtfdmdgTimelineWidget.DayAxis( orientation='bottom' )
+        super( WtfdmdgTimelineWidget, self ).__init__( axisItems={'left': ax, 'bottom': dayAx } )
+        self._barGraphItem = pg.BarGraphItem( x0=[], x1=[], y0=[], y1=[] )
+        self.addItem( self._barGraphItem )
+        self._span = 1
+        self._palette = WtfdmdgTimelineWidget.Palette()
+        self._colors = QtWidgets.QApplication.instance().createTagColorCache( self._palette )
+        self.getViewBox().setMouseEnabled( False, False )
+        self.getViewBox().sigXRangeChanged.connect( self._onScroll )
+        self.hideAxis( 'bottom' )
+        self.invertY( True )
+
+    class Palette( object ):
+        """
+        Tags seen across the loaded days, in the shape of a WtfdmdgTagIndex
+        as far as WtfdmdgTagColorCache is concerned. Tags within a class are
+        kept sorted, so a tag keeps its color wherever the view scrolls.
+        """
+
+        def __init__( self ):
+            self._tagtable = {}
+            self._revisions = {}
+
+        def add( self, tagclass, tags ):
+            known = self._tagtable.setdefault( tagclass, [] )
+            new = set( tags ).difference( known )
+            if len( new ) > 0:
+                known.extend( new )
+                known.sort()
+                self._revisions[ tagclass ] = self._revisions.get( tagclass, 0 ) + 1
+
+        def getTagTable( self ):
+            return self._tagtable
+
+        def getClassRevision( self, tagclass ):
+            return self._revisions.get( tagclass, 0 )
+
+    def getSpan( self ):
+        """
+        Get the number of days shown
+        """
+        return self._span
+
+    def setSpan( self, days ):
+        """
+        Show the current day's session alone (days == 1), or the last days of history
+        """
+        self._span = days
+        vb = self.getViewBox()
+        if days == 1:
+            self.hideAxis( 'bottom' )
+            vb.setMouseEnabled( False, False )
+            vb.setLimits( xMin=None, xMax=None, minXRange=None, maxXRange=None )
+            vb.enableAutoRange()
+        else:
+            self.showAxis( 'bottom' )
+            vb.setMouseEnabled( True, False )
+            vb.setLimits( xMax=1, minXRange=1, maxXRange=366 )
+            vb.setXRange( 1 - days, 1, padding=0 )
+            vb.enableAutoRange( axis=pg.ViewBox.YAxis )
+        QtWidgets.QApplication.instance().invalidate( QtWidgets.QApplication.instance().VIEW_TIMELINE )
+
+    def cycleSpan( self ):
+        """
+        Switch to the next of SPANS
+        """
+        spans = WtfdmdgTimelineWidget.SPANS
+        self.setSpan( spans[ ( spans.index( self._span ) + 1 ) % len( spans ) ] if self._span in spans else spans[0] )
+
+    @profiled( "WtfdmdgTimelineWidget.redraw" )
+    def redraw( self ):
+        """
+        Plot everything. The bar item is updated in place, with geometry
+        computed for all tasks at once.
+        """
+        if self._span == 1:
+            self._redrawSession()
+        else:
+            self._redrawHistory()
+
+    def _redrawSession( self ):
+        tasks = [ x for x in QtWidgets.QApplication.instance().getSession().values() if x.begin is not None and x.end is not None ]
+
+        if len( tasks ) <= 0:
+            self._setBars( np.zeros( 0 ), np.zeros( 0 ), np.zeros( 0 ), np.zeros( 0 ), [] )
+            return
+
+        maxConcurrent, columnAssignments = layoutTimeline( tasks )
+        width = 1.0 / max( maxConcurrent, 1 )
+
+        # Draw in order of begin time
+        y0, y1 = self.getEpochSeconds( tasks )
+        order = np.argsort( y0, kind="stable" )
+        y0 = y0[ order ]
+        y1 = y1[ order ]
+        tasks = [ tasks[ i ] for i in order ]
+
+        x0 = np.fromiter( ( columnAssignments[ task ] for task in tasks ), dtype=float, count=len( tasks ) ) * width
+        x1 = x0 + width
+
+        self._setBars( x0, x1, y0, y1, [ self._getBrush( task ) for task in tasks ] )
+
+    def _redrawHistory( self ):
+        """
+        Plot the days in view which have been read, reading the rest in the
+        background. Depending on how many days are in view, draw tasks,
+        hourly blocks or daily blocks.
+        """
+        app = QtWidgets.QApplication.instance()
+        tagclass = app.getSelectedTagClass()
+        today = datetime.date.today()
+        lo, hi = self.getViewBox().viewRange()[0]
+        offsets = range( max( int( math.floor( lo ) ), -366 ), min( int( math.ceil( hi ) ), 1 ) )
+        if len( offsets ) <= WtfdmdgTimelineWidget.TASK_DAYS:
+            level = self._getTaskBars
+        elif len( offsets ) <= WtfdmdgTimelineWidget.HOUR_DAYS:
+            level = self._getHourBars
+        else:
+            level = self._getDayBars
+
+        parts = []
+        for offset in offsets:
+            day = self._getDay( today + datetime.timedelta( days=offset ) )
+            if day is not None and len( day[ "tasks" ] ) > 0:
+                parts.append( level( day, tagclass, offset ) )
+        profiler.count( "timeline days drawn", len( parts ) )
+        if len( parts ) == 0:
+            self._setBars( np.zeros( 0 ), np.zeros( 0 ), np.zeros( 0 ), np.zeros( 0 ), [] )
+            return
+        self._setBars( *[ np.concatenate( [ p[ i ] for p in parts ] ) for i in range( 4 ) ],
+                       [ b for p in parts for b in p[4] ] )
+
+    def _getTaskBars( self, day, tagclass, offset ):
+        store = day[ "tasks" ]
+        tasks = list( store )
+        maxConcurrent, columnAssignments = layoutTimeline( tasks )
+        width = WtfdmdgTimelineWidget.DAY_WIDTH / max( maxConcurrent, 1 )
+        x0 = offset + np.array( [ columnAssignments[ t ] for t in tasks ], dtype=float ) * width
+        brushes = [ self._colors.getBrush( tagclass, store.getTaskTags( i ).get( tagclass, [] ) ) for i in range( len( store ) ) ]
+        return x0, x0 + width, day[ "begins" ], day[ "ends" ], brushes
+
+    def _getHourBars( self, day, tagclass, offset ):
+        """
+        One block per tag per hour, as wide as the share of the hour spent
+        on that tag
+        """
+        names, hourly = self._getAggregate( day, tagclass )
+        widths = hourly / np.maximum( hourly.sum( axis=1 ), 3600.0 )[ :, None ] * WtfdmdgTimelineWidget.DAY_WIDTH
+        x1 = offset + np.cumsum( widths, axis=1 )
+        hours, tags = np.nonzero( hourly )
+        brushes = [ self._getTagBrush( tagclass, names[ t ] ) for t in tags ]
+        return x1[ hours, tags ] - widths[ hours, tags ], x1[ hours, tags ], hours * 3600.0, ( hours + 1 ) * 3600.0, brushes
+
+    def _getDayBars( self, day, tagclass, offset ):
+        """
+        One block per tag, spanning the working day, as wide as the share
+        of the day spent on that tag
+        """
+        names, hourly = self._getAggregate( day, tagclass )
+        daily = hourly.sum( axis=0 )
+        widths = daily / max( daily.sum(), 1e-9 ) * WtfdmdgTimelineWidget.DAY_WIDTH
+        x1 = offset + np.cumsum( widths )
+        tags = np.nonzero( daily )[0]
+        n = len( tags )
+        return ( x1[ tags ] - widths[ tags ], x1[ tags ], np.full( n, day[ "begins" ].min() ), np.full( n, day[ "ends" ].max() ),
+                 [ self._getTagBrush( tagclass, names[ t ] ) for t in tags ] )
+
+    def _getTagBrush( self, tagclass, tag ):
+        return self._colors.getBrush( tagclass, [] if tag is None else [ tag ] )
+
+    def _getAggregate( self, day, tagclass ):
+        """
+        Return ( names, hourly ) for tagclass on day, where hourly[ h, t ]
+        is the time spent on tag names[ t ] during hour h. A task's time is
+        split evenly between its tags. Computed once per day and class.
+        """
+        if tagclass not in day[ "aggregates" ]:
+            store = day[ "tasks" ]
+            taskTags = [ store.getTaskTags( i ).get( tagclass ) or [ None ] for i in range( len( store ) ) ]
+            names = sorted( set( t for tags in taskTags for t in tags ), key=lambda t: ( t is None, t ) )
+            ids = { t : i for i, t in enumerate( names ) }
+            shares = np.zeros( ( len( taskTags ), len( names ) ) )
+            for i, tags in enumerate( taskTags ):
+                for t in tags:
+                    shares[ i, ids[ t ] ] = 1.0 / len( tags )
+            # Tasks may run past midnight, into the next day's hours
+            hours = max( 24, int( math.ceil( day[ "ends" ].max() / 3600.0 ) ) )
+            starts = np.arange( hours ) * 3600.0
+            overlap = np.clip( np.minimum( day[ "ends" ][ :, None ], starts + 3600.0 ) -
+                               np.maximum( day[ "begins" ][ :, None ], starts ), 0, None )
+            day[ "aggregates" ][ tagclass ] = ( names, overlap.T.dot( shares ) )
+        return day[ "aggregates" ][ tagclass ]
+
+    def _getDay( self, date ):
+        """
+        Get closed tasks of date, or None if it has yet to be read. What is
+        drawn is worked out once per version of the day, and kept with its
+        entry in the application's day cache.
+        Returns a dict of tasks (a WtfdmdgTaskStore, which also holds their
+        tags), their begin and end times as seconds after midnight, and per
+        tag class aggregates.
+        """
+        app = QtWidgets.QApplication.instance()
+        entry = app.getDayEntry( date )
+        if entry is None:
+            return None
+        day = entry.derived.get( "timeline" )
+        version = ( date, entry.taskIndex.revision )
+        if day is not None and day[ "version" ] == version:
+            return day
+        profiler.count( "timeline days prepared" )
+        store = WtfdmdgTaskStore( app.getCommandParser(),
+                                  ( t for t in entry.session.values() if t.begin is not None and t.end is not None ), date )
+        tagtable = {}
+        for cls, tag in store.getTagNames():
+            tagtable.setdefault( cls, [] ).append( tag )
+        for cls in tagtable:
+            self._palette.add( cls, tagtable[ cls ] )
+        midnight = ( datetime.datetime.combine( date, datetime.time() ) - WtfdmdgTaskStore.EPOCH ) // datetime.timedelta( microseconds=1 )
+        day = {
+            "version"    : version,
+            "tasks"      : store,
+            "begins"     : ( np.frombuffer( store.getColumn( "begin" ), dtype=np.int64 ) - midnight ) / 1e6,
+            "ends"       : ( np.frombuffer( store.getColumn( "end" ), dtype=np.int64 ) - midnight ) / 1e6,
+            "aggregates" : {},
+        }
+        entry.derived[ "timeline" ] = day
+        return day
+
+    def _onScroll( self, *args ):
+        if self._span != 1:
+            QtWidgets.QApplication.instance().invalidate( QtWidgets.QApplication.instance().VIEW_TIMELINE )
+
+    def _setBars( self, x0, x1, y0, y1, brushes ):
+        """
+        Update the bar item in place. Brushes are shared through tag color
+        caches. When every bar has the same one, pyqtgraph can draw them all
+        in a single call.
+        """
+        profiler.count( "timeline bars drawn", len( brushes ) )
+        if len( brushes ) == 0:
+            self._barGraphItem.setOpts( x0=x0, x1=x1, y0=y0, y1=y1, brush=None, brushes=None )
+        elif all( b is brushes[0] for b in brushes ):
+            self._barGraphItem.setOpts( x0=x0, x1=x1, y0=y0, y1=y1, brush=brushes[0], brushes=None )
+        else:
+            self._barGraphItem.setOpts( x0=x0, x1=x1, y0=y0, y1=y1, brush=None, brushes=brushes )
+
+    @staticmethod
+    def getEpochSeconds( tasks ):
+        """
+        Return arrays of begin and end times of tasks, as seconds since the
+        epoch. Times are taken as wall clock times, so they are labeled
+        with gmtime, and a DST change never moves a task.
+        """
+        begins = np.array( [ task.begin for task in tasks ], dtype="datetime64[us]" )
+        ends = np.array( [ task.end for task in tasks ], dtype="datetime64[us]" )
+        return ( begins.astype( "int64" ) / 1e6, ends.astype( "int64" ) / 1e6 )
+
+    @profiled( "WtfdmdgTimelineWidget._getBrush" )
+    def _getBrush( self, task ):
+        """
+        Construct brush for this task
+        """
+        app = QtWidgets.QApplication.instance()
+        selectedTagClass = app.getSelectedTagClass()
+        theseTags = app.getTagsForTask( task ).get( selectedTagClass, [] )
+        return app.getTagBrush( selectedTagClass, theseTags )